@@ -0,0 +1,16 @@
+"""
+Micro benchmarks, run from the app folder:
+    python -m benchmarks.<module_name>
+"""
+import os
+
+# Set only necessary env vars without default value, benchmarks don't connect to real services
+for _name, _value in {
+    'SERVICE_NAME': 'benchmark',
+    'DATABASE_USERNAME': 'benchmark',
+    'DATABASE_PASSWORD': 'benchmark',
+    'DATABASE_HOST': 'localhost',
+    'DATABASE_PORT': '5432',
+    'DATABASE_DB': 'benchmark',
+}.items():
+    os.environ.setdefault(_name, _value)
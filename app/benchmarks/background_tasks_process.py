@@ -0,0 +1,52 @@
+"""
+Throughput of a CPU bound function with ExecutionMode.THREAD vs ExecutionMode.PROCESS by process pool size
+"""
+import asyncio
+import os
+import time
+
+from core.basckground_tasks import BackgroundTasks, ExecutionMode, ProcessPool
+from core import basckground_tasks
+
+JOBS = 32
+ITERATIONS = 300_000
+
+
+def cpu_bound(iterations: int) -> int:
+    total = 0
+    for i in range(iterations):
+        total += i * i % 7
+    return total
+
+
+async def run_jobs(tasks: BackgroundTasks, execution_mode: ExecutionMode) -> float:
+    start = time.perf_counter()
+    running = [
+        await tasks.add_auto_named_task(cpu_bound, ITERATIONS, execution_mode=execution_mode)
+        for _ in range(JOBS)
+    ]
+    await asyncio.gather(*running)
+    return JOBS / (time.perf_counter() - start)
+
+
+async def main():
+    tasks = BackgroundTasks()
+    print(f'{"mode":>8} | {"workers":>7} | {"jobs/s":>8}')
+    print(f'{"thread":>8} | {"-":>7} | {await run_jobs(tasks, ExecutionMode.THREAD):>8.2f}')
+
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        basckground_tasks.process_pool = ProcessPool(workers)
+        basckground_tasks.process_pool.start()
+        # Warm up, spawn the workers out of the measure
+        await asyncio.gather(*[
+            await tasks.add_auto_named_task(cpu_bound, 1, execution_mode=ExecutionMode.PROCESS)
+            for _ in range(workers)
+        ])
+        print(f'{"process":>8} | {workers:>7} | {await run_jobs(tasks, ExecutionMode.PROCESS):>8.2f}')
+        basckground_tasks.process_pool.shutdown()
+        workers *= 2
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""
+Purge cost against task count: full scan (previous implementation) vs expiry index
+
+Every task is done but still inside BACKGROUND_TASK_PERSISTENCE_LIMIT, which is the common case
+for each garbage collector run, so nothing should be purged
+"""
+import asyncio
+import time
+
+from core.basckground_tasks import BackgroundTasks
+from core.settings import settings
+
+TASK_COUNTS = (1_000, 10_000, 100_000)
+ROUNDS = 20
+
+
+async def noop():
+    return None
+
+
+def full_scan_purge(tasks: BackgroundTasks):
+    """ Previous purge_tasks implementation, kept here as reference """
+    for name in list(tasks._tasks.keys()):  # noqa
+        task, start_time = tasks._tasks[name]  # noqa
+        task_age = time.time() - start_time
+
+        if (task.done() or task.cancelled()) and task_age > settings.BACKGROUND_TASK_PERSISTENCE_LIMIT:
+            tasks._safe_remove_task_callback(name, None)  # noqa
+
+
+def measure(purge, tasks: BackgroundTasks) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        purge(tasks)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+async def main():
+    print(f'{"tasks":>10} | {"full scan (ms)":>15} | {"expiry index (ms)":>18}')
+    for count in TASK_COUNTS:
+        tasks = BackgroundTasks()
+        for i in range(count):
+            await tasks.add_task(f'task-{i}', noop)
+        await asyncio.gather(*(task for task, _ in tasks._tasks.values()))  # noqa
+
+        full_scan = measure(full_scan_purge, tasks)
+        indexed = measure(BackgroundTasks.purge_tasks, tasks)
+        print(f'{count:>10} | {full_scan:>15.3f} | {indexed:>18.4f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
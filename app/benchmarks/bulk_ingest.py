@@ -0,0 +1,75 @@
+"""
+Users ingest: row by row inserts vs executemany vs COPY, plain and upsert
+Needs the DB of the DATABASE_* env vars, benchmarks defaults are benchmark:benchmark@localhost:5432/benchmark
+"""
+import asyncio
+import time
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, insert
+
+from core.database import Session, engine_internal
+from schemas.entity_sample.schema_example import User
+from services.users.bulk_ingest import IngestMethod, ingest_users
+
+ROWS = 50_000
+ROW_BY_ROW_ROWS = 5_000
+BATCH_SIZE = 5000
+
+# Same columns as UserModel, without the schema placeholder and the foreign key
+table = Table(
+    'benchmark_user', MetaData(),
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('name', String, unique=True),
+    Column('fullname', String),
+    Column('disabled', Boolean),
+    Column('subscription', Integer),
+)
+
+
+async def users(rows: int):
+    for i in range(rows):
+        yield User(username=f'user{i}', full_name=f'User {i}', disabled=i % 2 == 0)
+
+
+async def row_by_row(rows: int) -> float:
+    start = time.perf_counter()
+    async with Session() as session:
+        async for user in users(rows):
+            await session.execute(
+                insert(table).values(name=user.username, fullname=user.full_name, disabled=user.disabled)
+            )
+        await session.commit()
+    return rows / (time.perf_counter() - start)
+
+
+async def reset_table():
+    async with engine_internal.begin() as connection:
+        await connection.run_sync(table.metadata.drop_all)
+        await connection.run_sync(table.metadata.create_all)
+
+
+async def main():
+    engine_internal.echo = False
+    print(f'{"method":>18} | {"rows/s":>9}')
+
+    await reset_table()
+    print(f'{"row by row":>18} | {await row_by_row(ROW_BY_ROW_ROWS):>9.0f}')
+
+    for method in IngestMethod:
+        for upsert in (False, True):
+            # Upsert over the rows of the plain insert, so every row is an update
+            if not upsert:
+                await reset_table()
+            report = await ingest_users(
+                users(ROWS), BATCH_SIZE, method, upsert=upsert, conflict_columns=('name',), table=table
+            )
+            name = f'{method}{" upsert" if upsert else ""}'
+            print(f'{name:>18} | {report["rows_per_second"]:>9.0f}')
+
+    async with engine_internal.begin() as connection:
+        await connection.run_sync(table.metadata.drop_all)
+    await engine_internal.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
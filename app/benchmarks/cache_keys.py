@@ -0,0 +1,43 @@
+"""
+Cache key build time and key length: key_exclude_txid vs hashed_key_builder
+"""
+import time
+
+from core.redis_cache import key_exclude_txid, hashed_key_builder
+from schemas.entity_sample.schema_example import User
+
+ROUNDS = 2_000
+
+
+async def get_users(**kwargs):
+    return kwargs
+
+
+def arguments() -> dict:
+    users = [User(username=f'user{i}', email=f'user{i}@mail.com') for i in range(100)]
+    return {
+        'small kwargs': {'user_id': 1, 'page': 2, 'active': True},
+        'dict 1000 items': {'filters': {f'field{i}': i for i in range(1000)}},
+        'set 1000 items': {'ids': set(range(1000))},
+        '100 models': {'users': users},
+    }
+
+
+def measure(builder, kwargs: dict) -> tuple[float, int]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        key = builder(get_users, transaction_id='txid', **kwargs)
+    return (time.perf_counter() - start) / ROUNDS * 1_000_000, len(key)  # noqa
+
+
+def main():
+    builders = {'key_exclude_txid': key_exclude_txid, 'hashed_key_builder': hashed_key_builder()}
+    print(f'{"arguments":>16} | {"builder":>18} | {"time (us)":>10} | {"key length":>10}')
+    for arguments_name, kwargs in arguments().items():
+        for builder_name, builder in builders.items():
+            elapsed, length = measure(builder, kwargs)
+            print(f'{arguments_name:>16} | {builder_name:>18} | {elapsed:>10.2f} | {length:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Encode/decode time and size of cached values: PickleSerializer vs OrjsonSerializer
+"""
+import time
+from datetime import datetime
+
+from aiocache.serializers import PickleSerializer
+from pydantic import BaseModel
+
+from core.serializers import OrjsonSerializer
+from schemas.entity_sample.schema_example import User
+
+ROUNDS = 200
+
+
+class Order(BaseModel):
+    id: int
+    created: datetime
+    user: User
+    items: list[str]
+
+
+def payloads() -> dict:
+    users = [User(username=f'user{i}', email=f'user{i}@mail.com', full_name=f'User {i}', disabled=False)
+             for i in range(1000)]
+    return {
+        'one model': users[0],
+        '1000 models': users,
+        '1000 nested models': [
+            Order(id=i, created=datetime(2024, 1, 1), user=user, items=['a', 'b', 'c'])
+            for i, user in enumerate(users)
+        ],
+        '1000 dicts': [user.model_dump() for user in users],
+    }
+
+
+def measure(serializer, value) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        dumped = serializer.dumps(value)
+    encode = (time.perf_counter() - start) / ROUNDS * 1_000_000
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        serializer.loads(dumped)  # noqa
+    decode = (time.perf_counter() - start) / ROUNDS * 1_000_000
+    return encode, decode, len(dumped)  # noqa
+
+
+def main():
+    serializers = {
+        'pickle': PickleSerializer(),
+        'orjson': OrjsonSerializer(compress_threshold=2 ** 31),
+        'orjson+compress': OrjsonSerializer(),
+    }
+    print(f'{"payload":>20} | {"serializer":>16} | {"encode (us)":>12} | {"decode (us)":>12} | {"bytes":>9}')
+    for payload_name, value in payloads().items():
+        for serializer_name, serializer in serializers.items():
+            encode, decode, size = measure(serializer, value)
+            print(f'{payload_name:>20} | {serializer_name:>16} | {encode:>12.1f} | {decode:>12.1f} | {size:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+CPU time vs bytes saved of the CompressionMiddleware encoders at each level, for whole JSON bodies and for an
+NDJSON stream compressed chunk by chunk. zstd and br are measured only if "zstandard" and "brotli" are installed
+"""
+import functools
+import time
+
+from core.utils import dump_json
+from middleware.compression import encoders
+from schemas.entity_sample.schema_example import User
+
+# Encoder: levels, the default of the middleware included
+LEVELS = {
+    'gzip': (1, 4, 6, 9),
+    'br': (0, 2, 4, 6, 9, 11),
+    'zstd': (1, 3, 6, 10, 19),
+}
+_LEVEL_ARGUMENT = {'gzip': 'gzip_level', 'br': 'brotli_quality', 'zstd': 'zstd_level'}
+# In seconds, minimum time measured by case
+MEASURE_TIME = 0.5
+STREAM_CHUNK_ROWS = 100
+
+
+def payloads() -> dict[str, bytes]:
+    users = [User(username=f'user{i}', email=f'user{i}@mail.com', full_name=f'User {i}', disabled=i % 7 == 0)
+             for i in range(10000)]
+    return {
+        '10 users': dump_json(users[:10]),
+        '1000 users': dump_json(users[:1000]),
+        '10000 users': dump_json(users),
+    }
+
+
+def stream_chunks() -> list[bytes]:
+    rows = [dump_json(User(username=f'user{i}', email=f'user{i}@mail.com', full_name=f'User {i}')) + b'\n'
+            for i in range(10000)]
+    return [b''.join(rows[i:i + STREAM_CHUNK_ROWS]) for i in range(0, len(rows), STREAM_CHUNK_ROWS)]
+
+
+def measure(function) -> tuple[float, bytes]:
+    rounds = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < MEASURE_TIME:
+        result = function()
+        rounds += 1
+    return elapsed / rounds, result  # noqa
+
+
+def compress_body(body: bytes, encoder) -> bytes:
+    return encoder.compress(body)
+
+
+def compress_stream(chunks: list[bytes], encoder) -> bytes:
+    process, finish = encoder.stream()
+    return b''.join(process(_) for _ in chunks) + finish()
+
+
+def main():
+    # Payload: uncompressed size, compress function by encoder
+    cases = {name: (len(body), functools.partial(compress_body, body)) for name, body in payloads().items()}
+    chunks = stream_chunks()
+    cases['stream 10000 users'] = sum(len(_) for _ in chunks), functools.partial(compress_stream, chunks)
+
+    print(f'{"payload":>20} | {"encoding":>8} | {"time (us)":>10} | {"MB/s":>7} | {"bytes":>8} | {"saved":>6} | '
+          f'{"saved KB / CPU ms":>17}')
+    for payload_name, (size, compress) in cases.items():
+        print(f'{payload_name:>20} | {"none":>8} | {0:>10.1f} | {"":>7} | {size:>8} | {0:>5.0%} | {"":>17}')
+        for encoding, levels in LEVELS.items():
+            for level in levels:
+                available = encoders(**{_LEVEL_ARGUMENT[encoding]: level})
+                if encoding not in available:
+                    break
+                elapsed, compressed = measure(lambda: compress(available[encoding]))
+                saved = size - len(compressed)
+                print(f'{payload_name:>20} | {f"{encoding} {level}":>8} | {elapsed * 1_000_000:>10.1f} | '
+                      f'{size / elapsed / 1_000_000:>7.1f} | {len(compressed):>8} | {saved / size:>5.0%} | '
+                      f'{saved / 1024 / (elapsed * 1000):>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
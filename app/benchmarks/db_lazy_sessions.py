@@ -0,0 +1,72 @@
+"""
+Pool pressure of requests declaring get_db: eager checkout (connection on open) vs lazy (first statement)
+Needs the DB of the DATABASE_* env vars, benchmarks defaults are benchmark:benchmark@localhost:5432/benchmark
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy import event, text
+
+from core.database import engine_internal, session_usage
+from routers.common.depends import get_db
+
+REQUESTS = 500
+# Requests that run a query, the rest only declare the dependency
+QUERY_RATIO = 0.2
+REQUEST_TIME = 0.01
+
+db_session = asynccontextmanager(get_db)
+
+
+class PoolPressure:
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak = 0
+
+    # noinspection PyUnusedLocal
+    def on_checkout(self, *args):
+        self.checkouts += 1
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+
+    # noinspection PyUnusedLocal
+    def on_checkin(self, *args):
+        self.in_use -= 1
+
+
+async def request(number: int, eager: bool):
+    async with db_session() as session:
+        if eager:
+            await session.connection()
+        if number % int(1 / QUERY_RATIO) == 0:
+            await session.execute(text(f'SELECT pg_sleep({REQUEST_TIME})'))
+        else:
+            await asyncio.sleep(REQUEST_TIME)
+
+
+async def run(eager: bool) -> tuple[float, PoolPressure]:
+    pressure = PoolPressure()
+    event.listen(engine_internal.sync_engine, 'checkout', pressure.on_checkout)
+    event.listen(engine_internal.sync_engine, 'checkin', pressure.on_checkin)
+    start = time.perf_counter()
+    await asyncio.gather(*(request(i, eager) for i in range(REQUESTS)))
+    elapsed = time.perf_counter() - start
+    event.remove(engine_internal.sync_engine, 'checkout', pressure.on_checkout)
+    event.remove(engine_internal.sync_engine, 'checkin', pressure.on_checkin)
+    return elapsed, pressure
+
+
+async def main():
+    engine_internal.echo = False
+    print(f'{"mode":>6} | {"elapsed (s)":>11} | {"checkouts":>9} | {"peak in use":>11}')
+    for eager in (True, False):
+        elapsed, pressure = await run(eager)
+        print(f'{"eager" if eager else "lazy":>6} | {elapsed:>11.2f} | {pressure.checkouts:>9} | {pressure.peak:>11}')
+    print(f'session usage: {session_usage.as_dict()}')
+    await engine_internal.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
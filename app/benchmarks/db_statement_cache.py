@@ -0,0 +1,71 @@
+"""
+Repeated query with the SQLAlchemy compiled cache and the asyncpg prepared statement cache on and off,
+built on every execution vs prebuilt
+Needs the DB of the DATABASE_* env vars, benchmarks defaults are benchmark:benchmark@localhost:5432/benchmark
+"""
+import asyncio
+import time
+
+from sqlalchemy import bindparam, column, select, table
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core.database import _database_url
+from core.settings import settings
+from core.statements import instrument_statement_cache, prebuilt, statement_cache_stats
+
+EXECUTIONS = 3000
+
+pg_class = table('pg_class', column('oid'), column('relname'), column('relnamespace'),
+                 schema='pg_catalog')
+pg_namespace = table('pg_namespace', column('oid'), column('nspname'), schema='pg_catalog')
+
+
+def build():
+    return (
+        select(pg_class.c.oid, pg_class.c.relname, pg_namespace.c.nspname)
+        .join_from(pg_class, pg_namespace, pg_class.c.relnamespace == pg_namespace.c.oid)
+        .where(pg_class.c.relname.like(bindparam('pattern')), pg_namespace.c.nspname == bindparam('schema'))
+        .order_by(pg_class.c.relname)
+        .limit(bindparam('limit'))
+    )
+
+
+@prebuilt
+def prebuilt_query():
+    return build()
+
+
+async def run(query_cache_size: int, prepared_statement_cache_size: int, statement) -> tuple[float, dict]:
+    engine = create_async_engine(
+        _database_url(settings.DATABASE_HOST, settings.DATABASE_PORT),
+        query_cache_size=query_cache_size,
+        connect_args={'prepared_statement_cache_size': prepared_statement_cache_size},
+    )
+    instrument_statement_cache(engine)
+    params = {'pattern': 'pg_%', 'schema': 'pg_catalog', 'limit': 5}
+    async with engine.connect() as connection:
+        # Warm-up, connection and first compilation
+        await connection.execute(statement(), params)
+        statement_cache_stats.__init__()
+        start = time.perf_counter()
+        for _ in range(EXECUTIONS):
+            (await connection.execute(statement(), params)).all()
+        elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return EXECUTIONS / elapsed, statement_cache_stats.as_dict()
+
+
+async def main():
+    print(f'{"statement":>9} | {"compiled cache":>14} | {"prepared cache":>14} | {"queries/s":>9} | stats')
+    for statement_name, statement in (('built', build), ('prebuilt', prebuilt_query)):
+        for query_cache_size, prepared_statement_cache_size in ((0, 0), (500, 0), (500, 100)):
+            qps, stats = await run(query_cache_size, prepared_statement_cache_size, statement)
+            stats = {k: v for k, v in stats.items() if v}
+            print(
+                f'{statement_name:>9} | {query_cache_size:>14} | {prepared_statement_cache_size:>14} | '
+                f'{qps:>9.0f} | {stats}'
+            )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""
+Import time of main.py, the cold start before the app can serve, with python -X importtime in a new interpreter
+"""
+import collections
+import statistics
+import subprocess
+import sys
+
+RUNS = 5
+TOP = 15
+# Imported on first use, shown to check nothing imports them on startup
+LAZY_MODULES = ('pyodbc', 'asyncpg', 'sqlalchemy.dialects.postgresql.asyncpg')
+
+
+def import_times() -> list[tuple[str, int, int]]:
+    """
+    :return: module, self and cumulative time in microseconds, in import order
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output=True, text=True, check=True
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, module = line.removeprefix('import time:').split('|')
+        times.append((module.strip(), int(self_time), int(cumulative)))
+    return times
+
+
+def main():
+    runs = [import_times() for _ in range(RUNS)]
+    totals = [next(cumulative for module, _, cumulative in times if module == 'main') for times in runs]
+    print(f'import main: {statistics.median(totals) / 1000:.0f} ms median of {RUNS} '
+          f'(min {min(totals) / 1000:.0f}, max {max(totals) / 1000:.0f})')
+
+    # Last run, by top level package
+    times = runs[-1]
+    by_package = collections.Counter()
+    for module, self_time, _ in times:
+        by_package[module.split('.')[0]] += self_time
+    print(f'\n{"package":>30} | {"self (ms)":>9}')
+    for package, self_time in by_package.most_common(TOP):
+        print(f'{package:>30} | {self_time / 1000:>9.1f}')
+
+    print(f'\n{"module":>50} | {"cumulative (ms)":>15}')
+    for module, _, cumulative in sorted(times, key=lambda _: _[2], reverse=True)[:TOP]:
+        print(f'{module:>50} | {cumulative / 1000:>15.1f}')
+
+    imported = {module for module, _, _ in times}
+    print('\nlazy modules imported on startup:', [_ for _ in LAZY_MODULES if _ in imported] or 'none')
+
+
+if __name__ == '__main__':
+    main()
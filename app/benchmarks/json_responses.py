@@ -0,0 +1,77 @@
+"""
+Body of pydantic_orjson_result: models to dicts then orjson (default) vs dump_json (direct=True, pydantic-core straight
+to bytes, orjson for other values). The payloads have no values written differently by them, see dump_json
+"""
+import time
+import warnings
+from datetime import datetime
+
+from orjson import orjson
+from pydantic import BaseModel
+
+from core.pagination import Page
+from core.utils import dump_json
+from schemas.entity_sample.schema_example import User
+
+ROUNDS = 100
+_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class Order(BaseModel):
+    id: int
+    created: datetime
+    user: User
+    items: list[str]
+
+
+def payloads() -> dict:
+    users = [User(username=f'user{i}', email=f'user{i}@mail.com', full_name=f'User {i}', disabled=False)
+             for i in range(10000)]
+    orders = [
+        Order(id=i, created=datetime(2024, 1, 1), user=user, items=['a', 'b', 'c'])
+        for i, user in enumerate(users[:1000])
+    ]
+    return {
+        'one model': users[0],
+        '1000 models': users[:1000],
+        '10000 models': users,
+        '1000 nested models': orders,
+        'page of 1000 nested': Page[Order](items=orders, next_cursor='cursor'),
+        '1000 dicts': [user.model_dump() for user in users[:1000]],
+    }
+
+
+def dict_orjson(value) -> bytes:
+    # Default pydantic_orjson_result + ORJSONResponse
+    if isinstance(value, BaseModel):
+        return orjson.dumps(value.dict(), option=_OPTIONS)
+    elif isinstance(value, list):
+        return orjson.dumps([_.dict() if isinstance(_, BaseModel) else _ for _ in value], option=_OPTIONS)
+    return orjson.dumps(value, option=_OPTIONS)
+
+
+def measure(serializer, value) -> tuple[float, bytes]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        dumped = serializer(value)
+    return (time.perf_counter() - start) / ROUNDS * 1_000_000, dumped  # noqa
+
+
+def main():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    serializers = {'dict + orjson': dict_orjson, 'dump_json': dump_json}
+    print(f'{"payload":>20} | {"serializer":>14} | {"time (us)":>10} | {"speedup":>7} | {"bytes":>8}')
+    for payload_name, value in payloads().items():
+        baseline = None
+        results = []
+        for serializer_name, serializer in serializers.items():
+            elapsed, dumped = measure(serializer, value)
+            baseline = baseline or elapsed
+            results.append(orjson.loads(dumped))
+            print(f'{payload_name:>20} | {serializer_name:>14} | {elapsed:>10.1f} | '
+                  f'{baseline / elapsed:>6.2f}x | {len(dumped):>8}')
+        assert all(_ == results[0] for _ in results), f'{payload_name}: different JSON'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Requests by second of GET /health-check/ served by server.py with one worker and with one per CPU, and the time
+to drain on SIGTERM. The load client runs in this process with keep-alive connections, so with few CPUs it takes
+CPU from the workers
+"""
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from server import worker_count
+
+DURATION = 10
+CONNECTIONS = 64
+PATH = '/health-check/'
+REQUEST = f'GET {PATH} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers: int, port: int, reuse_port: bool) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        'SERVER_HOST': '127.0.0.1',
+        'SERVER_PORT': str(port),
+        'SERVER_WORKERS': str(workers),
+        'SERVER_REUSE_PORT': str(reuse_port),
+    }
+    return subprocess.Popen(
+        [sys.executable, 'server.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+async def wait_ready(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(REQUEST)
+            await reader.readuntil(b'\r\n\r\n')
+            writer.close()
+            return
+        except (OSError, asyncio.IncompleteReadError):
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f'Server not ready on port {port}')
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    await reader.readexactly(length)
+    return int(head.split(b' ', 2)[1])
+
+
+async def connection_load(port: int, deadline: float, counts: dict):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            writer.write(REQUEST)
+            try:
+                status = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                # Closed by a recycled worker
+                counts['errors'] += 1
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                continue
+            counts['ok' if status == 200 else 'errors'] += 1
+    finally:
+        writer.close()
+
+
+async def load(port: int) -> dict:
+    counts = {'ok': 0, 'errors': 0}
+    deadline = time.monotonic() + DURATION
+    await asyncio.gather(*(connection_load(port, deadline, counts) for _ in range(CONNECTIONS)))
+    return counts
+
+
+def run(workers: int, reuse_port: bool = False) -> tuple[float, int, float]:
+    """
+    :return: requests by second, errors and seconds to stop on SIGTERM
+    """
+    port = free_port()
+    server = start_server(workers, port, reuse_port)
+    try:
+        asyncio.run(wait_ready(port))
+        counts = asyncio.run(load(port))
+    finally:
+        start = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        drain = time.perf_counter() - start
+    return counts['ok'] / DURATION, counts['errors'], drain
+
+
+def main():
+    workers = worker_count()
+    print(f'{DURATION} s, {CONNECTIONS} keep-alive connections, {os.cpu_count()} CPUs')
+    print(f'{"workers":>20} | {"req/s":>8} | {"errors":>6} | {"SIGTERM (s)":>11}')
+    cases = [(1, False), (workers, False)]
+    if hasattr(socket, 'SO_REUSEPORT'):
+        cases.append((workers, True))
+    for count, reuse_port in cases:
+        requests_per_second, errors, drain = run(count, reuse_port)
+        name = f'{count}{" SO_REUSEPORT" if reuse_port else ""}'
+        print(f'{name:>20} | {requests_per_second:>8.0f} | {errors:>6} | {drain:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,30 @@
 import asyncio
 import functools
+import multiprocessing
+import pickle
 import time
+import weakref
 from asyncio import Task
-from collections import defaultdict
-from typing import DefaultDict, Any, Callable, ParamSpec, Tuple
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import StrEnum
+from typing import DefaultDict, Any, Callable, ParamSpec, Tuple, Deque, Dict, Hashable
 
 import structlog
 from starlette.concurrency import run_in_threadpool
 
 from .settings import settings
-from .utils import generate_transaction_id
+from .utils import available_cpus, generate_transaction_id
 
 logger = structlog.get_logger('_api_')
 
 P = ParamSpec('P')
 
+# Task class used when no one is given
+DEFAULT_TASK_CLASS = 'default'
+# Task class for internal tasks (garbage collector), does not consume slots of the global limit
+SYSTEM_TASK_CLASS = 'system'
+
 
 class CancelledTask(ValueError):
     pass
@@ -28,49 +38,325 @@ class ResultNotSet(ValueError):
     pass
 
 
+class NotExistingTaskClass(ValueError):
+    pass
+
+
+class TaskQueueFull(ValueError):
+    pass
+
+
+class TaskClassBusy(ValueError):
+    pass
+
+
+class NotPicklableTask(ValueError):
+    pass
+
+
+class ProcessPoolNotStarted(RuntimeError):
+    pass
+
+
+class ExecutionMode(StrEnum):
+    ASYNC = 'async'  # coroutine functions, in the event loop
+    THREAD = 'thread'  # sync functions, in the starlette thread pool
+    PROCESS = 'process'  # CPU bound sync functions, in the process pool
+
+
+class ProcessPool:
+    """
+    ProcessPoolExecutor for ExecutionMode.PROCESS tasks, started and shut down by the app lifespan
+    """
+    _executor: ProcessPoolExecutor | None
+
+    def __init__(self, max_workers: int = 0) -> None:
+        """
+        :param max_workers: 0 means the CPUs divided by the server workers, each one starts its own pool
+        """
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def workers(self) -> int:
+        return self.max_workers or max(1, available_cpus() // max(1, settings.SERVER_WORKERS))
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # fork is not safe with the threads of the event loop and the thread pool
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+    def shutdown(self, wait: bool = True):
+        """
+        Cancel the jobs not started yet and stop the workers
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func: Callable[P, Any], *args: P.args, **kwargs: P.kwargs) -> Any:
+        """
+        Run func in a worker process, func, arguments and result must be picklable.
+        Cancelling the caller cancels the job only if it didn't start, a running job ends in the worker and
+        its result is discarded
+        """
+        if self._executor is None:
+            raise ProcessPoolNotStarted
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+
+process_pool = ProcessPool(settings.BACKGROUND_TASK_PROCESS_WORKERS)
+
+
 class BackgroundTask:
     def __init__(
-            self, func: Callable[P, Any], *args: P.args, **kwargs: P.kwargs
+            self,
+            func: Callable[P, Any], *args: P.args, execution_mode: ExecutionMode | None = None, **kwargs: P.kwargs
     ) -> None:
+        """
+        :param execution_mode: by default ASYNC for coroutine functions and THREAD for the rest
+        """
+        is_coroutine = asyncio.iscoroutinefunction(func)
+        if execution_mode is None:
+            execution_mode = ExecutionMode.ASYNC if is_coroutine else ExecutionMode.THREAD
+        elif (execution_mode == ExecutionMode.ASYNC) != is_coroutine:
+            raise ValueError(f'Execution mode {execution_mode} not valid for {func}')
+
+        if execution_mode == ExecutionMode.PROCESS:
+            # Fail in the caller instead of in the pool
+            try:
+                pickle.dumps((func, args, kwargs))
+            except Exception as e:
+                raise NotPicklableTask(str(e)) from e
+
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.execution_mode = execution_mode
 
     async def __call__(self) -> None:
-        if asyncio.iscoroutinefunction(self.func):
+        if self.execution_mode == ExecutionMode.ASYNC:
             return await self.func(*self.args, **self.kwargs)
-        else:
+        elif self.execution_mode == ExecutionMode.THREAD:
             return await run_in_threadpool(self.func, *self.args, **self.kwargs)
+        else:
+            return await process_pool.run(self.func, *self.args, **self.kwargs)
+
+
+class TaskClass:
+    """
+    Named group of background tasks with its own concurrency limit and priority
+    """
+
+    def __init__(
+            self,
+            name: str,
+            limit: int = 0,
+            priority: int = 1,
+            max_queue: int = 0,
+            shared: bool = True
+    ) -> None:
+        """
+        :param name:
+        :param limit: max tasks of this class running at time, 0 means no limit
+        :param priority: weight of this class when sharing the global limit, a class with priority 2 gets
+            twice the slots than a class with priority 1 while both have tasks waiting
+        :param max_queue: max tasks of this class waiting for a slot, 0 means no limit
+        :param shared: if the tasks of this class consume slots of the global limit
+        """
+        if priority < 1:
+            raise ValueError('Task class priority must be greater than 0')
+        self.name = name
+        self.limit = limit
+        self.priority = priority
+        self.max_queue = max_queue
+        self.shared = shared
+        self.running: int = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # Weighted fair queuing virtual time, the class with the lowest one is served first
+        self.virtual_time: float = 0.0
 
 
 class BackgroundTasks:
     _tasks: DefaultDict[str, Tuple[Task, float]]
-    _semaphore: asyncio.BoundedSemaphore | None
-
-    def __init__(self, max_requests_at_time: int = 0) -> None:
+    # (monotonic completion time, name, task) ordered by completion, used by purge_tasks. Weak reference, so a
+    # removed task and its result are freed without waiting for its expiry
+    _expiry_index: Deque[Tuple[float, str, weakref.ReferenceType[Task]]]
+    _task_classes: Dict[str, TaskClass]
+    # Coalescing key: name of the running task
+    _in_flight: Dict[Hashable, str]
+    # Name: extra callers sharing the task
+    _shared: Dict[str, int]
+
+    def __init__(self, max_requests_at_time: int = 0, task_classes: list[TaskClass] | None = None) -> None:
+        """
+        :param max_requests_at_time: global limit of running tasks shared by all classes, 0 means no limit
+        :param task_classes: extra task classes, "default" and "system" are always registered
+        """
         self._tasks = defaultdict()
-        self._semaphore = asyncio.BoundedSemaphore(max_requests_at_time) if max_requests_at_time else None
+        self._expiry_index = deque()
+        self._limit = max_requests_at_time
+        self._running = 0  # running tasks of shared classes
+        self._virtual_time = 0.0
+        self._task_classes = {}
+        self._in_flight = {}
+        self._shared = {}
+        # Tasks not created because an identical one was running
+        self.coalesced_tasks = 0
+        self.register_task_class(TaskClass(DEFAULT_TASK_CLASS))
+        self.register_task_class(TaskClass(SYSTEM_TASK_CLASS, shared=False))
+        for task_class in task_classes or []:
+            self.register_task_class(task_class)
+
+    def register_task_class(self, task_class: TaskClass):
+        """
+        Add or replace a task class
+        Raise TaskClassBusy when replacing a class with tasks running or waiting, they would never get a slot
+        """
+        current = self._task_classes.get(task_class.name)
+        if current is not None and (current.running or current.waiters):
+            raise TaskClassBusy(task_class.name)
+        self._task_classes[task_class.name] = task_class
+
+    def task_classes_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            name: {'running': task_class.running, 'waiting': len(task_class.waiters)}
+            for name, task_class in self._task_classes.items()
+        }
+
+    def _get_task_class(self, name: str) -> TaskClass:
+        try:
+            return self._task_classes[name]
+        except KeyError:
+            raise NotExistingTaskClass(name)
+
+    def _has_slot(self, task_class: TaskClass) -> bool:
+        if task_class.limit and task_class.running >= task_class.limit:
+            return False
+        return not task_class.shared or not self._limit or self._running < self._limit
+
+    def _start(self, task_class: TaskClass):
+        task_class.running += 1
+        if task_class.shared:
+            self._running += 1
+            self._virtual_time = max(self._virtual_time, task_class.virtual_time)
+            task_class.virtual_time += 1 / task_class.priority
+
+    def _request_slot(self, task_class: TaskClass) -> asyncio.Future:
+        """
+        Return a future resolved when the task can run, resolved from the beginning if there is a free slot
+        """
+        slot = asyncio.get_running_loop().create_future()
+        if not task_class.waiters and self._has_slot(task_class):
+            self._start(task_class)
+            slot.set_result(None)
+            return slot
+
+        if task_class.max_queue and len(task_class.waiters) >= task_class.max_queue:
+            raise TaskQueueFull(task_class.name)
+
+        if not task_class.waiters:
+            # An idle class must not claim the slots it didn't use while idle
+            task_class.virtual_time = max(task_class.virtual_time, self._virtual_time)
+        task_class.waiters.append(slot)
+        return slot
+
+    def _dispatch(self):
+        """
+        Give free slots to waiting tasks, the class with the lowest virtual time first
+        """
+        while True:
+            candidates = [
+                task_class for task_class in self._task_classes.values()
+                if task_class.waiters and self._has_slot(task_class)
+            ]
+            if not candidates:
+                return
+
+            task_class = min(candidates, key=lambda _: (_.virtual_time, -_.priority))
+            slot = task_class.waiters.popleft()
+            if slot.done():
+                continue
+            self._start(task_class)
+            slot.set_result(None)
 
-    async def _executor(self, task: BackgroundTask):
-        if not self._semaphore:
-            return await task()
-        else:
-            async with self._semaphore:
-                return await task()
+    # noinspection PyUnusedLocal
+    def _release_slot_callback(self, task_class: TaskClass, slot: asyncio.Future, task: Task):
+        if not slot.done() or slot.cancelled():
+            # Cancelled before having a slot
+            if slot in task_class.waiters:
+                task_class.waiters.remove(slot)
+            slot.cancel()
+            return
+
+        task_class.running -= 1
+        if task_class.shared:
+            self._running -= 1
+        self._dispatch()
+
+    # noinspection PyMethodMayBeStatic
+    async def _executor(self, task: BackgroundTask, slot: asyncio.Future):
+        await slot
+        return await task()
 
     async def add_auto_named_task(
             self,
-            func: Callable[P, Any], *args: P.args, **kwargs: P.kwargs
+            func: Callable[P, Any], *args: P.args,
+            task_class: str = DEFAULT_TASK_CLASS, execution_mode: ExecutionMode | None = None,
+            coalesce: bool = False,
+            **kwargs: P.kwargs
     ) -> (str, Task):
+        """
+        Schedule a task with a generated name, "coalesce" is reserved and not forwarded to func
+        With coalesce, if an identical task (same func and arguments) is running, it is returned instead of
+        creating a new one, and it is removed when the last caller gets its result or removes it
+        """
+        key = self._coalesce_key(func, args, kwargs, task_class, execution_mode) if coalesce else None
+        if key is not None and (name := self._in_flight.get(key)) and name in self._tasks:
+            self._shared[name] = self._shared.get(name, 0) + 1
+            self.coalesced_tasks += 1
+            return self._tasks[name][0]
+
         name = generate_transaction_id()
-        return await self.add_task(name, func, *args, **kwargs)
+        task = await self.add_task(
+            name, func, *args, task_class=task_class, execution_mode=execution_mode, **kwargs
+        )
+        if key is not None:
+            self._in_flight[key] = name
+            task.add_done_callback(
+                functools.partial(self._in_flight_done_callback, key, name)
+            )
+        return task
+
+    @staticmethod
+    def _coalesce_key(func: Callable, args: tuple, kwargs: dict, *options) -> Hashable | None:
+        key = (func, args, tuple(sorted(kwargs.items())), *options)
+        try:
+            hash(key)
+        except TypeError:
+            logger.debug(f'Not hashable arguments, task not coalesced: {func}')
+            return None
+        return key
+
+    # noinspection PyUnusedLocal
+    def _in_flight_done_callback(self, key: Hashable, name: str, task: Task):
+        if self._in_flight.get(key) == name:
+            del self._in_flight[key]
 
     async def add_fire_and_forget_task(
             self,
-            func: Callable[P, Any], *args: P.args, **kwargs: P.kwargs
+            func: Callable[P, Any], *args: P.args,
+            task_class: str = DEFAULT_TASK_CLASS, execution_mode: ExecutionMode | None = None,
+            **kwargs: P.kwargs
     ) -> Task:
         name = generate_transaction_id()
-        task = await self.add_task(name, func, *args, **kwargs)
+        background_task = BackgroundTask(func, *args, execution_mode=execution_mode, **kwargs)
+        # Not indexed, removes itself on completion
+        task = self._register_task(name, background_task, task_class, indexed=False)
         task.add_done_callback(
             functools.partial(self._safe_remove_task_callback, name)
         )
@@ -79,16 +365,44 @@ class BackgroundTasks:
     async def add_task(
             self,
             name: str,
-            func: Callable[P, Any], *args: P.args, **kwargs: P.kwargs,
+            func: Callable[P, Any], *args: P.args,
+            task_class: str = DEFAULT_TASK_CLASS, execution_mode: ExecutionMode | None = None,
+            **kwargs: P.kwargs,
     ) -> Task:
-        background_task = BackgroundTask(func, *args, **kwargs)
+        """
+        Schedule a task, "task_class" and "execution_mode" are reserved and not forwarded to func
+        Raise TaskQueueFull if the class has max_queue tasks waiting
+        Raise NotPicklableTask if execution_mode is PROCESS and func or its arguments can't be pickled
+        """
+        background_task = BackgroundTask(func, *args, execution_mode=execution_mode, **kwargs)
+        return self._register_task(name, background_task, task_class)
+
+    def _register_task(
+            self, name: str, background_task: BackgroundTask, task_class: str, indexed: bool = True
+    ) -> Task:
+        _task_class = self._get_task_class(task_class)
+        slot = self._request_slot(_task_class)
         task = asyncio.create_task(
-            self._executor(background_task),
+            self._executor(background_task, slot),
             name=name
         )
+        # Release the slot even if the task is cancelled before starting
+        task.add_done_callback(
+            functools.partial(self._release_slot_callback, _task_class, slot)
+        )
         self._tasks[name] = task, time.time()  # UNIX time of start
+        if indexed:
+            task.add_done_callback(
+                functools.partial(self._index_done_task_callback, name)
+            )
         return task
 
+    def _index_done_task_callback(self, name: str, task: Task):
+        """
+        Append the finished task to the expiry index. Tasks finish in time order, so the index stays sorted
+        """
+        self._expiry_index.append((time.monotonic(), name, weakref.ref(task)))
+
     # noinspection PyUnusedLocal
     def _safe_remove_task_callback(self, name: str, task: Task = None):
         """
@@ -102,7 +416,14 @@ class BackgroundTasks:
     def remove_task(self, name: str, auto_cancel: bool = True):
         """
         Remove a task if exists
+        PROCESS tasks already running in a worker can't be stopped, they end there and the result is discarded
+        A coalesced task is only cancelled and removed by its last caller
         """
+        if self._shared.get(name):
+            self._shared[name] -= 1
+            return
+
+        self._shared.pop(name, None)
         if name in self._tasks:
             task, start_time = self._tasks[name]
             if auto_cancel and not task.cancelled():
@@ -138,23 +459,28 @@ class BackgroundTasks:
 
     def purge_tasks(self):
         """
-        Purge all done or cancelled tasks that have been in memory for more than BACKGROUND_TASK_PERSISTENCE_LIMIT
+        Purge all done or cancelled tasks that have been finished for more than BACKGROUND_TASK_PERSISTENCE_LIMIT
+        Only expired entries of the expiry index are visited, the rest of the tasks are not scanned
         BE CAREFUL, can be deleted even if no-one called to result_task
         """
-        for name in list(self._tasks.keys()):
-            task, start_time = self._tasks[name]
-            task_age = time.time() - start_time
-
-            if (task.done() or task.cancelled()) and task_age > settings.BACKGROUND_TASK_PERSISTENCE_LIMIT:
+        expire_before = time.monotonic() - settings.BACKGROUND_TASK_PERSISTENCE_LIMIT
+        while self._expiry_index and self._expiry_index[0][0] <= expire_before:
+            _, name, task_ref = self._expiry_index.popleft()
+            # Skip entries already removed or whose name was reused by a newer task
+            if name in self._tasks and self._tasks[name][0] is task_ref():
+                self._shared.pop(name, None)
                 self._safe_remove_task_callback(name, None)
 
     async def garbage_collector(self):
         await asyncio.sleep(settings.BACKGROUND_TASK_GARBAGE_RESOLUTION)
         self.purge_tasks()
-        await background_tasks.add_fire_and_forget_task(background_tasks.garbage_collector)
+        await self.add_fire_and_forget_task(self.garbage_collector, task_class=SYSTEM_TASK_CLASS)
 
 
-background_tasks = BackgroundTasks(settings.BACKGROUND_TASK_LIMIT)
+background_tasks = BackgroundTasks(
+    settings.BACKGROUND_TASK_LIMIT,
+    [TaskClass(name, **config) for name, config in settings.BACKGROUND_TASK_CLASSES.items()]
+)
 
 _background_tasks = set()
 
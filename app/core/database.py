@@ -1,36 +1,285 @@
-import pyodbc
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import asyncio
+import functools
+import itertools
+from typing import Awaitable, Callable, TypeVar
+
+import structlog
+from sqlalchemy import Delete, Insert, Update, text, event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session as OrmSession
 
+from core.basckground_tasks import background_tasks, SYSTEM_TASK_CLASS
+from core.db_pool import AdaptiveLimiter, InstrumentedPool, instrument_engine
+from core.query_log import query_log
+from core.statements import instrument_statement_cache
 from core.settings import settings, Environment
 
-# Prevent to pyodbc create internal pool
-# https://docs.sqlalchemy.org/en/14/dialects/mssql.html#pyodbc-pooling-connection-close-behavior
-pyodbc.pooling = False
+logger = structlog.get_logger('_api_')
+
+T = TypeVar('T')
+
+
+def _database_url(host: str, port: str) -> str:
+    return (
+        f'postgresql+asyncpg://'
+        f'{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD}'
+        f'@{host}:{str(port)}'
+        f'/{settings.DATABASE_DB}'
+    )
 
-# Internal DB
-engine_internal = create_async_engine(
-    f'postgresql+asyncpg://'
-    f'{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD}'
-    f'@{settings.DATABASE_HOST}:{str(settings.DATABASE_PORT)}'
-    f'/{settings.DATABASE_DB}',
+
+_engine_options = dict(
     # isolation_level="READ COMMITTED",
     # Prevent connection loss
     pool_use_lifo=True,
     pool_pre_ping=True,
-    pool_size=15,
-    max_overflow=5,
-    pool_recycle=300,
+    pool_size=settings.DATABASE_POOL_SIZE,
+    max_overflow=settings.DATABASE_MAX_OVERFLOW,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE,
+    poolclass=InstrumentedPool,
+    query_cache_size=settings.DATABASE_QUERY_CACHE_SIZE,
+    connect_args={'prepared_statement_cache_size': settings.DATABASE_PREPARED_STATEMENT_CACHE_SIZE},
     echo=True if settings.ENVIRONMENT == Environment.DEV else False
 )
 
+
+def _create_engine(host: str, port: str) -> AsyncEngine:
+    engine = create_async_engine(_database_url(host, port), **_engine_options)
+    if engine.dialect.driver == 'pyodbc':
+        # Prevent to pyodbc create internal pool, only imported when a pyodbc engine is used
+        # https://docs.sqlalchemy.org/en/14/dialects/mssql.html#pyodbc-pooling-connection-close-behavior
+        import pyodbc
+        pyodbc.pooling = False
+    limiter = AdaptiveLimiter(
+        settings.DATABASE_POOL_SIZE + settings.DATABASE_MAX_OVERFLOW,
+        min_limit=settings.DATABASE_POOL_ADAPTIVE_MIN,
+        target_wait=settings.DATABASE_POOL_ADAPTIVE_TARGET_WAIT
+    ) if settings.DATABASE_POOL_ADAPTIVE else None
+    instrument_engine(engine, limiter)
+    if settings.QUERY_LOG_ENABLED:
+        query_log.instrument(engine)
+    instrument_statement_cache(engine)
+    return engine
+
+
+@functools.cache
+def get_engine() -> AsyncEngine:
+    """
+    Internal DB engine, created on first use so importing this module doesn't load the driver.
+    Also available as "engine_internal"
+    """
+    return _create_engine(settings.DATABASE_HOST, settings.DATABASE_PORT)
+
+
+def _replica_engine(replica: str) -> AsyncEngine:
+    """
+    :param replica: "host" or "host:port"
+    """
+    host, _, port = replica.partition(':')
+    return _create_engine(host, port or settings.DATABASE_PORT)
+
+
+@functools.cache
+def get_replica_engines() -> list[AsyncEngine]:
+    """
+    Read replicas of internal DB, created on first use. Also available as "replica_engines"
+    """
+    return [_replica_engine(replica) for replica in settings.DATABASE_REPLICA_HOSTS]
+
+
+Base = declarative_base()
+
+
+class SessionUsage:
+    """
+    Sessions opened by the DB dependencies, and how many of them never checked out a connection
+    """
+
+    def __init__(self) -> None:
+        self.sessions = 0
+        self.untouched = 0
+
+    def record(self, session: AsyncSession):
+        self.sessions += 1
+        if not session.info.get('touched'):
+            self.untouched += 1
+
+    def as_dict(self) -> dict:
+        return {'sessions': self.sessions, 'untouched': self.untouched}
+
+
+session_usage = SessionUsage()
+
+
+# noinspection PyUnusedLocal
+@event.listens_for(OrmSession, 'after_begin')
+def _mark_session_touched(session: OrmSession, transaction, connection):
+    """
+    Called when the session checks out a connection, on its first statement
+    """
+    session.info['touched'] = True
+
+
+class ReplicaRouter:
+    """
+    Choose the replica engine for read only sessions, replicas with too much lag are not used until they catch up.
+    Without healthy replicas the primary is used
+    """
+    # Lag in seconds, 0 if the replica replayed all it received
+    LAG_QUERY = text(
+        'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+    )
+
+    def __init__(
+            self, primary: AsyncEngine, replicas: list[AsyncEngine], balancing: str = 'round_robin', max_lag: float = 10
+    ) -> None:
+        """
+        :param balancing: "round_robin" or "least_connections"
+        :param max_lag: in seconds
+        """
+        if balancing not in ('round_robin', 'least_connections'):
+            raise ValueError(f'Unknown replica balancing: {balancing}')
+        self.primary = primary
+        self.replicas = replicas
+        self.balancing = balancing
+        self.max_lag = max_lag
+        self.healthy: list[AsyncEngine] = list(replicas)
+        self._counter = itertools.count()
+
+    def get_engine(self) -> AsyncEngine:
+        healthy = self.healthy
+        if not healthy:
+            return self.primary
+        if self.balancing == 'least_connections':
+            return min(healthy, key=lambda engine: engine.pool.checkedout())  # noqa
+        return healthy[next(self._counter) % len(healthy)]
+
+    async def _replica_lag(self, engine: AsyncEngine) -> float:
+        try:
+            async with engine.connect() as connection:
+                return float((await connection.execute(self.LAG_QUERY)).scalar())
+        except Exception:  # noqa
+            logger.exception(f'Error checking replica lag: {engine.url.host}:{engine.url.port}')
+            return float('inf')
+
+    async def check_lag(self):
+        lags = await asyncio.gather(*(self._replica_lag(engine) for engine in self.replicas))
+        healthy = [engine for engine, lag in zip(self.replicas, lags) if lag <= self.max_lag]
+        for engine, lag in zip(self.replicas, lags):
+            if engine in self.healthy and engine not in healthy:
+                logger.warning(f'Replica out of rotation, lag {lag} s: {engine.url.host}:{engine.url.port}')
+        self.healthy = healthy
+
+    async def lag_monitor(self):
+        await self.check_lag()
+        await asyncio.sleep(settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL)
+        await background_tasks.add_fire_and_forget_task(self.lag_monitor, task_class=SYSTEM_TASK_CLASS)
+
+
+@functools.cache
+def get_replica_router() -> ReplicaRouter:
+    """
+    Also available as "replica_router"
+    """
+    return ReplicaRouter(
+        get_engine(), get_replica_engines(),
+        balancing=settings.DATABASE_REPLICA_BALANCING, max_lag=settings.DATABASE_REPLICA_MAX_LAG
+    )
+
+
+class RoutingSession(OrmSession):
+    """
+    Bound to the primary, resolved on the first statement so the engine is created on first use.
+    Read only sessions (info["read_only"]) read from one replica, after the first write (or flush) all the
+    statements go to the primary, so the session reads its own writes
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get('read_only') and not self.info.get('has_written'):
+            if not self._flushing and not isinstance(clause, (Insert, Update, Delete)):
+                # Same replica for the whole session, for consistent reads
+                if (engine := self.info.get('replica')) is None:
+                    engine = self.info['replica'] = get_replica_router().get_engine()
+                return engine.sync_engine
+            self.info['has_written'] = True
+        return get_engine().sync_engine
+
+
 Session = sessionmaker(
     autocommit=False,
     autoflush=False,
-    bind=engine_internal,
     class_=AsyncSession,
+    sync_session_class=RoutingSession,
     expire_on_commit=False
 )
 
-Base = declarative_base()
+ReadOnlySession = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
+    expire_on_commit=False,
+    info={'read_only': True}
+)
+
+
+@functools.cache
+def get_fan_out_limiter() -> asyncio.Semaphore:
+    """
+    Queries at time of all the fan_out calls of the worker, so concurrent requests don't take the whole pool
+    """
+    return asyncio.Semaphore(settings.DATABASE_FAN_OUT_CONCURRENCY or max(
+        1, (_engine_options['pool_size'] + _engine_options['max_overflow']) // 2
+    ))
+
+
+async def fan_out(
+        *queries: Callable[[AsyncSession], Awaitable[T]],
+        session_factory: sessionmaker = Session
+) -> list[T]:
+    """
+    Run independent queries in parallel, each one in its own short-lived session because an AsyncSession can't be
+    used concurrently. The queries at time are limited by get_fan_out_limiter, shared by all the calls.
+    If a query fails the others are cancelled and its exception is raised.
+    Example:
+        user, subscriptions = await fan_out(
+            lambda session: session.get(UserModel, user_id),
+            lambda session: session.scalars(select(SubscriptionModel)),
+        )
+
+    :param queries: async callables receiving the session
+    :param session_factory: Session or ReadOnlySession
+    :return: results in the same order as the queries
+    """
+    semaphore = get_fan_out_limiter()
+
+    async def run(query: Callable[[AsyncSession], Awaitable[T]]) -> T:
+        async with semaphore:
+            async with session_factory() as session:
+                return await query(session)
+
+    tasks = [asyncio.create_task(run(query)) for query in queries]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Don't leave queries running with their connections checked out
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def __getattr__(name: str):
+    """
+    Lazy module attributes, "from core.database import engine_internal" still works but creates the engine,
+    modules imported on startup should call the get_ functions when used
+    """
+    if name == 'engine_internal':
+        return get_engine()
+    elif name == 'replica_engines':
+        return get_replica_engines()
+    elif name == 'replica_router':
+        return get_replica_router()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
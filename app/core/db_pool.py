@@ -0,0 +1,239 @@
+import asyncio
+import collections
+import time
+
+import structlog
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry
+from sqlalchemy.util import await_only
+
+logger = structlog.get_logger('_api_')
+
+_CHECKOUT_AT = 'checkout_at'
+
+
+class AdaptiveLimiter:
+    """
+    Connections checked out at time, adjusted every interval from the observed checkout wait and hold time:
+    - The hold time (checkout to checkin) grows over twice its baseline: the DB is saturated, more concurrency
+      only makes every query slower, so the limit decreases by a quarter
+    - Checkouts wait more than target_wait with a healthy DB: the limit increases by one, up to max_limit
+    Waiting for the limiter is cheaper than queueing queries in the DB
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 2, target_wait: float = 0.01, interval: float = 1) -> None:
+        """
+        :param max_limit: usually pool_size + max_overflow
+        :param min_limit:
+        :param target_wait: in seconds, average checkout wait tolerated before increasing the limit
+        :param interval: in seconds, time between adjustments
+        """
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.target_wait = target_wait
+        self.interval = interval
+        self.limit = max_limit
+        self.in_use = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._baseline_hold: float | None = None
+        self._window_start = time.monotonic()
+        self._window_waits = []
+        self._window_holds = []
+
+    async def acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Woken but cancelled before running, pass the slot
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        while self._waiters and self.in_use < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_use += 1
+                waiter.set_result(None)
+
+    def observe(self, wait: float | None = None, hold: float | None = None):
+        if wait is not None:
+            self._window_waits.append(wait)
+        if hold is not None:
+            self._window_holds.append(hold)
+
+        now = time.monotonic()
+        if now - self._window_start < self.interval:
+            return
+        self._adjust()
+        self._window_start = now
+        self._window_waits.clear()
+        self._window_holds.clear()
+
+    def _adjust(self):
+        if not self._window_holds:
+            return
+        hold = sum(self._window_holds) / len(self._window_holds)
+        wait = sum(self._window_waits) / len(self._window_waits) if self._window_waits else 0
+        # The baseline drifts up slowly, so it follows a DB that became slower for good
+        self._baseline_hold = hold if self._baseline_hold is None else min(self._baseline_hold * 1.05, hold)
+
+        limit = self.limit
+        if hold > self._baseline_hold * 2:
+            limit = max(self.min_limit, int(limit * 0.75))
+        elif wait > self.target_wait:
+            limit = min(self.max_limit, limit + 1)
+
+        if limit != self.limit:
+            logger.info(f'DB concurrency limit {self.limit} -> {limit}, hold {hold:.4f} s, wait {wait:.4f} s')
+            self.limit = limit
+            self._wake_up()
+
+    def as_dict(self) -> dict:
+        return {'limit': self.limit, 'in_use': self.in_use, 'waiting': len(self._waiters)}
+
+
+class PoolMetrics:
+    """
+    Counters of an InstrumentedPool, times in seconds
+    """
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        # Pool timeouts and connection errors
+        self.checkout_errors = 0
+        self.in_use_peak = 0
+        # Checkouts served while the pool was over pool_size
+        self.overflow_checkouts = 0
+        self.overflow_peak = 0
+        self.connects = 0
+        self.pre_ping_failures = 0
+        self.invalidations = 0
+        self.recycles = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'checkouts': self.checkouts,
+            'checkout_wait_avg': self.checkout_wait_total / self.checkouts if self.checkouts else 0.0,
+            'checkout_wait_max': self.checkout_wait_max,
+            'checkout_errors': self.checkout_errors,
+            'in_use_peak': self.in_use_peak,
+            'overflow_checkouts': self.overflow_checkouts,
+            'overflow_peak': self.overflow_peak,
+            'connects': self.connects,
+            'pre_ping_failures': self.pre_ping_failures,
+            'invalidations': self.invalidations,
+            'recycles': self.recycles,
+        }
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool recording PoolMetrics, with an optional AdaptiveLimiter in front of the checkouts.
+    Pre-ping failures are recorded by the engine "handle_error" event, see instrument_engine
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replaced by the ones of the previous pool when recreated (engine dispose)
+        self.metrics = PoolMetrics()
+        self.limiter: AdaptiveLimiter | None = None
+        # A recreated pool receives the listeners of the previous one
+        if '_dispatch' not in kwargs:
+            event.listen(self, 'connect', self._on_connect)
+            event.listen(self, 'invalidate', self._on_invalidate)
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        start = time.perf_counter()
+        if self.limiter:
+            # Pool methods run in the greenlet of the async engine
+            await_only(self.limiter.acquire())
+        try:
+            record = super()._do_get()
+        except Exception:
+            self.metrics.checkout_errors += 1
+            if self.limiter:
+                self.limiter.release()
+            raise
+
+        now = time.perf_counter()
+        wait = now - start
+        record.info[_CHECKOUT_AT] = now
+
+        metrics = self.metrics
+        metrics.checkouts += 1
+        metrics.checkout_wait_total += wait
+        metrics.checkout_wait_max = max(metrics.checkout_wait_max, wait)
+        metrics.in_use_peak = max(metrics.in_use_peak, self.checkedout())
+        if (overflow := self.overflow()) > 0:
+            metrics.overflow_checkouts += 1
+            metrics.overflow_peak = max(metrics.overflow_peak, overflow)
+        # Same condition the record checks next to reconnect
+        if record.dbapi_connection is not None and -1 < self._recycle < time.time() - record.starttime:
+            metrics.recycles += 1
+        if self.limiter:
+            self.limiter.observe(wait=wait)
+        return record
+
+    def _do_return_conn(self, record: ConnectionPoolEntry) -> None:
+        checkout_at = record.info.pop(_CHECKOUT_AT, None)
+        try:
+            super()._do_return_conn(record)
+        finally:
+            if self.limiter:
+                self.limiter.release()
+                if checkout_at is not None:
+                    self.limiter.observe(hold=time.perf_counter() - checkout_at)
+
+    def recreate(self) -> 'InstrumentedPool':
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        pool.limiter = self.limiter
+        return pool
+
+    # noinspection PyUnusedLocal
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.metrics.connects += 1
+
+    # noinspection PyUnusedLocal
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.metrics.invalidations += 1
+
+    def status_dict(self) -> dict:
+        status = {
+            'size': self.size(),
+            'in_use': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            **self.metrics.as_dict(),
+        }
+        if self.limiter:
+            status['adaptive'] = self.limiter.as_dict()
+        return status
+
+
+def instrument_engine(engine: AsyncEngine, limiter: AdaptiveLimiter | None = None):
+    """
+    :param engine: created with poolclass=InstrumentedPool
+    :param limiter: adaptive concurrency, disabled by default
+    """
+    engine.pool.limiter = limiter
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def _on_error(context):
+        if context.is_pre_ping:
+            engine.pool.metrics.pre_ping_failures += 1
@@ -0,0 +1,285 @@
+import asyncio
+import contextlib
+import os
+import pickle
+import socket
+from typing import Any, Callable, ParamSpec
+
+import redis.asyncio as redis
+import structlog
+
+from .basckground_tasks import (
+    BackgroundTask, ExecutionMode, NotExistingTask, ResultNotSet, background_tasks, SYSTEM_TASK_CLASS
+)
+from .redis_cache import blocking_redis_client
+from .settings import settings
+
+logger = structlog.get_logger('_api_')
+
+P = ParamSpec('P')
+
+_PENDING = 'pending'
+_DONE = 'done'
+_ERROR = 'error'
+
+
+class NotRegisteredTask(ValueError):
+    pass
+
+
+class DistributedTaskError(Exception):
+    """
+    Raised by result_task when the task failed with an exception that could not be pickled
+    """
+    pass
+
+
+class DistributedTasks:
+    """
+    Background tasks shared by all the workers and nodes through a Redis Stream with a consumer group
+
+    Delivery is at least once: a task is acknowledged after its result is stored, and the tasks of crashed
+    consumers are delivered again after claim_idle_time, so the functions must be idempotent.
+    Functions are sent by name, they must be registered with "register" in every worker.
+    The Redis client is received as param, so it can be a fakeredis client for testing
+    """
+
+    def __init__(
+            self,
+            client: redis.Redis,
+            stream: str,
+            group: str = 'workers',
+            consumer: str | None = None,
+            concurrency: int = 10,
+            result_ttl: int = 6 * 60 * 60,
+            claim_idle_time: int = 60,
+            max_deliveries: int = 5,
+    ) -> None:
+        """
+        :param client:
+        :param stream: Redis key of the stream, also used as prefix for the results
+        :param group: consumer group, all the workers of the service must use the same
+        :param consumer: unique name of this worker, by default hostname and pid
+        :param concurrency: tasks running at time in this worker
+        :param result_ttl: in seconds, time to keep the results
+        :param claim_idle_time: in seconds, time without heartbeat before a task is delivered again
+        :param max_deliveries: deliveries before a task is set as failed
+        """
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.concurrency = concurrency
+        self.result_ttl = result_ttl
+        self.claim_idle_time = claim_idle_time
+        self.max_deliveries = max_deliveries
+        self._functions: dict[str, Callable] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._consumer_task: asyncio.Task | None = None
+        self._stopping = False
+
+    def register(self, func: Callable[P, Any]) -> Callable[P, Any]:
+        """
+        Decorator to allow a function to be executed as distributed task
+        """
+        self._functions[self._function_name(func)] = func
+        return func
+
+    @staticmethod
+    def _function_name(func: Callable) -> str:
+        return f'{func.__module__}:{func.__qualname__}'
+
+    def _result_key(self, name: str) -> str:
+        return f'{self.stream}:result:{name}'
+
+    async def add_task(
+            self,
+            name: str,
+            func: Callable[P, Any], *args: P.args, execution_mode: ExecutionMode | None = None, **kwargs: P.kwargs
+    ) -> str:
+        """
+        Publish a task, any worker can run it. Arguments and result must be picklable
+        "execution_mode" is reserved and not forwarded to func
+        """
+        function_name = self._function_name(func)
+        if function_name not in self._functions:
+            raise NotRegisteredTask(function_name)
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(self._result_key(name), pickle.dumps({'status': _PENDING}), ex=self.result_ttl)
+            pipe.xadd(self.stream, {
+                'name': name,
+                'function': function_name,
+                'execution_mode': execution_mode or '',
+                'payload': pickle.dumps((args, kwargs)),
+            })
+            await pipe.execute()
+        return name
+
+    async def remove_task(self, name: str):
+        """
+        Remove a task and its result, if it did not start will not be run
+        A task already running in a worker can't be stopped, it ends there and the result is discarded
+        """
+        await self.client.delete(self._result_key(name))
+
+    async def result_task(self, name: str, auto_remove: bool = True):
+        """
+        If the task had any Exception, will be thrown from here
+        """
+        stored = await self.client.get(self._result_key(name))
+        if stored is None:
+            raise NotExistingTask
+
+        result = pickle.loads(stored)
+        if result['status'] == _PENDING:
+            raise ResultNotSet
+
+        if auto_remove:
+            await self.remove_task(name)
+
+        if result['status'] == _ERROR:
+            raise result['error']
+        return result['result']
+
+    async def _ensure_group(self):
+        try:
+            await self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def start(self):
+        await self._ensure_group()
+        self._stopping = False
+        self._consumer_task = asyncio.create_task(self._consume(), name=f'distributed-tasks-{self.consumer}')
+
+    async def stop(self):
+        """
+        Stop consuming, tasks not finished will be delivered again to other consumer after claim_idle_time
+        """
+        if self._consumer_task:
+            # Some clients swallow the cancellation while blocked reading, the flag ends the loop anyway
+            self._stopping = True
+            self._consumer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._consumer_task
+            self._consumer_task = None
+
+    async def _consume(self):
+        claim_start = '0-0'
+        while not self._stopping:
+            try:
+                # Tasks of crashed consumers first
+                claim_start = await self._claim_stuck_tasks(claim_start)
+
+                response = await self.client.xreadgroup(
+                    self.group, self.consumer, {self.stream: '>'},
+                    count=self.concurrency, block=self.claim_idle_time * 1000 // 2
+                )
+                for _, messages in response or []:
+                    for message_id, fields in messages:
+                        await self._dispatch(message_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa
+                logger.exception('Error consuming distributed tasks')
+                await asyncio.sleep(1)
+
+    async def _claim_stuck_tasks(self, start: str) -> str:
+        response = await self.client.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=self.claim_idle_time * 1000, start_id=start, count=self.concurrency
+        )
+        next_start, messages = response[0], response[1]
+        for message_id, fields in messages:
+            if not fields:
+                # Deleted from the stream
+                await self.client.xack(self.stream, self.group, message_id)
+                continue
+
+            pending = await self.client.xpending_range(
+                self.stream, self.group, min=message_id, max=message_id, count=1
+            )
+            if pending and pending[0]['times_delivered'] > self.max_deliveries:
+                name = fields[b'name'].decode()
+                logger.error(f'Distributed task exceeded max deliveries: {name}')
+                await self._finish(message_id, name, {
+                    'status': _ERROR,
+                    'error': DistributedTaskError(f'Max deliveries exceeded: {self.max_deliveries}')
+                })
+                continue
+
+            await self._dispatch(message_id, fields)
+        return next_start.decode() if isinstance(next_start, bytes) else next_start
+
+    async def _dispatch(self, message_id: bytes, fields: dict[bytes, bytes]):
+        await self._semaphore.acquire()
+        task = await background_tasks.add_fire_and_forget_task(
+            self._process, message_id, fields, task_class=SYSTEM_TASK_CLASS
+        )
+        task.add_done_callback(lambda _: self._semaphore.release())
+
+    async def _heartbeat(self, message_id: bytes):
+        """
+        Reset the idle time of a running task so other consumers don't claim it
+        """
+        while True:
+            await asyncio.sleep(self.claim_idle_time / 2)
+            await self.client.xclaim(
+                self.stream, self.group, self.consumer, min_idle_time=0, message_ids=[message_id], justid=True
+            )
+
+    async def _process(self, message_id: bytes, fields: dict[bytes, bytes]):
+        name = fields[b'name'].decode()
+        if not await self.client.exists(self._result_key(name)):
+            # Removed before starting
+            await self._finish(message_id, name, None)
+            return
+
+        function_name = fields[b'function'].decode()
+        heartbeat = asyncio.create_task(self._heartbeat(message_id))
+        try:
+            func = self._functions[function_name]
+            args, kwargs = pickle.loads(fields[b'payload'])
+            execution_mode = fields[b'execution_mode'].decode() or None
+            result = {
+                'status': _DONE,
+                'result': await BackgroundTask(func, *args, execution_mode=execution_mode, **kwargs)()
+            }
+        except Exception as e:
+            logger.exception(f'Error in distributed task: {name}')
+            result = {'status': _ERROR, 'error': e}
+        finally:
+            heartbeat.cancel()
+
+        await self._finish(message_id, name, result)
+
+    async def _finish(self, message_id: bytes, name: str, result: dict | None):
+        """
+        Store the result, only if the task was not removed meanwhile, then remove the message
+        """
+        async with self.client.pipeline(transaction=True) as pipe:
+            if result is not None:
+                try:
+                    stored = pickle.dumps(result)
+                except Exception as e:
+                    stored = pickle.dumps({'status': _ERROR, 'error': DistributedTaskError(repr(e))})
+                pipe.set(self._result_key(name), stored, ex=self.result_ttl, xx=True)
+            pipe.xack(self.stream, self.group, message_id)
+            pipe.xdel(self.stream, message_id)
+            await pipe.execute()
+
+
+distributed_tasks = DistributedTasks(
+    blocking_redis_client(
+        settings.REDIS_ENDPOINT, settings.REDIS_PORT,
+        # Consumer blocking read, heartbeats and results
+        max_connections=settings.DISTRIBUTED_TASKS_CONCURRENCY * 2 + 2
+    ),
+    stream=f'{settings.SERVICE_NAME}:tasks',
+    concurrency=settings.DISTRIBUTED_TASKS_CONCURRENCY,
+    result_ttl=settings.DISTRIBUTED_TASKS_RESULT_TTL,
+    claim_idle_time=settings.DISTRIBUTED_TASKS_CLAIM_IDLE_TIME,
+    max_deliveries=settings.DISTRIBUTED_TASKS_MAX_DELIVERIES,
+)
@@ -31,3 +31,9 @@ class UserNotFound(BaseAPIHTTPException):
     http_status_code = status.HTTP_404_NOT_FOUND
     default_message = 'User not found'
     example_message = default_message
+
+
+class InvalidCursor(BaseAPIHTTPException):
+    http_status_code = status.HTTP_400_BAD_REQUEST
+    default_message = 'Invalid pagination cursor'
+    example_message = default_message
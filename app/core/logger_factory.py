@@ -49,7 +49,7 @@ def logger_factory():
             logger: logging.Logger, method_name: str, event_dict: EventDict
     ) -> EventDict:
         """ Add api name to logger """
-        event_dict['api'] = settings.API_NAME
+        event_dict['api'] = settings.SERVICE_NAME
         return event_dict
 
     structlog.configure(
@@ -0,0 +1,205 @@
+"""
+OpenAPI document served as prebuilt bytes, with gzip and brotli variants and ETags.
+Build it on deploy from the app folder, with the settings of the environment (root path, OPENAPI_SERVER):
+    python -m core.openapi [directory]
+The document is tied to the build id of the code (BUILD_ID or the git commit) and the version and settings of the
+app. Without a prebuilt document, without build id, or with one of other build or settings, it's built on the first
+request
+"""
+import functools
+import gzip
+import hashlib
+import subprocess
+import sys
+from pathlib import Path
+
+import structlog
+from fastapi import FastAPI
+from orjson import orjson
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from core.settings import settings
+from core.utils import negotiate_encoding
+
+try:
+    import brotli
+except ImportError:  # optional, only the gzip variant is built when not installed
+    brotli = None
+
+logger = structlog.get_logger('_api_')
+
+IDENTITY = 'identity'
+# Content-Encoding: file extension, in order of preference
+_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+_FILE = 'openapi.json'
+_META_FILE = 'openapi.meta.json'
+
+
+def _git(*args: str) -> subprocess.CompletedProcess | None:
+    try:
+        return subprocess.run(['git', *args], cwd=settings.BASE_PATH, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+@functools.cache
+def build_id() -> str:
+    """
+    settings.BUILD_ID, otherwise the git commit of BASE_PATH. Empty if unknown or with uncommitted changes, as the
+    commit doesn't identify the code then
+    """
+    if settings.BUILD_ID:
+        return settings.BUILD_ID
+    commit = _git('rev-parse', 'HEAD')
+    if commit is None or commit.returncode:
+        return ''
+    changes = _git('diff', '--quiet', 'HEAD')
+    if changes is None or changes.returncode:
+        return ''
+    return commit.stdout.strip()
+
+
+def fingerprint(app: FastAPI) -> str:
+    """
+    Hash of the build id and the settings of the app, a prebuilt document of other code or settings is not used
+    """
+    source = orjson.dumps(
+        [build_id(), app.title, app.description, app.version, app.servers, app.root_path], default=str
+    )
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+
+def build_document(app: FastAPI, root_path: str) -> bytes:
+    # Same servers as the FastAPI route
+    schema = app.openapi()
+    if root_path and app.root_path_in_servers:
+        if root_path not in {server.get('url') for server in schema.get('servers', [])}:
+            schema = {**schema, 'servers': [{'url': root_path}, *schema.get('servers', [])]}
+    return orjson.dumps(schema)
+
+
+def compress(content: bytes) -> dict[str, bytes]:
+    # Built once, so the highest levels
+    variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content, quality=11)
+    return variants
+
+
+class OpenAPIDocument:
+    """
+    Variants of the document by Content-Encoding, with their ETag
+    """
+
+    def __init__(self, content: bytes, compressed: dict[str, bytes]) -> None:
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        self.variants = {IDENTITY: (content, f'"{digest}"')}
+        for encoding, body in compressed.items():
+            self.variants[encoding] = body, f'"{digest}-{encoding}"'
+
+    def _encoding(self, request: Request) -> str:
+        return negotiate_encoding(
+            request.headers.get('accept-encoding', ''), [_ for _ in _EXTENSIONS if _ in self.variants]
+        ) or IDENTITY
+
+    def response(self, request: Request) -> Response:
+        encoding = self._encoding(request)
+        body, etag = self.variants[encoding]
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if encoding != IDENTITY:
+            headers['Content-Encoding'] = encoding
+
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in (_.strip() for _ in if_none_match.split(','))):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type='application/json', headers=headers)
+
+
+def write_prebuilt(app: FastAPI, directory: Path) -> dict[str, int]:
+    """
+    :return: size in bytes by file
+    """
+    root_path = (app.root_path or '').rstrip('/')
+    content = build_document(app, root_path)
+    files = {_FILE: content}
+    for encoding, body in compress(content).items():
+        files[_FILE + _EXTENSIONS[encoding]] = body
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for extension in _EXTENSIONS.values():
+        # Variants of a previous build without the encoder now
+        (directory / (_FILE + extension)).unlink(missing_ok=True)
+    for name, body in files.items():
+        (directory / name).write_bytes(body)
+    (directory / _META_FILE).write_bytes(orjson.dumps(
+        {'fingerprint': fingerprint(app), 'build_id': build_id(), 'version': app.version, 'root_path': root_path}
+    ))
+    return {name: len(body) for name, body in files.items()}
+
+
+def load_prebuilt(app: FastAPI, directory: Path) -> tuple[str, OpenAPIDocument] | None:
+    """
+    :return: root path and document, None if not built or outdated
+    """
+    try:
+        meta = orjson.loads((directory / _META_FILE).read_bytes())
+        content = (directory / _FILE).read_bytes()
+    except FileNotFoundError:
+        return None
+    if not build_id():
+        logger.warning(f'Prebuilt OpenAPI document in {directory} not used without BUILD_ID or a clean git commit, '
+                       f'it will be built on first request')
+        return None
+    if meta.get('fingerprint') != fingerprint(app):
+        logger.warning(f'Prebuilt OpenAPI document in {directory} is outdated, it will be built on first request')
+        return None
+
+    compressed = {}
+    for encoding, extension in _EXTENSIONS.items():
+        if (path := directory / (_FILE + extension)).exists():
+            compressed[encoding] = path.read_bytes()
+    return meta['root_path'], OpenAPIDocument(content, compressed)
+
+
+def use_prebuilt_openapi(app: FastAPI, directory: Path | None = None):
+    """
+    Replace the FastAPI openapi route by one serving an OpenAPIDocument by root path: the prebuilt one if found
+    in directory, otherwise built on the first request. Call it after adding the routes
+    :param app:
+    :param directory: OPENAPI_PREBUILT_DIR by default
+    """
+    if not app.openapi_url:
+        return
+
+    documents: dict[str, OpenAPIDocument] = {}
+    if prebuilt := load_prebuilt(app, directory or settings.OPENAPI_PREBUILT_DIR):
+        root_path, document = prebuilt
+        documents[root_path] = document
+
+    async def openapi(request: Request) -> Response:
+        root_path = request.scope.get('root_path', '').rstrip('/')
+        if (document := documents.get(root_path)) is None:
+            content = build_document(app, root_path)
+            document = documents[root_path] = OpenAPIDocument(content, compress(content))
+        return document.response(request)
+
+    routes = app.router.routes
+    for index, route in enumerate(routes):
+        if isinstance(route, Route) and route.path == app.openapi_url:
+            routes[index] = Route(app.openapi_url, openapi, include_in_schema=False)
+
+
+def main():
+    from main import app
+
+    if not build_id():
+        sys.exit('Set BUILD_ID or commit the changes, a prebuilt document without build id is not used')
+    directory = Path(sys.argv[1]) if len(sys.argv) > 1 else settings.OPENAPI_PREBUILT_DIR
+    for name, size in write_prebuilt(app, directory).items():
+        print(f'{directory / name}: {size} bytes')
+
+
+if __name__ == '__main__':
+    main()
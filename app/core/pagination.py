@@ -0,0 +1,153 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Annotated, Any, Callable, Generic, Sequence, TypeVar
+
+from fastapi import Query
+from orjson import orjson
+from pydantic import BaseModel
+from sqlalchemy import ColumnElement, Select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.exceptions import InvalidCursor
+from core.settings import settings
+
+T = TypeVar('T')
+
+_SIGNATURE_SIZE = 16
+# Types orjson dumps as str, restored from the cursor by the python type of the key column
+_FROM_STR: dict[type, Callable[[str], Any]] = {
+    datetime: datetime.fromisoformat,
+    date: date.fromisoformat,
+    time: time.fromisoformat,
+    uuid.UUID: uuid.UUID,
+    Decimal: Decimal,
+}
+
+
+class PaginationSecretNotSet(RuntimeError):
+    pass
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    # None on the last page
+    next_cursor: str | None = None
+
+
+class PageParams:
+    """
+    Dependency with the query params of a keyset page: ?limit=50&cursor=<next_cursor of the previous page>
+    """
+
+    def __init__(
+            self,
+            limit: Annotated[int, Query(ge=1, le=settings.PAGINATION_MAX_LIMIT)] = settings.PAGINATION_DEFAULT_LIMIT,
+            cursor: Annotated[str | None, Query()] = None,
+    ) -> None:
+        self.limit = limit
+        self.cursor = cursor
+
+
+def _b64encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode()
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def _signature(keys: Sequence[ColumnElement], descending: bool, payload: bytes) -> bytes:
+    """
+    :raise PaginationSecretNotSet:
+    """
+    if not settings.PAGINATION_SECRET:
+        raise PaginationSecretNotSet('PAGINATION_SECRET is needed to sign the pagination cursors')
+    # The key names and the direction are signed too, so a cursor of other keys or order is rejected
+    message = ','.join(key.key for key in keys).encode() + (b' desc\n' if descending else b' asc\n') + payload
+    return hmac.new(settings.PAGINATION_SECRET.encode(), message, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+
+
+def encode_cursor(keys: Sequence[ColumnElement], values: Sequence[Any], descending: bool = False) -> str:
+    # Decimal as str
+    payload = orjson.dumps(list(values), default=str)
+    return f'{_b64encode(payload)}.{_b64encode(_signature(keys, descending, payload))}'
+
+
+def _python_type(key: ColumnElement) -> type | None:
+    try:
+        return key.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def decode_cursor(keys: Sequence[ColumnElement], cursor: str, descending: bool = False) -> list[Any]:
+    """
+    :raise InvalidCursor: malformed, tampered or from other keys or order
+    """
+    try:
+        payload, signature = (_b64decode(_) for _ in cursor.split('.'))
+    except (ValueError, binascii.Error):
+        raise InvalidCursor
+    if not hmac.compare_digest(signature, _signature(keys, descending, payload)):
+        raise InvalidCursor
+
+    values = orjson.loads(payload)
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise InvalidCursor
+    try:
+        return [
+            _FROM_STR[python_type](value)
+            if isinstance(value, str) and (python_type := _python_type(key)) in _FROM_STR else value
+            for key, value in zip(keys, values)
+        ]
+    except ValueError:
+        raise InvalidCursor
+
+
+async def paginate(
+        session: AsyncSession,
+        statement: Select,
+        keys: Sequence[ColumnElement],
+        params: PageParams,
+        converter: Callable[[Any], Any] | None = None,
+        scalars: bool = True,
+        descending: bool = False,
+) -> Page:
+    """
+    Keyset pagination: the page starts after the keys of the last item of the previous page, so its cost doesn't
+    depend on the page depth as with OFFSET. The keys must be unique together and should be indexed.
+    Example:
+        @router.get('/users/')
+        @pydantic_orjson_result
+        async def list_users(page: Annotated[PageParams, Depends()], db: Annotated[AsyncSession, Depends(get_db)]):
+            return await paginate(db, select(UserModel), [UserModel.id], page, converter=to_user_schema)
+
+    :param session:
+    :param statement: select without order_by or limit, can have where
+    :param keys: columns of the order, like [UserModel.id] or [UserModel.name, UserModel.id]
+    :param params:
+    :param converter: item to the response value, usually a pydantic model
+    :param scalars: items are the first column of each row, for ORM entities. Otherwise rows, keys must be selected
+    :param descending: order of all the keys
+    :return: page for pydantic_orjson_result
+    """
+    if params.cursor:
+        after = tuple_(*keys)
+        values = tuple_(*decode_cursor(keys, params.cursor, descending))
+        statement = statement.where(after < values if descending else after > values)
+
+    statement = statement.order_by(*(key.desc() if descending else key for key in keys)).limit(params.limit + 1)
+    result = await session.execute(statement)
+    items = list(result.scalars() if scalars else result)
+
+    next_cursor = None
+    if len(items) > params.limit:
+        items = items[:params.limit]
+        next_cursor = encode_cursor(keys, [getattr(items[-1], key.key) for key in keys], descending)
+
+    return Page(items=[converter(_) for _ in items] if converter else items, next_cursor=next_cursor)
@@ -0,0 +1,186 @@
+import hashlib
+import re
+import time
+from typing import Any
+
+import structlog
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from core.basckground_tasks import add_fire_and_forget_task
+from core.settings import settings
+
+logger = structlog.get_logger('_api_')
+
+# Attribute of the execution context, so a failed statement doesn't leave anything behind
+_START_TIME = '_query_log_start'
+
+# Normalization of a statement to its fingerprint, in order
+_NORMALIZE = [
+    # Comments
+    (re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL), ' '),
+    # String literals, then numbers and bind params of any paramstyle
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+|%\(\w+\)s|%s|(?<![:\w]):\w+|\b\d+(?:\.\d+)?\b'), '?'),
+    # Lists of values, so IN clauses of different size are the same statement
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+# Statements EXPLAIN can plan without running them, EXPLAIN itself is not recorded
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_EXPLAIN = re.compile(r'^\s*EXPLAIN\b', re.IGNORECASE)
+
+
+def normalize_statement(statement: str) -> str:
+    for pattern, replacement in _NORMALIZE:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class StatementStats:
+    def __init__(self, fingerprint: str, statement: str) -> None:
+        self.fingerprint = fingerprint
+        # Normalized
+        self.statement = statement
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.slow_calls = 0
+        self.plan: Any = None
+        self.plan_time: float | None = None
+        self._explaining = False
+
+    def as_dict(self) -> dict:
+        return {
+            'fingerprint': self.fingerprint,
+            'statement': self.statement,
+            'calls': self.calls,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time,
+            'slow_calls': self.slow_calls,
+            'plan': self.plan,
+        }
+
+
+class QueryLog:
+    """
+    Time of every statement executed by the instrumented engines, aggregated by fingerprint (statement without
+    literals nor params). Statements slower than slow_threshold are logged, and their plan is captured with
+    EXPLAIN (without ANALYZE, so they aren't run again) in a background task, once every explain_interval
+    """
+
+    def __init__(
+            self,
+            slow_threshold: float = 0.5,
+            max_statements: int = 1000,
+            explain: bool = True,
+            explain_interval: int = 300,
+    ) -> None:
+        """
+        :param slow_threshold: in seconds
+        :param max_statements: fingerprints kept, the new ones are not recorded when full
+        :param explain: capture the plan of slow statements
+        :param explain_interval: in seconds, time between plans of the same fingerprint
+        """
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.statements: dict[str, StatementStats] = {}
+        # Executions not recorded because max_statements was reached
+        self.dropped = 0
+        # Normalization is cached by the statement string, SQLAlchemy reuses the compiled strings
+        self._fingerprints: dict[str, tuple[str, str]] = {}
+
+    def instrument(self, engine: AsyncEngine):
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine.sync_engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    # noinspection PyUnusedLocal
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        setattr(context, _START_TIME, time.perf_counter())
+
+    # noinspection PyUnusedLocal
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, _START_TIME, None)
+        if start is None or _EXPLAIN.match(statement):
+            return
+        elapsed = time.perf_counter() - start
+        self.record(statement, elapsed, None if executemany else parameters, conn.engine)
+
+    def _fingerprint(self, statement: str) -> tuple[str, str]:
+        if (cached := self._fingerprints.get(statement)) is None:
+            normalized = normalize_statement(statement)
+            cached = hashlib.blake2b(normalized.encode(), digest_size=8).hexdigest(), normalized
+            if len(self._fingerprints) < self.max_statements * 4:
+                self._fingerprints[statement] = cached
+        return cached
+
+    def record(self, statement: str, elapsed: float, parameters: Any = None, engine=None):
+        """
+        :param statement: as sent to the driver
+        :param elapsed: in seconds
+        :param parameters: for EXPLAIN, None if the statement can't be explained
+        :param engine: sync engine to run EXPLAIN
+        """
+        fingerprint, normalized = self._fingerprint(statement)
+        if (stats := self.statements.get(fingerprint)) is None:
+            if len(self.statements) >= self.max_statements:
+                self.dropped += 1
+                return
+            stats = self.statements[fingerprint] = StatementStats(fingerprint, normalized)
+
+        stats.calls += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        if elapsed < self.slow_threshold:
+            return
+
+        stats.slow_calls += 1
+        logger.warning(f'Slow query {elapsed:.3f} s [{fingerprint}]: {normalized}')
+        if (
+                self.explain and engine is not None and parameters is not None and not stats._explaining
+                and _EXPLAINABLE.match(statement)
+                and (stats.plan_time is None or time.monotonic() - stats.plan_time >= self.explain_interval)
+        ):
+            stats._explaining = True
+            # Called from sync code in the event loop thread
+            add_fire_and_forget_task(self._explain, stats, statement, parameters, engine)
+
+    @staticmethod
+    async def _explain(stats: StatementStats, statement: str, parameters: Any, engine):
+        try:
+            async with AsyncEngine(engine).connect() as connection:
+                result = await connection.exec_driver_sql(
+                    f'EXPLAIN (ANALYZE off, FORMAT JSON) {statement}', parameters
+                )
+                plan = result.scalar()
+            stats.plan = plan[0]['Plan'] if isinstance(plan, list) else plan
+            logger.info(f'Plan of slow query [{stats.fingerprint}]: {stats.plan}')
+        except Exception:  # noqa
+            logger.exception(f'Error explaining slow query [{stats.fingerprint}]')
+        finally:
+            stats.plan_time = time.monotonic()
+            stats._explaining = False
+
+    def top(self, limit: int = 20, order_by: str = 'total_time') -> list[dict]:
+        """
+        :param order_by: total_time, max_time, calls or slow_calls
+        """
+        statements = sorted(self.statements.values(), key=lambda _: getattr(_, order_by), reverse=True)
+        return [_.as_dict() for _ in statements[:limit]]
+
+    def reset(self):
+        self.statements.clear()
+        self.dropped = 0
+
+
+query_log = QueryLog(
+    slow_threshold=settings.QUERY_LOG_SLOW_THRESHOLD,
+    max_statements=settings.QUERY_LOG_MAX_STATEMENTS,
+    explain=settings.QUERY_LOG_EXPLAIN,
+    explain_interval=settings.QUERY_LOG_EXPLAIN_INTERVAL,
+)
@@ -1,10 +1,21 @@
 import asyncio
+import contextlib
+import hashlib
 import logging
+import math
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable
+from uuid import uuid4
 
 import redis.asyncio as redis
 import structlog
 from aiocache import caches, cached
 from aiocache.backends.redis import RedisBackend, _NOT_SET
+from orjson import orjson
+from pydantic import BaseModel
+from core.basckground_tasks import background_tasks
 from core.settings import settings
 from redis.asyncio import BlockingConnectionPool
 from tenacity import retry, wait_fixed, stop_after_attempt, retry_if_exception_type, before_sleep_log
@@ -12,6 +23,27 @@ from tenacity import retry, wait_fixed, stop_after_attempt, retry_if_exception_t
 logger = structlog.get_logger('_api_')
 
 
+def blocking_redis_client(
+        endpoint: str = '127.0.0.1', port: int = 6379, db: int = 0, password: str | None = None,
+        max_connections: int | None = None, create_connection_timeout: float | None = None
+) -> redis.Redis:
+    """
+    Redis client over a BlockingConnectionPool, waits for a free connection instead of failing when the pool is full
+    """
+    connection_pool = BlockingConnectionPool(
+        host=endpoint, port=port, db=db,
+        password=password, decode_responses=False,
+        socket_connect_timeout=create_connection_timeout,
+        max_connections=max_connections,
+        timeout=30,  # custom
+    )
+    client = redis.Redis(connection_pool=connection_pool)
+
+    # needed for consistency with how Redis creation of connection_pool works
+    client.auto_close_connection_pool = True
+    return client
+
+
 class RedisCacheBlockingPool(RedisBackend):
     """
     Based on https://github.com/aio-libs/aiocache/pull/691
@@ -24,17 +56,10 @@ class RedisCacheBlockingPool(RedisBackend):
         super().__init__(endpoint, port, db, password, pool_min_size, pool_max_size, create_connection_timeout,
                          **kwargs)
 
-        connection_pool = BlockingConnectionPool(
-            host=self.endpoint, port=self.port, db=self.db,
-            password=self.password, decode_responses=False,
-            socket_connect_timeout=self.create_connection_timeout,
-            max_connections=self.pool_max_size,
-            timeout=30,  # custom
+        self.client = blocking_redis_client(
+            self.endpoint, self.port, self.db, self.password,
+            max_connections=self.pool_max_size, create_connection_timeout=self.create_connection_timeout
         )
-        self.client = redis.Redis(connection_pool=connection_pool)
-
-        # needed for consistency with how Redis creation of connection_pool works
-        self.client.auto_close_connection_pool = True
 
 
 caches.set_config({
@@ -42,24 +67,163 @@ caches.set_config({
         'cache': "aiocache.RedisCache",
         'namespace': settings.SERVICE_NAME,
         'serializer': {
-            'class': "aiocache.serializers.PickleSerializer"
+            'class': "core.serializers.OrjsonSerializer",
+            'compress_threshold': settings.CACHE_COMPRESS_THRESHOLD
         }
     },
     'redis_alt': {
-        'cache': "core.cache.RedisCacheBlockingPool",
+        'cache': "core.redis_cache.RedisCacheBlockingPool",
         'endpoint': settings.REDIS_ENDPOINT,
         'namespace': settings.SERVICE_NAME,
-        'port': 6379,
+        'port': settings.REDIS_PORT,
         'timeout': None,  # necessary for BlockingConnectionPool, because block will wait X time
         'pool_max_size': 3,  # necessary for BlockingConnectionPool, stress tests show that more than 3 is not necessary
         'serializer': {
-            'class': "aiocache.serializers.PickleSerializer"
+            'class': "core.serializers.OrjsonSerializer",
+            'compress_threshold': settings.CACHE_COMPRESS_THRESHOLD
         },
         'ttl': 60 * 60 * 12  # 12 hours default value
     }
 })
 
 
+class LocalCache:
+    """
+    In-process LRU cache with TTL, first tier in front of Redis.
+    Values are stored as they are, not serialized, callers must not mutate them
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        """
+        Return None if the key doesn't exist or expired, like aiocache
+        """
+        if (item := self._values.get(key)) is None:
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._values[key]
+            return None
+
+        self._values.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any):
+        self._values[key] = time.monotonic() + self.ttl, value
+        self._values.move_to_end(key)
+        if len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    def delete(self, key: str):
+        self._values.pop(key, None)
+
+    def clear(self):
+        self._values.clear()
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.l2_hits = 0
+        self.l2_misses = 0
+
+    @staticmethod
+    def _rate(hits: int, misses: int) -> float:
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    @property
+    def l1_hit_rate(self) -> float:
+        return self._rate(self.l1_hits, self.l1_misses)
+
+    @property
+    def l2_hit_rate(self) -> float:
+        return self._rate(self.l2_hits, self.l2_misses)
+
+    def as_dict(self) -> dict:
+        return {
+            'l1_hits': self.l1_hits, 'l1_misses': self.l1_misses, 'l1_hit_rate': self.l1_hit_rate,
+            'l2_hits': self.l2_hits, 'l2_misses': self.l2_misses, 'l2_hit_rate': self.l2_hit_rate,
+        }
+
+
+class CacheInvalidation:
+    """
+    Propagate invalidations to the local caches of every worker through Redis pub/sub
+    """
+
+    def __init__(self, client: redis.Redis, channel: str) -> None:
+        self.client = client
+        self.channel = channel
+        self._local_caches: list[LocalCache] = []
+        self._listener_task: asyncio.Task | None = None
+
+    def register(self, local_cache: LocalCache):
+        self._local_caches.append(local_cache)
+
+    def unregister(self, local_cache: LocalCache):
+        if local_cache in self._local_caches:
+            self._local_caches.remove(local_cache)
+
+    @property
+    def has_local_caches(self) -> bool:
+        return bool(self._local_caches)
+
+    def invalidate_local(self, *keys: str):
+        for local_cache in self._local_caches:
+            for key in keys:
+                local_cache.delete(key)
+
+    async def publish(self, *keys: str):
+        self.invalidate_local(*keys)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.publish(self.channel, key)
+            await pipe.execute()
+
+    async def start(self):
+        """
+        Listen invalidations, only if any function uses a local cache
+        """
+        if self._local_caches and self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen(), name='cache-invalidation')
+
+    async def stop(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener_task
+            self._listener_task = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.invalidate_local(message['data'].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa
+                logger.exception('Error listening cache invalidations')
+                # Invalidations could be lost while disconnected
+                for local_cache in self._local_caches:
+                    local_cache.clear()
+                await asyncio.sleep(1)
+
+
+cache_invalidation = CacheInvalidation(
+    blocking_redis_client(settings.REDIS_ENDPOINT, settings.REDIS_PORT, max_connections=2),
+    f'{settings.SERVICE_NAME}:cache-invalidation'
+)
+
+
 def key_exclude_txid(func, *args, **kwargs):
     """
     Generate a cache key for methods that use transaction_id
@@ -77,26 +241,362 @@ def key_exclude_txid(func, *args, **kwargs):
     )
 
 
+_ENTRY_KEY = '__cache_entry__'
+
+# Delete the keys of every tag set (KEYS) and the sets, return the deleted keys
+_INVALIDATE_TAGS_SCRIPT = """
+local deleted = {}
+for _, tag in ipairs(KEYS) do
+    for _, key in ipairs(redis.call('SMEMBERS', tag)) do
+        redis.call('DEL', key)
+        deleted[#deleted + 1] = key
+    end
+    redis.call('DEL', tag)
+end
+return deleted
+"""
+
+_invalidation_retry = retry(
+    wait=wait_fixed(0.3),
+    stop=stop_after_attempt(30),
+    retry=(
+            retry_if_exception_type(redis.RedisError)
+            | retry_if_exception_type(asyncio.exceptions.TimeoutError)
+    ),
+    before_sleep=before_sleep_log(logger, logging.ERROR)
+)
+
+
+def _canonical_default(value: Any) -> Any:
+    """
+    orjson default for the types without a stable JSON form
+    """
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json')
+    if isinstance(value, (set, frozenset)):
+        try:
+            return sorted(value)
+        except TypeError:
+            # Elements of different types, sort by their canonical form
+            return sorted(_canonical_json(_).decode() for _ in value)
+    raise TypeError(f'Not supported in cache keys: {type(value)}, exclude the argument')
+
+
+def _canonical_json(value: Any) -> bytes:
+    try:
+        return orjson.dumps(value, default=_canonical_default, option=orjson.OPT_SORT_KEYS)
+    except orjson.JSONEncodeError:
+        # Slower, only for dicts with keys that are not str
+        return orjson.dumps(
+            value, default=_canonical_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        )
+
+
+def hashed_key_builder(exclude: Iterable[str] = ('transaction_id',)) -> Callable[..., str]:
+    """
+    Build a key_builder with fixed length keys: function path and the blake2b digest of the canonical JSON of the
+    arguments. Dicts are sorted, sets too, and pydantic models are dumped, so equal arguments give the same key
+    :param exclude: kwargs not used in the key
+    """
+    exclude = frozenset(exclude)
+
+    def key_builder(func, *args, **kwargs) -> str:
+        kwargs = {k: v for k, v in kwargs.items() if k not in exclude}
+        digest = hashlib.blake2b(_canonical_json([args, kwargs]), digest_size=16).hexdigest()
+        return f'{func.__module__}.{func.__qualname__}:{digest}'
+
+    return key_builder
+
+
 class internal_cached(cached):  # noqa
+    """
+    aiocache "cached" with "invalidate" and an optional in-process cache (L1) in front of the backend (L2).
+    L1 is invalidated in every worker when "invalidate" runs. Hits are counted in "stats" for each tier
+
+    Stampede protection, values are stored with their expiration time and compute duration:
+    - lock_lease: seconds, only one caller (in any worker) recomputes a missing key, the rest wait for its value
+    - early_expiration: XFetch beta (1 is a good start), callers recompute randomly before the expiration,
+      sooner the longer the function takes
+    - stale_ttl: seconds after the expiration the value is still returned while one refresh runs in background
+
+    Tags (Redis backends only), to invalidate many keys at once with "invalidate_tags":
+    - tags: list of tags, or function receiving the same arguments than the cached function and returning them.
+      Example: tags=lambda user_id, **_: [f'user:{user_id}']
+    """
+
+    def __init__(
+            self, *args,
+            local_cache: bool = False,
+            local_max_size: int = settings.CACHE_L1_MAX_SIZE,
+            local_ttl: float = settings.CACHE_L1_TTL,
+            lock_lease: float = 0,
+            early_expiration: float = 0,
+            stale_ttl: int = 0,
+            tags: Iterable[str] | Callable[..., Iterable[str]] | None = None,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.stats = CacheStats()
+        self.local_cache = LocalCache(local_max_size, local_ttl) if local_cache else None
+        if self.local_cache is not None:
+            cache_invalidation.register(self.local_cache)
+
+        if (early_expiration or stale_ttl) and not isinstance(self.ttl, (int, float)):
+            raise ValueError('early_expiration and stale_ttl need a ttl')
+        self.lock_lease = lock_lease
+        self.early_expiration = early_expiration
+        self.stale_ttl = stale_ttl
+        self._refreshing: set[str] = set()
+        self.tags = tags
 
     def __call__(self, f):
         self._f = f
         wrapper = super().__call__(f)
+        if self.tags and not isinstance(self.cache, RedisBackend):
+            raise ValueError('Cache tags need a Redis backend')
         wrapper.invalidate = self.invalidate
+        wrapper.invalidate_many = self.invalidate_many
+        wrapper.invalidate_tags = self.invalidate_tags
+        wrapper.stats = self.stats
         return wrapper
 
-    async def invalidate(self, *args, **kwargs):
-        @retry(
-            wait=wait_fixed(0.3),
-            stop=stop_after_attempt(30),
-            retry=(
-                    retry_if_exception_type(redis.RedisError)
-                    | retry_if_exception_type(asyncio.exceptions.TimeoutError)
-            ),
-            before_sleep=before_sleep_log(logger, logging.ERROR)
+    async def get_from_cache(self, key: str, record_stats: bool = True):
+        """
+        :param record_stats: count the hit or miss in "stats", not while waiting the value of other caller
+        """
+        if self.local_cache is not None:
+            if (value := self.local_cache.get(key)) is not None:
+                if record_stats:
+                    self.stats.l1_hits += 1
+                return value
+            if record_stats:
+                self.stats.l1_misses += 1
+
+        value = await super().get_from_cache(key)
+        if value is not None and self.local_cache is not None:
+            self.local_cache.set(key, value)
+        if record_stats:
+            if value is None:
+                self.stats.l2_misses += 1
+            else:
+                self.stats.l2_hits += 1
+        return value
+
+    async def set_in_cache(self, key, value):
+        await super().set_in_cache(key, value)
+        if self.local_cache is not None:
+            self.local_cache.set(key, value)
+
+    @property
+    def _stampede_protection(self) -> bool:
+        return bool(self.lock_lease or self.early_expiration or self.stale_ttl)
+
+    async def decorator(
+            self, f, *args, cache_read=True, cache_write=True, aiocache_wait_for_write=True, **kwargs
+    ):
+        if not self._stampede_protection and self.tags:
+            key = self.get_cache_key(f, args, kwargs)
+            if cache_read and (value := await self.get_from_cache(key)) is not None:
+                return value
+            result = await f(*args, **kwargs)
+            if cache_write and not self.skip_cache_func(result):
+                await self.set_in_cache(key, result)
+                await self._tag_key(key, args, kwargs)
+            return result
+        elif not self._stampede_protection:
+            return await super().decorator(
+                f, *args,
+                cache_read=cache_read, cache_write=cache_write, aiocache_wait_for_write=aiocache_wait_for_write,
+                **kwargs
+            )
+
+        key = self.get_cache_key(f, args, kwargs)
+        entry = await self._get_entry(key) if cache_read else None
+        if entry is not None:
+            if not self._is_expired(entry):
+                return entry['value']
+            if self._is_stale(entry):
+                await self._refresh_in_background(f, key, args, kwargs, entry)
+                return entry['value']
+
+        return await self._compute(f, key, args, kwargs, cache_write=cache_write, stale_entry=entry)
+
+    async def _get_entry(self, key: str, record_stats: bool = True) -> dict | None:
+        entry = await self.get_from_cache(key, record_stats)
+        # Values stored without stampede protection are ignored
+        return entry if isinstance(entry, dict) and entry.get(_ENTRY_KEY) else None
+
+    async def _set_entry(self, key: str, value: Any, delta: float):
+        entry = {
+            _ENTRY_KEY: True,
+            'value': value,
+            'expires_at': time.time() + self.ttl if self.early_expiration or self.stale_ttl else None,
+            'delta': delta,
+        }
+        try:
+            await self.cache.set(
+                key, entry, ttl=self.ttl + self.stale_ttl if self.stale_ttl else self.ttl
+            )
+        except Exception:  # noqa
+            logger.exception(f"Couldn't set {key}, unexpected error")
+        if self.local_cache is not None:
+            self.local_cache.set(key, entry)
+
+    def _is_expired(self, entry: dict) -> bool:
+        if entry['expires_at'] is None:
+            return False
+        now = time.time()
+        if self.early_expiration:
+            # XFetch, log of (0, 1] is negative, so it moves "now" forward
+            now -= entry['delta'] * self.early_expiration * math.log(1 - random.random())
+        return now >= entry['expires_at']
+
+    def _is_stale(self, entry: dict) -> bool:
+        """
+        Expired value that can still be returned while it is refreshed
+        """
+        return entry['expires_at'] is None or time.time() < entry['expires_at'] + self.stale_ttl
+
+    async def _refresh_in_background(self, f, key: str, args, kwargs, stale_entry: dict):
+        # One refresh per key in this worker, the lock avoids refreshes from other workers
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = await background_tasks.add_fire_and_forget_task(
+            self._compute, f, key, args, kwargs, True, stale_entry
         )
+        task.add_done_callback(lambda _: self._refreshing.discard(key))
+
+    async def _acquire_lock(self, key: str) -> str | None:
+        """
+        Same lock than aiocache RedLock, but without waiting, return the token if acquired
+        """
+        token = str(uuid4())
+        try:
+            await self.cache._add(self.cache.build_key(f'{key}-lock'), token, ttl=self.lock_lease)  # noqa
+        except ValueError:
+            return None
+        return token
+
+    async def _release_lock(self, key: str, token: str):
+        try:
+            await self.cache._redlock_release(self.cache.build_key(f'{key}-lock'), token)  # noqa
+        except Exception:  # noqa
+            logger.exception(f"Couldn't release lock of {key}, it will expire after lease")
+
+    async def _wait_for_entry(self, key: str) -> dict | None:
+        """
+        Wait the value computed by the lock owner, at most lock_lease
+        """
+        deadline = time.monotonic() + self.lock_lease
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(0.05, self.lock_lease / 10))
+            # The caller already counted its miss
+            entry = await self._get_entry(key, record_stats=False)
+            if entry is not None and not self._is_expired(entry):
+                return entry
+        return None
+
+    async def _compute(self, f, key: str, args, kwargs, cache_write=True, stale_entry: dict | None = None):
+        """
+        :param stale_entry: returned if another caller is computing and it can still be used
+        """
+        token = None
+        if self.lock_lease:
+            token = await self._acquire_lock(key)
+            if token is None:
+                if stale_entry is not None and self._is_stale(stale_entry):
+                    return stale_entry['value']
+                if (entry := await self._wait_for_entry(key)) is not None:
+                    return entry['value']
+                # Lease expired without value, compute it anyway
+
+        try:
+            start = time.monotonic()
+            result = await f(*args, **kwargs)
+            if cache_write and not self.skip_cache_func(result):
+                await self._set_entry(key, result, time.monotonic() - start)
+                await self._tag_key(key, args, kwargs)
+            return result
+        finally:
+            if token is not None:
+                await self._release_lock(key, token)
+
+    def _tag_key_name(self, tag: str) -> str:
+        return self.cache.build_key(f'tag:{tag}')
+
+    async def _tag_key(self, key: str, args, kwargs):
+        """
+        Add the key to the set of each tag, the sets expire with their newest key
+        """
+        if not self.tags:
+            return
+        tags = self.tags(*args, **kwargs) if callable(self.tags) else self.tags
+        ttl = self.ttl + self.stale_ttl if isinstance(self.ttl, (int, float)) else None
+        try:
+            async with self.cache.client.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.sadd(self._tag_key_name(tag), self.cache.build_key(key))
+                    if ttl:
+                        pipe.expire(self._tag_key_name(tag), ttl)
+                await pipe.execute()
+        except Exception:  # noqa
+            logger.exception(f"Couldn't tag {key}, unexpected error")
+
+    @staticmethod
+    async def _invalidate_local(keys: list[str]):
+        # Not only when this function has L1, tags are shared by functions and the keys can be in the L1 of others.
+        # Every worker registers the same local caches, so without any here there is none to invalidate
+        if keys and cache_invalidation.has_local_caches:
+            await cache_invalidation.publish(*keys)
+
+    async def invalidate(self, *args, **kwargs):
+        key = self.get_cache_key(self._f, args, kwargs)
+
+        @_invalidation_retry
         async def _wrapper():
-            key = self.get_cache_key(self._f, args, kwargs)
             await self.cache.delete(key)
+            await self._invalidate_local([key])
 
         await _wrapper()
+
+    async def invalidate_many(self, *calls_kwargs: dict):
+        """
+        Invalidate the keys of many calls in one round trip, each dict are the kwargs of one call
+        """
+        keys = [self.get_cache_key(self._f, (), dict(kwargs)) for kwargs in calls_kwargs]
+
+        @_invalidation_retry
+        async def _wrapper():
+            if isinstance(self.cache, RedisBackend):
+                await self.cache.client.delete(*[self.cache.build_key(key) for key in keys])
+            else:
+                for key in keys:
+                    await self.cache.delete(key)
+            await self._invalidate_local(keys)
+
+        if keys:
+            await _wrapper()
+
+    async def invalidate_tags(self, *tags: str) -> dict:
+        """
+        Invalidate all the keys with any of the tags, of every function using the same cache backend and namespace.
+        Runs as one Lua script
+        :return: number of keys deleted and elapsed milliseconds
+        """
+        prefix = self.cache.build_key('')
+
+        @_invalidation_retry
+        async def _wrapper() -> list[str]:
+            deleted = await self.cache.client.eval(
+                _INVALIDATE_TAGS_SCRIPT, len(tags), *[self._tag_key_name(tag) for tag in tags]
+            )
+            keys = [key.decode()[len(prefix):] for key in deleted]
+            await self._invalidate_local(keys)
+            return keys
+
+        start = time.perf_counter()
+        keys = await _wrapper() if tags else []
+        report = {'tags': len(tags), 'keys': len(keys), 'elapsed_ms': (time.perf_counter() - start) * 1000}
+        logger.info('Cache tags invalidated', **report)
+        return report
@@ -0,0 +1,166 @@
+import importlib
+import math
+import pickle
+import zlib
+from typing import Any
+
+from aiocache.serializers import BaseSerializer
+from orjson import orjson
+from pydantic import BaseModel
+
+from core.utils import list_adapter
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used when not installed
+    zstandard = None
+
+# Format tags, first byte of every value. Values written by PickleSerializer start with 0x80 (pickle protocol >= 2)
+_TAG_ORJSON = b'J'
+_TAG_MODEL = b'M'  # pydantic model: class path, new line, model JSON
+_TAG_MODEL_LIST = b'L'  # list of pydantic models of the same class: class path, new line, list JSON
+_TAG_PICKLE = b'P'
+# Compressed value, the decompressed value starts with one of the tags above
+_TAG_ZLIB = b'Z'
+_TAG_ZSTD = b'S'
+_LEGACY_PICKLE = 0x80
+
+_MODEL_KEY = '__pydantic__'
+_MODEL_MARKER = b'"' + _MODEL_KEY.encode() + b'"'
+
+# Exact types orjson restores as they are
+_JSON_SCALARS = frozenset({str, int, bool, type(None)})
+
+_models: dict[str, type[BaseModel]] = {}
+
+
+def _model_path(cls: type[BaseModel]) -> str:
+    return f'{cls.__module__}:{cls.__qualname__}'
+
+
+def _keeps_types(value: Any) -> bool:
+    """
+    If a JSON round trip keeps the types of the value: dicts with str keys, lists, str, int, finite float, bool, None
+    and pydantic models. orjson coerces the rest (UUID and Enum to str, tuple to list, NaN to null, subclasses of
+    str, int, dict or list to the base type) or can't dump them
+    """
+    cls = value.__class__
+    if cls in _JSON_SCALARS:
+        return True
+    elif cls is float:
+        return math.isfinite(value)
+    elif cls is list:
+        return all(_keeps_types(_) for _ in value)
+    elif cls is dict:
+        return all(k.__class__ is str and _keeps_types(v) for k, v in value.items())
+    return isinstance(value, BaseModel)
+
+
+def _encode_model(value: Any) -> dict:
+    if isinstance(value, BaseModel):
+        return {_MODEL_KEY: _model_path(value.__class__), 'data': value.model_dump(mode='json', by_alias=True)}
+    # Not JSON type, stored with pickle to keep the type
+    raise TypeError
+
+
+def _model_class(path: str) -> type[BaseModel]:
+    if (cls := _models.get(path)) is None:
+        module_name, qualname = path.split(':')
+        cls = importlib.import_module(module_name)
+        for attribute in qualname.split('.'):
+            cls = getattr(cls, attribute)
+        if not (isinstance(cls, type) and issubclass(cls, BaseModel)):
+            raise TypeError(f'{path} is not a pydantic model')
+        _models[path] = cls
+    return cls
+
+
+def _decode_models(value: Any) -> Any:
+    if isinstance(value, dict):
+        if _MODEL_KEY in value:
+            return _model_class(value[_MODEL_KEY]).model_validate(value['data'])
+        return {k: _decode_models(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_decode_models(_) for _ in value]
+    return value
+
+
+class OrjsonSerializer(BaseSerializer):
+    """
+    Serialize to bytes with orjson. Pydantic models and lists of models are dumped by alias and validated by
+    pydantic-core, models inside other structures are restored too.
+    Any other value with a type JSON can't keep (tuples, sets, UUIDs, Enums, Decimals, datetimes, custom classes),
+    even nested, is stored with pickle to keep its types.
+
+    Values bigger than compress_threshold are compressed with zstd if "zstandard" is installed, zlib otherwise.
+    Every value starts with a format tag, so values written by PickleSerializer can still be read
+    """
+
+    DEFAULT_ENCODING = None
+
+    def __init__(self, *args, compress_threshold: int = 1024, compress_level: int = 3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    @staticmethod
+    def _dumps(value: Any) -> bytes:
+        if isinstance(value, BaseModel):
+            return _TAG_MODEL + _model_path(value.__class__).encode() + b'\n' + value.model_dump_json(by_alias=True).encode()
+
+        if isinstance(value, list) and value and isinstance(value[0], BaseModel):
+            cls = value[0].__class__
+            if all(_.__class__ is cls for _ in value):
+                return _TAG_MODEL_LIST + _model_path(cls).encode() + b'\n' + list_adapter(cls).dump_json(value, by_alias=True)
+
+        if not _keeps_types(value):
+            return _TAG_PICKLE + pickle.dumps(value)
+        try:
+            return _TAG_ORJSON + orjson.dumps(
+                value,
+                default=_encode_model,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+            )
+        except TypeError:
+            return _TAG_PICKLE + pickle.dumps(value)
+
+    def dumps(self, value: Any) -> bytes:
+        dumped = self._dumps(value)
+        if len(dumped) < self.compress_threshold:
+            return dumped
+        if zstandard is not None:
+            return _TAG_ZSTD + zstandard.ZstdCompressor(level=self.compress_level).compress(dumped)
+        return _TAG_ZLIB + zlib.compress(dumped, self.compress_level)
+
+    def loads(self, value: bytes | None) -> Any:
+        if value is None:
+            return None
+
+        if value[0] == _LEGACY_PICKLE:
+            return pickle.loads(value)  # noqa: S301
+
+        tag = value[:1]
+        if tag == _TAG_ZSTD:
+            if zstandard is None:
+                raise ValueError('Value compressed with zstd, "zstandard" package is not installed')
+            value = zstandard.ZstdDecompressor().decompress(value[1:])
+            tag = value[:1]
+        elif tag == _TAG_ZLIB:
+            value = zlib.decompress(value[1:])
+            tag = value[:1]
+
+        payload = value[1:]
+        if tag == _TAG_ORJSON:
+            result = orjson.loads(payload)
+            if _MODEL_MARKER in payload:
+                result = _decode_models(result)
+            return result
+        elif tag == _TAG_MODEL or tag == _TAG_MODEL_LIST:
+            path, payload = payload.split(b'\n', 1)
+            cls = _model_class(path.decode())
+            if tag == _TAG_MODEL:
+                return cls.model_validate_json(payload)
+            return list_adapter(cls).validate_json(payload)
+        elif tag == _TAG_PICKLE:
+            return pickle.loads(payload)  # noqa: S301
+        raise ValueError(f'Unknown cache value format: {tag!r}')
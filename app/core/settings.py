@@ -16,6 +16,13 @@ class Settings(BaseSettings):
     WEB_APP_DESCRIPTION: str = 'Description about what the microservice does'
     WEB_APP_VERSION: str = '1.0.0'
     OPENAPI_SERVER: str = ''
+    # Written by "python -m core.openapi", relative to the app folder
+    OPENAPI_PREBUILT_DIR: Path = Path('files/openapi')
+    # Identifies the deployed code, like the git commit, the prebuilt OpenAPI document is used only if built by the
+    # same one. The git commit of BASE_PATH by default
+    BUILD_ID: str = ''
+    # Used as namespace in Redis
+    SERVICE_NAME: str
 
     # To know the development where is executed
     ENVIRONMENT: Environment = Environment.DEV
@@ -25,12 +32,64 @@ class Settings(BaseSettings):
     # Path to the place main.py is
     BASE_PATH: Path = Path.cwd()
 
+    # Launcher, see server.py
+    SERVER_HOST: str = '0.0.0.0'
+    SERVER_PORT: int = 8000
+    # Worker processes, 0 means one per CPU
+    SERVER_WORKERS: int = 0
+    # Each worker binds its own socket with SO_REUSEPORT instead of sharing the one of the supervisor
+    SERVER_REUSE_PORT: bool = False
+    SERVER_BACKLOG: int = 2048
+    # Requests served by a worker before it's replaced, 0 disables it. A random jitter up to the second is added
+    SERVER_MAX_REQUESTS: int = 0
+    SERVER_MAX_REQUESTS_JITTER: int = 0
+    # In seconds, time for the in-flight requests to finish on SIGTERM
+    SERVER_GRACEFUL_TIMEOUT: int = 30
+    # In seconds, idle keep-alive connections are closed after it
+    SERVER_KEEP_ALIVE: int = 5
+
+    # Response compression, zstd and br only if "zstandard" and "brotli" are installed, see middleware.compression
+    COMPRESSION_ENABLED: bool = True
+    # In bytes, smaller bodies are sent as they are
+    COMPRESSION_MINIMUM_SIZE: int = 1024
+    # Media types compressed, empty means middleware.compression.DEFAULT_CONTENT_TYPES
+    COMPRESSION_CONTENT_TYPES: list[str] = []
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_QUALITY: int = 4
+    COMPRESSION_ZSTD_LEVEL: int = 3
+
     # Background tasks limit
     BACKGROUND_TASK_LIMIT: int = 0
+    # Background task classes, name: TaskClass params. Example:
+    # {"bulk": {"limit": 2, "priority": 1, "max_queue": 100}, "interactive": {"priority": 4}}
+    BACKGROUND_TASK_CLASSES: dict[str, dict[str, int | bool]] = {}
     # Resolution of 30 seconds
     BACKGROUND_TASK_GARBAGE_RESOLUTION: int = 30
     # In seconds, default to six hours
     BACKGROUND_TASK_PERSISTENCE_LIMIT: int = 6 * 60 * 60
+    # Workers of the process pool for ExecutionMode.PROCESS tasks of each server worker, 0 means the CPUs divided
+    # by the server workers
+    BACKGROUND_TASK_PROCESS_WORKERS: int = 0
+
+    # Redis
+    REDIS_ENDPOINT: str = '127.0.0.1'
+    REDIS_PORT: int = 6379
+    # In-process cache in front of Redis for internal_cached(local_cache=True), TTL in seconds
+    CACHE_L1_MAX_SIZE: int = 1024
+    CACHE_L1_TTL: int = 60
+    # In bytes, cached values bigger than this are compressed
+    CACHE_COMPRESS_THRESHOLD: int = 1024
+
+    # Distributed background tasks on Redis Streams, consumers are started on lifespan if enabled
+    DISTRIBUTED_TASKS_ENABLED: bool = False
+    # Tasks running at time in each worker
+    DISTRIBUTED_TASKS_CONCURRENCY: int = 10
+    # In seconds, default to six hours
+    DISTRIBUTED_TASKS_RESULT_TTL: int = 6 * 60 * 60
+    # In seconds, time without heartbeat before a task of a crashed consumer is delivered again
+    DISTRIBUTED_TASKS_CLAIM_IDLE_TIME: int = 60
+    # Deliveries before a task is set as failed
+    DISTRIBUTED_TASKS_MAX_DELIVERIES: int = 5
 
     # Only for selenium projects
     REMOTE_BROWSER: bool = False
@@ -41,6 +100,42 @@ class Settings(BaseSettings):
     DATABASE_HOST: str
     DATABASE_PORT: str
     DATABASE_DB: str
+    DATABASE_POOL_SIZE: int = 15
+    DATABASE_MAX_OVERFLOW: int = 5
+    # In seconds
+    DATABASE_POOL_RECYCLE: int = 300
+    # Compiled statements kept by SQLAlchemy, by engine. 0 disables the cache
+    DATABASE_QUERY_CACHE_SIZE: int = 500
+    # Prepared statements kept by asyncpg, by connection. 0 disables the cache
+    DATABASE_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+    # Adapt the connections used at time to the checkout wait and query time, see core.db_pool.AdaptiveLimiter
+    DATABASE_POOL_ADAPTIVE: bool = False
+    DATABASE_POOL_ADAPTIVE_MIN: int = 2
+    # In seconds, average checkout wait tolerated before allowing more connections
+    DATABASE_POOL_ADAPTIVE_TARGET_WAIT: float = 0.01
+    # Statements timing by fingerprint, see core.query_log
+    QUERY_LOG_ENABLED: bool = True
+    # In seconds, slower statements are logged and explained
+    QUERY_LOG_SLOW_THRESHOLD: float = 0.5
+    QUERY_LOG_MAX_STATEMENTS: int = 1000
+    QUERY_LOG_EXPLAIN: bool = True
+    # In seconds, time between EXPLAIN of the same statement
+    QUERY_LOG_EXPLAIN_INTERVAL: int = 300
+    # Read replicas, "host" or "host:port", used by read only sessions
+    DATABASE_REPLICA_HOSTS: list[str] = []
+    # "round_robin" or "least_connections"
+    DATABASE_REPLICA_BALANCING: str = 'round_robin'
+    # In seconds, replicas with more lag are not used
+    DATABASE_REPLICA_MAX_LAG: float = 10
+    DATABASE_REPLICA_LAG_CHECK_INTERVAL: int = 5
+    # Queries at time of all the fan_out calls of a worker, 0 means half of the pool (pool_size + max_overflow)
+    DATABASE_FAN_OUT_CONCURRENCY: int = 0
+
+    # Keyset pagination, the secret signs the cursors so it must be the same in all the workers.
+    # Only needed by the paginated endpoints, they fail without it
+    PAGINATION_SECRET: str = ''
+    PAGINATION_DEFAULT_LIMIT: int = 50
+    PAGINATION_MAX_LIMIT: int = 500
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+
+import structlog
+
+logger = structlog.get_logger('_api_')
+
+
+class StartupReport:
+    """
+    Time of each startup phase, from the creation of the report (import of main) to the end of lifespan startup
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        # Phase name: milliseconds, in execution order
+        self.phases: dict[str, float] = {}
+        self.total: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (time.perf_counter() - start) * 1000
+
+    def finish(self):
+        self.total = (time.perf_counter() - self.start) * 1000
+        logger.info('Startup report', **self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {
+            'phases_ms': {name: round(elapsed, 2) for name, elapsed in self.phases.items()},
+            'total_ms': round(self.total, 2) if self.total is not None else None,
+        }
+
+
+startup_report = StartupReport()
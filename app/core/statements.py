@@ -0,0 +1,111 @@
+from typing import Callable, Generic, TypeVar
+
+from sqlalchemy import Executable, event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+S = TypeVar('S', bound=Executable)
+
+_PREBUILT_OPTION = 'prebuilt_statement'
+
+
+class StatementCacheStats:
+    """
+    Hits of the SQLAlchemy compiled cache (query_cache_size) and of the asyncpg prepared statement cache
+    (prepared_statement_cache_size). Many misses after the warm-up mean a cache is too small
+    """
+
+    def __init__(self) -> None:
+        self.compiled_hits = 0
+        self.compiled_misses = 0
+        # Statements that can't be cached, like text() with literals or lambdas without tracking
+        self.compiled_uncached = 0
+        self.prepared_hits = 0
+        self.prepared_misses = 0
+
+    def record(self, compiled: bool | None, prepared: bool | None):
+        if compiled is None:
+            self.compiled_uncached += 1
+        elif compiled:
+            self.compiled_hits += 1
+        else:
+            self.compiled_misses += 1
+
+        if prepared is not None:
+            if prepared:
+                self.prepared_hits += 1
+            else:
+                self.prepared_misses += 1
+
+    def as_dict(self) -> dict:
+        return {
+            'compiled_hits': self.compiled_hits,
+            'compiled_misses': self.compiled_misses,
+            'compiled_uncached': self.compiled_uncached,
+            'prepared_hits': self.prepared_hits,
+            'prepared_misses': self.prepared_misses,
+        }
+
+
+# All the statements executed, and by prebuilt statement name
+statement_cache_stats = StatementCacheStats()
+prebuilt_statements_stats: dict[str, StatementCacheStats] = {}
+
+
+class PrebuiltStatement(Generic[S]):
+    """
+    Statement built once, on first use, and reused by every execution: the construct and its cache key are
+    not generated again, and the SQL string is the same so asyncpg reuses the prepared statement.
+    Values must be bind params, see "prebuilt"
+    """
+
+    def __init__(self, name: str, builder: Callable[[], S]) -> None:
+        self.name = name
+        self.builder = builder
+        self._statement: S | None = None
+
+    def __call__(self) -> S:
+        if self._statement is None:
+            self._statement = self.builder().execution_options(**{_PREBUILT_OPTION: self.name})
+            prebuilt_statements_stats.setdefault(self.name, StatementCacheStats())
+        return self._statement
+
+    @property
+    def stats(self) -> StatementCacheStats:
+        self()
+        return prebuilt_statements_stats[self.name]
+
+
+def prebuilt(builder: Callable[[], S]) -> PrebuiltStatement[S]:
+    """
+    Decorator to declare a reusable statement, with the values as bind params. Example:
+        @prebuilt
+        def user_by_id():
+            return select(UserModel).where(UserModel.id == bindparam('id'))
+
+        user = (await session.execute(user_by_id(), {'id': user_id})).scalar_one()
+    """
+    return PrebuiltStatement(f'{builder.__module__}:{builder.__qualname__}', builder)
+
+
+def _prepared_cache_hit(conn, statement: str) -> bool | None:
+    # LRU cache of the asyncpg adapted connection, None if disabled or other driver
+    cache = getattr(conn.connection.dbapi_connection, '_prepared_statement_cache', None)
+    if cache is None:
+        return None
+    return statement in cache
+
+
+# noinspection PyUnusedLocal
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    cache_hit = context.cache_hit
+    compiled = True if cache_hit is CACHE_HIT else False if cache_hit is CACHE_MISS else None
+    prepared = _prepared_cache_hit(conn, statement)
+
+    statement_cache_stats.record(compiled, prepared)
+    if (name := context.execution_options.get(_PREBUILT_OPTION)) is not None:
+        prebuilt_statements_stats[name].record(compiled, prepared)
+
+
+def instrument_statement_cache(engine: AsyncEngine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
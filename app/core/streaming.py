@@ -0,0 +1,98 @@
+from enum import StrEnum
+from typing import Any, AsyncIterator, Callable
+
+import structlog
+from orjson import orjson
+from pydantic import BaseModel
+from sqlalchemy import Executable, Row
+from sqlalchemy.orm import sessionmaker
+from starlette.responses import StreamingResponse
+
+from core.database import Session
+
+logger = structlog.get_logger('_api_')
+
+
+class StreamFormat(StrEnum):
+    NDJSON = 'ndjson'
+    JSON_ARRAY = 'json'
+
+
+_MEDIA_TYPES = {
+    StreamFormat.NDJSON: 'application/x-ndjson',
+    StreamFormat.JSON_ARRAY: 'application/json',
+}
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json')
+    raise TypeError
+
+
+def _row_to_dict(row: Any) -> Any:
+    if isinstance(row, Row):
+        return row._asdict()
+    return row
+
+
+async def _stream_rows(
+        statement: Executable,
+        fmt: StreamFormat,
+        converter: Callable[[Any], Any],
+        scalars: bool,
+        batch_size: int,
+        session_factory: sessionmaker,
+) -> AsyncIterator[bytes]:
+    # The session lives as long as the response, request dependencies are closed before the body is sent
+    async with session_factory() as session:
+        result = await session.stream(statement, execution_options={'yield_per': batch_size})
+        if scalars:
+            result = result.scalars()
+
+        first = True
+        try:
+            async for partition in result.partitions(batch_size):
+                lines = [orjson.dumps(converter(row), default=_default) for row in partition]
+                if fmt == StreamFormat.NDJSON:
+                    yield b'\n'.join(lines) + b'\n'
+                else:
+                    yield (b'[' if first else b',') + b','.join(lines)
+                first = False
+        except Exception:
+            # Status and headers are already sent, the body ends truncated (invalid JSON array)
+            logger.exception('Error streaming query result')
+            raise
+        if fmt == StreamFormat.JSON_ARRAY:
+            yield b'[]' if first else b']'
+
+
+def stream_query(
+        statement: Executable,
+        fmt: StreamFormat = StreamFormat.NDJSON,
+        converter: Callable[[Any], Any] | None = None,
+        scalars: bool = False,
+        batch_size: int = 1000,
+        session_factory: sessionmaker = Session,
+        **kwargs
+) -> StreamingResponse:
+    """
+    Response with the rows of a query, read with a server side cursor and serialized with orjson by batches,
+    so the memory doesn't depend on the size of the result.
+    Example:
+        return stream_query(select(UserModel), scalars=True, converter=lambda _: User.model_validate(_))
+
+    :param statement: select to stream
+    :param fmt: NDJSON, one row by line, or JSON array
+    :param converter: row to JSON serializable value or pydantic model, by default rows as dicts
+    :param scalars: stream the first column of each row, for ORM entities
+    :param batch_size: rows fetched from the cursor and sent at time
+    :param session_factory: Session or ReadOnlySession, a new session is opened for the stream
+    :param kwargs: StreamingResponse params, as status_code or headers
+    :return:
+    """
+    return StreamingResponse(
+        _stream_rows(statement, fmt, converter or _row_to_dict, scalars, batch_size, session_factory),
+        media_type=_MEDIA_TYPES[fmt],
+        **kwargs
+    )
@@ -1,12 +1,22 @@
 import asyncio
 import functools
+import os
 from datetime import datetime
-from typing import Any, Callable
+from typing import Any, Callable, Iterable
 from uuid import uuid4
 
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from orjson import orjson
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process can run on, fewer than os.cpu_count() with taskset or cpusets
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
 
 def generate_transaction_id():
@@ -51,7 +61,71 @@ def try_pack_object(s: Any) -> str:
         return s
 
 
-def pydantic_orjson_result(func):
+def negotiate_encoding(accept_encoding: str, available: Iterable[str]) -> str | None:
+    """
+    Content-Encoding for an Accept-Encoding header, like "gzip, br;q=0.8, zstd;q=0": the available encoding with the
+    highest q value, the first of available on a tie. "*" gives its q value to the encodings not listed, q=0 refuses
+    :param accept_encoding:
+    :param available: lower case, in order of preference
+    :return: None to send the body as it is
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = None
+        if quality is not None and (name := name.strip().lower()):
+            qualities[name] = quality
+
+    encoding, encoding_quality = None, 0.0
+    for name in available:
+        if (quality := qualities.get(name, qualities.get('*', 0.0))) > encoding_quality:
+            encoding, encoding_quality = name, quality
+    return encoding
+
+
+@functools.cache
+def list_adapter(cls: type[BaseModel]) -> TypeAdapter:
+    """
+    TypeAdapter(list[cls]), cached because building it is expensive
+    """
+    return TypeAdapter(list[cls])
+
+
+def _dump_model(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json')
+    raise TypeError(f'Type is not JSON serializable: {value.__class__.__name__}')
+
+
+def dump_json(value: Any) -> bytes:
+    """
+    Serialize a value to JSON bytes. Models and lists of models of the same class go straight to bytes with
+    pydantic-core, without intermediate dicts. Other values are dumped by orjson, with the models inside them
+    dumped by pydantic.
+    The JSON is not always the same as orjson of the model dicts: pydantic writes UTC datetimes with "Z" instead
+    of "+00:00", and the models and lists of models dumped by pydantic-core write big floats with exponent sign,
+    like 1e+20 instead of 1e20
+    """
+    if isinstance(value, BaseModel):
+        return value.__pydantic_serializer__.to_json(value)
+
+    if isinstance(value, list) and value and isinstance(value[0], BaseModel):
+        cls = value[0].__class__
+        if all(_.__class__ is cls for _ in value):
+            return list_adapter(cls).dump_json(value)
+
+    # Same options as ORJSONResponse
+    return orjson.dumps(value, default=_dump_model, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def pydantic_orjson_result(func=None, *, direct: bool = False):
     """
     Decorator that converts the result of an asynchronous function to an ORJSONResponse.
 
@@ -66,17 +140,25 @@ def pydantic_orjson_result(func):
     the list as an ORJSONResponse.
     3. For any other type of return value, it directly returns it as an ORJSONResponse.
 
+    With @pydantic_orjson_result(direct=True) the return value is serialized with dump_json instead, models go
+    straight to bytes with pydantic-core. It's faster but some values are written differently, see dump_json.
+
     Args:
         func (Callable): The asynchronous function to be wrapped.
+        direct (bool): serialize with dump_json.
 
     Returns:
-        Callable: The wrapped function which returns an ORJSONResponse.
+        Callable: The wrapped function which returns an ORJSONResponse, or a JSON Response if direct.
     """
+    if func is None:
+        return functools.partial(pydantic_orjson_result, direct=direct)
 
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         result = await func(*args, **kwargs)
-        if isinstance(result, BaseModel):
+        if direct:
+            return Response(dump_json(result), media_type='application/json')
+        elif isinstance(result, BaseModel):
             return ORJSONResponse(result.dict())
         elif isinstance(result, list):
             return ORJSONResponse([_.dict() for _ in result])
@@ -1,21 +1,26 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 import structlog
 import uvicorn
 from fastapi import FastAPI
-from fastapi.testclient import TestClient
-from starlette.middleware.exceptions import ExceptionMiddleware
 
-from core.basckground_tasks import background_tasks
+from core.basckground_tasks import background_tasks, process_pool, SYSTEM_TASK_CLASS
+from core.distributed_tasks import distributed_tasks
+from core.database import get_replica_router
 from core.logger_factory import logger_factory
+from core.openapi import use_prebuilt_openapi
+from core.redis_cache import cache_invalidation
 from core.settings import settings, Environment
-from middleware.middlewares import add_error_handlers, add_cors
+from core.startup import startup_report
+from middleware.middlewares import add_error_handlers, add_cors, add_compression, build_middleware_stack
 from routers.routers import add_routers
 
 logger = structlog.get_logger('_api_')
 
 # Configure logging
-logger_factory()
+with startup_report.phase('logging'):
+    logger_factory()
 
 # Configure FastAPI
 if settings.ENVIRONMENT != Environment.PROD:
@@ -24,55 +29,79 @@ if settings.ENVIRONMENT != Environment.PROD:
 
 @asynccontextmanager
 async def lifespan(lifespan_app: FastAPI):
-    # Force to build middleware stack for all apps and fill the
-    # "middleware_stack" property
-    client = TestClient(app)
-    # Main app
-    client.get('/docs?__lifespan__start__')
-    # Sub apps
-    # client.get('/admin/docs?__lifespan__start__')
-
-    # Hack ExceptionMiddleware to handle (500 or Exception) errors
-    # Override on startup because is the moment when the middleware_stack was built
-    # Breaking change, only works from 0.91.0 to upper: https://fastapi.tiangolo.com/release-notes/#0910
-    # noinspection PyUnresolvedReferences
-    generic_exception_handlers = {k: v for k, v in app.exception_handlers.items() if k == 500 or k == Exception}
-    if generic_exception_handlers:
-        _app = app.middleware_stack
-        while True:
-            if isinstance(_app, ExceptionMiddleware):
-                _app._exception_handlers.update(generic_exception_handlers)  # noqa
-                break
-            elif hasattr(_app, 'app'):
-                _app = _app.app
-            else:
-                break
+    # Built on startup, not on the first request, to patch the exception handlers
+    with startup_report.phase('middleware_stack'):
+        build_middleware_stack(lifespan_app)
+
+    # Start process pool for CPU bound background tasks
+    with startup_report.phase('process_pool'):
+        process_pool.start()
 
     # Start task garbage collector
-    await background_tasks.add_fire_and_forget_task(background_tasks.garbage_collector)
+    with startup_report.phase('background_tasks'):
+        await background_tasks.add_fire_and_forget_task(
+            background_tasks.garbage_collector, task_class=SYSTEM_TASK_CLASS
+        )
+
+    # Start checking read replicas lag
+    if settings.DATABASE_REPLICA_HOSTS:
+        with startup_report.phase('replica_monitor'):
+            await background_tasks.add_fire_and_forget_task(
+                get_replica_router().lag_monitor, task_class=SYSTEM_TASK_CLASS
+            )
+
+    # Start consuming distributed tasks
+    if settings.DISTRIBUTED_TASKS_ENABLED:
+        with startup_report.phase('distributed_tasks'):
+            await distributed_tasks.start()
+
+    # Listen invalidations for local caches
+    with startup_report.phase('cache_invalidation'):
+        await cache_invalidation.start()
+
+    startup_report.finish()
 
     yield
 
-app = FastAPI(
-    title=settings.WEB_APP_TITLE,
-    description=settings.WEB_APP_DESCRIPTION,
-    version=settings.WEB_APP_VERSION,
-    servers=[
-        {'url': settings.OPENAPI_SERVER, 'description': f'{settings.ENVIRONMENT} environment'},
-    ] if settings.OPENAPI_SERVER else None,
-    lifespan=lifespan,
-    root_path=f'/endpoint-prefix' if not settings.LOCAL else None
-)
+    await cache_invalidation.stop()
+
+    if settings.DISTRIBUTED_TASKS_ENABLED:
+        await distributed_tasks.stop()
+
+    # Cancel pending CPU bound tasks and stop the workers, waiting for the running ones in a thread to not block
+    # the event loop
+    await asyncio.to_thread(process_pool.shutdown)
+
+
+with startup_report.phase('app'):
+    app = FastAPI(
+        title=settings.WEB_APP_TITLE,
+        description=settings.WEB_APP_DESCRIPTION,
+        version=settings.WEB_APP_VERSION,
+        servers=[
+            {'url': settings.OPENAPI_SERVER, 'description': f'{settings.ENVIRONMENT} environment'},
+        ] if settings.OPENAPI_SERVER else None,
+        lifespan=lifespan,
+        root_path=f'/endpoint-prefix' if not settings.LOCAL else None
+    )
+
+    # Configure HTTP Starlette server
+    add_error_handlers(app)
+
+    # Cors configuration
+    add_cors(app)
 
-# Configure HTTP Starlette server
-add_error_handlers(app)
+    # Compress responses, outside CORS
+    add_compression(app)
 
-# Cors configuration
-add_cors(app)
+    # Configure routes
+    add_routers(app)
 
-# Configure routes
-add_routers(app)
+with startup_report.phase('openapi'):
+    # Serve the document built by "python -m core.openapi", if it's from these routes and settings
+    use_prebuilt_openapi(app)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Single process for development, see server.py for production
+    uvicorn.run(app, host=settings.SERVER_HOST, port=settings.SERVER_PORT)
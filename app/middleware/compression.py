@@ -0,0 +1,205 @@
+import zlib
+from typing import Callable
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.utils import negotiate_encoding
+
+try:
+    import brotli
+except ImportError:  # optional, br is not offered when not installed
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # optional, zstd is not offered when not installed
+    zstandard = None
+
+DEFAULT_CONTENT_TYPES = (
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+)
+# In bytes, bigger bodies are compressed in a thread so they don't block the event loop
+_THREAD_THRESHOLD = 256 * 1024
+
+# Incremental compressor: compress and flush a chunk, and finish the stream
+StreamCompressor = tuple[Callable[[bytes], bytes], Callable[[], bytes]]
+
+
+class Encoder:
+    def __init__(self, compress: Callable[[bytes], bytes], stream: Callable[[], StreamCompressor]) -> None:
+        """
+        :param compress: whole body
+        :param stream: new StreamCompressor, each chunk is flushed so it reaches the client without waiting
+        """
+        self.compress = compress
+        self.stream = stream
+
+
+def _gzip_stream(level: int) -> StreamCompressor:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _brotli_stream(quality: int) -> StreamCompressor:
+    compressor = brotli.Compressor(quality=quality)
+    return lambda chunk: compressor.process(chunk) + compressor.flush(), compressor.finish
+
+
+def _zstd_stream(level: int) -> StreamCompressor:
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (
+        lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+
+def encoders(gzip_level: int = 6, brotli_quality: int = 4, zstd_level: int = 3) -> dict[str, Encoder]:
+    """
+    :return: available encoders by Content-Encoding, in order of preference
+    """
+    available = {}
+    if zstandard is not None:
+        available['zstd'] = Encoder(
+            lambda body: zstandard.ZstdCompressor(level=zstd_level).compress(body), lambda: _zstd_stream(zstd_level)
+        )
+    if brotli is not None:
+        available['br'] = Encoder(
+            lambda body: brotli.compress(body, quality=brotli_quality), lambda: _brotli_stream(brotli_quality)
+        )
+    available['gzip'] = Encoder(
+        lambda body: zlib.compress(body, gzip_level, wbits=31), lambda: _gzip_stream(gzip_level)
+    )
+    return available
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with zstd, brotli or gzip, the one the client prefers (Accept-Encoding), in that order on a tie.
+    zstd and brotli are offered only if "zstandard" and "brotli" are installed.
+    Responses are sent as they are if smaller than minimum_size, of a content type not in content_types, already
+    compressed (Content-Encoding), with "Cache-Control: no-transform", or bigger once compressed.
+    Streaming responses are compressed chunk by chunk
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            minimum_size: int = 1024,
+            content_types: tuple[str, ...] = DEFAULT_CONTENT_TYPES,
+            gzip_level: int = 6,
+            brotli_quality: int = 4,
+            zstd_level: int = 3,
+    ) -> None:
+        """
+        :param app:
+        :param minimum_size: in bytes, of the body or of the Content-Length of streaming responses
+        :param content_types: media types, without parameters
+        :param gzip_level: 1 to 9
+        :param brotli_quality: 0 to 11
+        :param zstd_level: 1 to 22
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.content_types = frozenset(content_types)
+        self.encoders = encoders(gzip_level, brotli_quality, zstd_level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http':
+            name = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''), self.encoders)
+            if name is not None:
+                responder = _CompressionResponder(self, name, self.encoders[name], send)
+                await self.app(scope, receive, responder.send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, name: str, encoder: Encoder, send: Send) -> None:
+        self.middleware = middleware
+        self.name = name
+        self.encoder = encoder
+        self._send = send
+        # Held until the first body message, to know the body size
+        self.start_message: Message | None = None
+        # Set while compressing a streaming response
+        self.stream: StreamCompressor | None = None
+
+    def _compressible(self, headers: MutableHeaders, status: int, body: bytes, more_body: bool) -> bool:
+        if status < 200 or status in (204, 304) or 'content-encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('cache-control', ''):
+            return False
+        if headers.get('content-type', '').split(';')[0].strip().lower() not in self.middleware.content_types:
+            return False
+        if more_body:
+            content_length = headers.get('content-length')
+            return content_length is None or int(content_length) >= self.middleware.minimum_size
+        return len(body) >= self.middleware.minimum_size
+
+    def _set_headers(self, headers: MutableHeaders):
+        headers['Content-Encoding'] = self.name
+        headers.add_vary_header('Accept-Encoding')
+        # The compressed body is other representation, a strong ETag must not match the uncompressed one
+        if (etag := headers.get('etag')) and not etag.startswith('W/'):
+            headers['ETag'] = f'W/{etag}'
+
+    async def _compress(self, body: bytes) -> bytes:
+        if len(body) >= _THREAD_THRESHOLD:
+            return await run_in_threadpool(self.encoder.compress, body)
+        return self.encoder.compress(body)
+
+    async def send(self, message: Message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body':
+            # Like http.response.pathsend, the body is not seen so it's sent as it is
+            if self.start_message is not None:
+                start_message, self.start_message = self.start_message, None
+                await self._send(start_message)
+            await self._send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start_message['headers'])
+            if not self._compressible(headers, start_message['status'], body, more_body):
+                await self._send(start_message)
+            elif more_body:
+                self.stream = self.encoder.stream()
+                self._set_headers(headers)
+                if 'content-length' in headers:
+                    del headers['content-length']
+                await self._send(start_message)
+            else:
+                compressed = await self._compress(body)
+                if len(compressed) < len(body):
+                    self._set_headers(headers)
+                    headers['Content-Length'] = str(len(compressed))
+                    message = {'type': 'http.response.body', 'body': compressed}
+                await self._send(start_message)
+                await self._send(message)
+                return
+
+        if self.stream is None:
+            await self._send(message)
+            return
+
+        process, finish = self.stream
+        chunk = process(body) if body else b''
+        if not more_body:
+            chunk += finish()
+        await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
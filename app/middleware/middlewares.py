@@ -1,6 +1,12 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.applications import Starlette
+from starlette.middleware.exceptions import ExceptionMiddleware
+from starlette.routing import Mount
 
+from core.settings import settings
+
+from .compression import CompressionMiddleware, DEFAULT_CONTENT_TYPES
 from .error_handlers.api import add_handler as api_add_handler
 from .error_handlers.pydantic_error import pydantic_add_handler
 
@@ -20,3 +26,44 @@ def add_cors(app: FastAPI):
         allow_methods=["*"],
         allow_headers=["*"],
     )
+
+
+def add_compression(app: FastAPI):
+    if not settings.COMPRESSION_ENABLED:
+        return
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+        content_types=tuple(settings.COMPRESSION_CONTENT_TYPES) or DEFAULT_CONTENT_TYPES,
+        gzip_level=settings.COMPRESSION_GZIP_LEVEL,
+        brotli_quality=settings.COMPRESSION_BROTLI_QUALITY,
+        zstd_level=settings.COMPRESSION_ZSTD_LEVEL,
+    )
+
+
+def build_middleware_stack(app: Starlette) -> None:
+    """
+    Build the middleware stack of the app and its mounted sub apps, instead of waiting for the first request,
+    and move the generic handlers (500 or Exception) to ExceptionMiddleware.
+    Starlette gives them to ServerErrorMiddleware, outside CORS and the other middlewares, so the error response
+    would miss their headers
+    Breaking change, only works from 0.91.0 to upper: https://fastapi.tiangolo.com/release-notes/#0910
+    """
+    if app.middleware_stack is None:
+        app.middleware_stack = app.build_middleware_stack()
+
+    generic_exception_handlers = {k: v for k, v in app.exception_handlers.items() if k == 500 or k == Exception}
+    if generic_exception_handlers:
+        _app = app.middleware_stack
+        while True:
+            if isinstance(_app, ExceptionMiddleware):
+                _app._exception_handlers.update(generic_exception_handlers)  # noqa
+                break
+            elif hasattr(_app, 'app'):
+                _app = _app.app
+            else:
+                break
+
+    for route in app.routes:
+        if isinstance(route, Mount) and isinstance(route.app, Starlette):
+            build_middleware_stack(route.app)
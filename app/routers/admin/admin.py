@@ -0,0 +1,50 @@
+from typing import Literal
+
+from fastapi import APIRouter
+from starlette.status import HTTP_204_NO_CONTENT
+
+from core.database import get_engine, get_replica_engines, session_usage
+from core.query_log import query_log
+from core.startup import startup_report
+from core.statements import statement_cache_stats, prebuilt_statements_stats
+from core.utils import pydantic_orjson_result
+
+router = APIRouter()
+
+
+@router.get("/slow-queries/")
+@pydantic_orjson_result
+async def slow_queries(
+        limit: int = 20,
+        order_by: Literal['total_time', 'max_time', 'calls', 'slow_calls'] = 'total_time'
+) -> dict:
+    return {
+        'slow_threshold': query_log.slow_threshold,
+        'dropped': query_log.dropped,
+        'statements': query_log.top(limit, order_by),
+    }
+
+
+@router.delete("/slow-queries/", status_code=HTTP_204_NO_CONTENT)
+async def reset_slow_queries():
+    query_log.reset()
+
+
+@router.get("/startup/")
+@pydantic_orjson_result
+async def startup() -> dict:
+    return startup_report.as_dict()
+
+
+@router.get("/db-pool/")
+@pydantic_orjson_result
+async def db_pool_metrics() -> dict:
+    return {
+        'primary': get_engine().pool.status_dict(),
+        'replicas': {
+            f'{engine.url.host}:{engine.url.port}': engine.pool.status_dict() for engine in get_replica_engines()
+        },
+        'sessions': session_usage.as_dict(),
+        'statement_cache': statement_cache_stats.as_dict(),
+        'prebuilt_statements': {name: stats.as_dict() for name, stats in prebuilt_statements_stats.items()},
+    }
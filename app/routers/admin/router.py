@@ -0,0 +1,10 @@
+from fastapi import FastAPI, APIRouter, Depends
+
+from routers.common.depends import security_bearer_cognito
+from .admin import router as admin_routes_router
+
+
+def include_router(app: FastAPI):
+    api_router = APIRouter(dependencies=[Depends(security_bearer_cognito)])
+    api_router.include_router(admin_routes_router, prefix='', tags=['Admin'])
+    app.include_router(api_router, prefix='/admin')
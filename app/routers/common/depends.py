@@ -7,7 +7,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.requests import Request
 from starlette.status import HTTP_403_FORBIDDEN
 
-from core.database import Session
+from core.database import Session, ReadOnlySession, session_usage
 from middleware.fastapi.security.bearer_cognito import JWTBearer
 from schemas.entity_sample.schema_example import User
 
@@ -20,21 +20,40 @@ security_bearer_cognito = JWTBearer()
 
 async def get_db() -> AsyncSession:
     """
+    The session is lazy, a connection is checked out from the pool (and pre-pinged) only on the first statement,
+    so declaring it in a route that doesn't query costs nothing. Sessions that never queried are counted in
+    "session_usage.untouched"
+
     WARNING: not use this with "asyncio.gather" without wrap with asynccontextmanager
     or will get these errors:
         https://docs.sqlalchemy.org/en/20/errors.html#error-isce
         https://github.com/sqlalchemy/sqlalchemy/discussions/9609
 
-    The correct for to use with that is:
-        internal_db = asynccontextmanager(get_internal_db)
-        async with internal_db() as session:
-            await method(session)
+    To run independent queries in parallel use "core.database.fan_out", each query gets its own session:
+        user, subscriptions = await fan_out(get_user, get_subscriptions)
 
     :return:
     """
     async_session = Session
     async with async_session() as session:
-        yield session
+        try:
+            yield session
+        finally:
+            session_usage.record(session)
+
+
+async def get_read_only_db() -> AsyncSession:
+    """
+    Same as get_db, but reads go to a replica until the session writes, then everything goes to the primary.
+    Use it in routes that can read data some seconds old
+    :return:
+    """
+    async_session = ReadOnlySession
+    async with async_session() as session:
+        try:
+            yield session
+        finally:
+            session_usage.record(session)
 
 
 def fake_decode_token(token):
@@ -2,9 +2,15 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends
 from fastapi.security import HTTPBasicCredentials
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from routers.common.depends import get_current_user, get_db
+from core.pagination import PageParams, paginate
+from core.streaming import stream_query, StreamFormat
+from core.utils import pydantic_orjson_result
+from models.user import UserModel
+from routers.common.depends import get_current_user, get_db, get_read_only_db
+from schemas.entity_sample.schema_example import User
 
 router = APIRouter()
 
@@ -18,3 +24,25 @@ async def read_items(
         "logged user": credentials.username,
         "db": "db is connected"
     }
+
+
+@router.get("/users/stream/")
+async def stream_users(
+        credentials: Annotated[HTTPBasicCredentials, Depends(get_current_user)],  # noqa
+        fmt: StreamFormat = StreamFormat.NDJSON
+):
+    # No get_db, the stream opens its own session
+    return stream_query(select(UserModel.id, UserModel.name, UserModel.fullname), fmt)
+
+
+@router.get("/users/")
+@pydantic_orjson_result
+async def list_users(
+        credentials: Annotated[HTTPBasicCredentials, Depends(get_current_user)],  # noqa
+        page: Annotated[PageParams, Depends()],
+        db: Annotated[AsyncSession, Depends(get_read_only_db)]
+):
+    return await paginate(
+        db, select(UserModel), [UserModel.id], page,
+        converter=lambda _: User(username=_.name, full_name=_.fullname, disabled=_.disabled)
+    )
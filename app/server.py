@@ -0,0 +1,200 @@
+"""
+Launcher for production, configured by the SERVER_* settings:
+    python server.py
+"""
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from importlib.util import find_spec
+from multiprocessing.process import BaseProcess
+
+import structlog
+import uvicorn
+
+from core.logger_factory import logger_factory
+from core.settings import settings
+from core.utils import available_cpus
+
+logger = structlog.get_logger('_api_')
+
+APP = 'main:app'
+# In seconds, a worker exiting with error before this is a startup failure, it's not restarted
+_STARTUP_FAILURE_TIME = 5
+# In seconds, time between checks of the workers
+_CHECK_INTERVAL = 0.5
+
+
+def worker_count() -> int:
+    if settings.SERVER_WORKERS > 0:
+        return settings.SERVER_WORKERS
+    return available_cpus()
+
+
+def bind_socket(reuse_port: bool = False) -> socket.socket:
+    """
+    :param reuse_port: SO_REUSEPORT, every worker binds its own socket to the same port
+    """
+    family = socket.AF_INET6 if ':' in settings.SERVER_HOST else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((settings.SERVER_HOST, settings.SERVER_PORT))
+    sock.listen(settings.SERVER_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _config() -> uvicorn.Config:
+    max_requests = settings.SERVER_MAX_REQUESTS
+    if max_requests and settings.SERVER_MAX_REQUESTS_JITTER:
+        # Workers started together are not recycled together
+        max_requests += random.randint(0, settings.SERVER_MAX_REQUESTS_JITTER)
+
+    return uvicorn.Config(
+        APP,
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        # uvloop and httptools, asyncio and h11 where not available
+        loop='auto',
+        http='auto',
+        backlog=settings.SERVER_BACKLOG,
+        timeout_keep_alive=settings.SERVER_KEEP_ALIVE,
+        # The server exits after these requests, and the supervisor starts other worker
+        limit_max_requests=max_requests or None,
+        # In-flight requests have this time to finish on SIGTERM
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT,
+    )
+
+
+def _serve(sock: socket.socket | None):
+    """
+    Worker process entry point
+    :param sock: listening socket shared by all the workers, None to bind one with SO_REUSEPORT
+    """
+    if sock is None:
+        sock = bind_socket(reuse_port=True)
+    uvicorn.Server(_config()).run(sockets=[sock])
+
+
+class Supervisor:
+    """
+    Pre-forked uvicorn workers:
+    - Without reuse_port the supervisor binds the socket and the workers accept from it, the connections waiting
+      in the backlog are not lost when a worker is recycled
+    - With reuse_port each worker binds its own socket and the kernel balances the connections between them,
+      more evenly under load, but the connections waiting in the backlog of a stopping worker are reset
+    Workers that exit (max requests reached or crashed) are started again. On SIGTERM or SIGINT the workers drain
+    their in-flight requests, and are killed after the graceful timeout
+    """
+
+    def __init__(self, workers: int, reuse_port: bool = False) -> None:
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.restarts = 0
+        self._processes: dict[int, tuple[BaseProcess, float]] = {}
+        # A worker imports the app from scratch, like uvicorn workers
+        self._context = multiprocessing.get_context('spawn')
+        self._socket: socket.socket | None = None
+        self._should_exit = threading.Event()
+        self._exit_code = 0
+
+    def _start(self, slot: int):
+        process = self._context.Process(target=_serve, args=(self._socket,), name=f'worker-{slot}')
+        process.start()
+        self._processes[slot] = process, time.monotonic()
+
+    # noinspection PyUnusedLocal
+    def _handle_exit(self, signum, frame):
+        self._should_exit.set()
+
+    def _check(self):
+        for slot, (process, started_at) in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            if process.exitcode and time.monotonic() - started_at < _STARTUP_FAILURE_TIME:
+                logger.error(f'Worker {process.pid} failed on startup with exit code {process.exitcode}')
+                self._exit_code = 1
+                self._should_exit.set()
+                return
+
+            if process.exitcode:
+                logger.warning(f'Worker {process.pid} exited with code {process.exitcode}, restarting')
+            else:
+                logger.info(f'Worker {process.pid} recycled')
+            self.restarts += 1
+            self._start(slot)
+
+    def _stop(self):
+        for process, _ in self._processes.values():
+            if process.is_alive():
+                # uvicorn stops accepting and waits for the in-flight requests
+                process.terminate()
+
+        deadline = time.monotonic() + settings.SERVER_GRACEFUL_TIMEOUT + _STARTUP_FAILURE_TIME
+        for process, _ in self._processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f'Worker {process.pid} did not stop in time, killing it')
+                process.kill()
+                process.join()
+
+        if self._socket is not None:
+            self._socket.close()
+
+    def run(self) -> int:
+        """
+        :return: exit code
+        """
+        if not self.reuse_port:
+            self._socket = bind_socket()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_exit)
+
+        for slot in range(self.workers):
+            self._start(slot)
+        logger.info(
+            f'Supervisor {os.getpid()} started {self.workers} workers on '
+            f'{settings.SERVER_HOST}:{settings.SERVER_PORT}, {"SO_REUSEPORT" if self.reuse_port else "shared socket"}'
+        )
+
+        while not self._should_exit.wait(_CHECK_INTERVAL):
+            self._check()
+
+        logger.info(f'Supervisor {os.getpid()} stopping {len(self._processes)} workers')
+        self._stop()
+        return self._exit_code
+
+
+def serve() -> int:
+    """
+    Run the app with SERVER_WORKERS processes, or in this process if there is one worker that is never recycled
+    :return: exit code
+    """
+    logger_factory()
+    workers = worker_count()
+    # Inherited by the spawned workers, they divide the CPUs of their process pools by it
+    os.environ['SERVER_WORKERS'] = str(workers)
+    logger.info(
+        f'Serving {APP} with {workers} workers, '
+        f'loop {"uvloop" if find_spec("uvloop") else "asyncio"}, http {"httptools" if find_spec("httptools") else "h11"}'
+    )
+
+    if workers == 1 and not settings.SERVER_MAX_REQUESTS:
+        uvicorn.Server(_config()).run()
+        return 0
+
+    reuse_port = settings.SERVER_REUSE_PORT
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning('SO_REUSEPORT is not available, the workers share the socket')
+        reuse_port = False
+    return Supervisor(workers, reuse_port).run()
+
+
+if __name__ == '__main__':
+    sys.exit(serve())
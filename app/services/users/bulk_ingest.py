@@ -0,0 +1,135 @@
+import time
+from enum import StrEnum
+from typing import AsyncIterable, AsyncIterator
+
+import structlog
+from sqlalchemy import Table
+
+from core.database import get_engine
+from models.user import UserModel
+from schemas.entity_sample.schema_example import User
+
+logger = structlog.get_logger('_api_')
+
+# UserModel columns filled from the User schema, in record order
+_COLUMNS = ('name', 'fullname', 'disabled')
+
+
+class InvalidConflictColumns(ValueError):
+    pass
+
+
+class IngestMethod(StrEnum):
+    # COPY protocol, fastest
+    COPY = 'copy'
+    # Prepared INSERT executed for all the rows of a batch
+    EXECUTEMANY = 'executemany'
+
+
+def _record(user: User) -> tuple:
+    return user.username, user.full_name, user.disabled
+
+
+async def _batches(users: AsyncIterable[User], batch_size: int) -> AsyncIterator[list[tuple]]:
+    batch = []
+    async for user in users:
+        batch.append(_record(user))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Statements:
+    """
+    SQL of a table, identifiers quoted by the dialect
+    """
+
+    def __init__(self, table: Table, conflict_columns: tuple[str, ...] | None) -> None:
+        preparer = get_engine().dialect.identifier_preparer
+        self.table = preparer.format_table(table)
+        self.schema = table.schema
+        self.name = table.name
+        columns = ', '.join(preparer.quote(_) for _ in _COLUMNS)
+        placeholders = ', '.join(f'${i + 1}' for i in range(len(_COLUMNS)))
+        self.insert = f'INSERT INTO {self.table} ({columns}) VALUES ({placeholders})'
+        if not conflict_columns:
+            return
+
+        conflict = ', '.join(preparer.quote(_) for _ in conflict_columns)
+        updates = ', '.join(
+            f'{preparer.quote(_)} = EXCLUDED.{preparer.quote(_)}' for _ in _COLUMNS if _ not in conflict_columns
+        )
+        self.on_conflict = f' ON CONFLICT ({conflict}) DO UPDATE SET {updates}' if updates else \
+            f' ON CONFLICT ({conflict}) DO NOTHING'
+
+        # Staging table for COPY + upsert, dropped on commit
+        self.staging = '_ingest_staging'
+        self.create_staging = f'CREATE TEMP TABLE {self.staging} ON COMMIT DROP AS ' \
+                              f'SELECT {columns} FROM {self.table} WITH NO DATA'
+        # A key repeated in one batch can't be updated twice by the same statement, the last row wins
+        self.merge_staging = f'INSERT INTO {self.table} ({columns}) ' \
+                             f'SELECT DISTINCT ON ({conflict}) {columns} FROM {self.staging} ' \
+                             f'ORDER BY {conflict}, ctid DESC' + self.on_conflict
+
+
+async def ingest_users(
+        users: AsyncIterable[User],
+        batch_size: int = 5000,
+        method: IngestMethod = IngestMethod.COPY,
+        upsert: bool = False,
+        conflict_columns: tuple[str, ...] | None = None,
+        table: Table = UserModel.__table__,
+) -> dict:
+    """
+    Insert users by batches on a raw asyncpg connection of the internal DB, each batch in its own transaction,
+    so a failure keeps the previous batches.
+    Rows by second are logged and returned.
+
+    :param users: validated users, can be a generator reading a file or other source
+    :param batch_size: rows by transaction
+    :param method: COPY or executemany
+    :param upsert: update the existing rows with the same conflict columns
+    :param conflict_columns: columns of a unique index or constraint of the table, required on upsert
+    :param table: UserModel table by default
+    :return: {"rows", "batches", "elapsed", "rows_per_second"}
+    """
+    if upsert and not conflict_columns:
+        raise InvalidConflictColumns('conflict_columns is required on upsert')
+    if upsert and not set(conflict_columns) <= set(_COLUMNS):
+        raise InvalidConflictColumns(f'conflict_columns must be in {_COLUMNS}, as the id is generated')
+    statements = _Statements(table, conflict_columns if upsert else None)
+    rows = batches = 0
+    start = time.perf_counter()
+
+    async with get_engine().connect() as connection:
+        driver_connection = (await connection.get_raw_connection()).driver_connection
+        async for batch in _batches(users, batch_size):
+            async with driver_connection.transaction():
+                if method == IngestMethod.EXECUTEMANY:
+                    await driver_connection.executemany(
+                        statements.insert + (statements.on_conflict if upsert else ''), batch
+                    )
+                elif upsert:
+                    await driver_connection.execute(statements.create_staging)
+                    await driver_connection.copy_records_to_table(
+                        statements.staging, records=batch, columns=_COLUMNS
+                    )
+                    await driver_connection.execute(statements.merge_staging)
+                else:
+                    await driver_connection.copy_records_to_table(
+                        statements.name, records=batch, columns=_COLUMNS, schema_name=statements.schema
+                    )
+            rows += len(batch)
+            batches += 1
+
+    elapsed = time.perf_counter() - start
+    report = {
+        'rows': rows,
+        'batches': batches,
+        'elapsed': elapsed,
+        'rows_per_second': rows / elapsed if elapsed else 0.0,
+    }
+    logger.info(f'Users ingested: {report}')
+    return report
@@ -4,3 +4,11 @@ import os
 def pytest_configure(config):
     # Set only necessary or env vars without default value. Example:
     os.environ['SERVICE_NAME'] = 'test'
+    for name, value in {
+        'DATABASE_USERNAME': 'test',
+        'DATABASE_PASSWORD': 'test',
+        'DATABASE_HOST': 'localhost',
+        'DATABASE_PORT': '5432',
+        'DATABASE_DB': 'test',
+    }.items():
+        os.environ.setdefault(name, value)
@@ -0,0 +1,319 @@
+import asyncio
+import math
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from core import basckground_tasks
+from core.basckground_tasks import (
+    BackgroundTasks, ExecutionMode, NotPicklableTask, ProcessPool, TaskClass, TaskClassBusy, TaskQueueFull,
+    SYSTEM_TASK_CLASS
+)
+
+
+async def _job(events: list, name: str, release: asyncio.Event | None = None):
+    events.append(('start', name))
+    if release is not None:
+        await release.wait()
+    await asyncio.sleep(0)
+    events.append(('end', name))
+    return name
+
+
+def _max_running(events: list, names: set | None = None) -> int:
+    running = peak = 0
+    for event, name in events:
+        if names is not None and name not in names:
+            continue
+        running += 1 if event == 'start' else -1
+        peak = max(peak, running)
+    return peak
+
+
+def test_class_limit():
+    async def run():
+        events = []
+        tasks = BackgroundTasks(task_classes=[TaskClass('limited', limit=2)])
+        for i in range(6):
+            await tasks.add_task(f't{i}', _job, events, f't{i}', task_class='limited')
+        await asyncio.gather(*(tasks._tasks[f't{i}'][0] for i in range(6)))
+        return events
+
+    events = asyncio.run(run())
+    assert _max_running(events) == 2
+    assert len(events) == 12
+
+
+def test_priority_share_of_global_limit():
+    async def run():
+        events = []
+        tasks = BackgroundTasks(1, [TaskClass('high', priority=2), TaskClass('low', priority=1)])
+        release = asyncio.Event()
+        # Holds the only slot while the others are queued
+        await tasks.add_task('blocker', _job, events, 'blocker', release)
+        for i in range(6):
+            await tasks.add_task(f'low{i}', _job, events, f'low{i}', task_class='low')
+            await tasks.add_task(f'high{i}', _job, events, f'high{i}', task_class='high')
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*(task for task, _ in list(tasks._tasks.values())))
+        return [name for event, name in events if event == 'start' and name != 'blocker']
+
+    order = asyncio.run(run())
+    # While both classes wait, high gets two slots for each one of low
+    first = order[:6]
+    assert sum(_.startswith('high') for _ in first) == 4
+    assert sum(_.startswith('low') for _ in first) == 2
+
+
+def test_system_class_does_not_use_global_slots():
+    async def run():
+        events = []
+        tasks = BackgroundTasks(1)
+        release = asyncio.Event()
+        await tasks.add_task('blocker', _job, events, 'blocker', release)
+        system = await tasks.add_task('system', _job, events, 'system', task_class=SYSTEM_TASK_CLASS)
+        result = await asyncio.wait_for(system, 1)
+        release.set()
+        return result
+
+    assert asyncio.run(run()) == 'system'
+
+
+def test_max_queue():
+    async def run():
+        events = []
+        tasks = BackgroundTasks(task_classes=[TaskClass('bounded', limit=1, max_queue=1)])
+        release = asyncio.Event()
+        await tasks.add_task('running', _job, events, 'running', release, task_class='bounded')
+        await tasks.add_task('waiting', _job, events, 'waiting', task_class='bounded')
+        with pytest.raises(TaskQueueFull):
+            await tasks.add_task('rejected', _job, events, 'rejected', task_class='bounded')
+        release.set()
+        await asyncio.gather(tasks._tasks['running'][0], tasks._tasks['waiting'][0])
+
+    asyncio.run(run())
+
+
+def test_replace_busy_task_class():
+    async def run():
+        events = []
+        tasks = BackgroundTasks(task_classes=[TaskClass('replaced', limit=1)])
+        release = asyncio.Event()
+        await tasks.add_task('running', _job, events, 'running', release, task_class='replaced')
+        await tasks.add_task('waiting', _job, events, 'waiting', task_class='replaced')
+        with pytest.raises(TaskClassBusy):
+            tasks.register_task_class(TaskClass('replaced', limit=5))
+
+        release.set()
+        assert await asyncio.wait_for(tasks._tasks['waiting'][0], 1) == 'waiting'
+        # Idle now
+        tasks.register_task_class(TaskClass('replaced', limit=5))
+        assert tasks._task_classes['replaced'].limit == 5
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('max_workers, server_workers, expected', [
+    (0, 0, 8),
+    (0, 1, 8),
+    (0, 4, 2),
+    (0, 16, 1),
+    (3, 4, 3),
+])
+def test_process_pool_workers_by_server_worker(monkeypatch, max_workers, server_workers, expected):
+    monkeypatch.setattr(basckground_tasks, 'available_cpus', lambda: 8)
+    monkeypatch.setattr(basckground_tasks.settings, 'SERVER_WORKERS', server_workers)
+    assert ProcessPool(max_workers).workers == expected
+
+
+def test_process_execution_mode(monkeypatch):
+    pool = ProcessPool(max_workers=1)
+    monkeypatch.setattr(basckground_tasks, 'process_pool', pool)
+
+    async def run():
+        tasks = BackgroundTasks()
+        await tasks.add_task('factorial', math.factorial, 20, execution_mode=ExecutionMode.PROCESS)
+        return await tasks._tasks['factorial'][0]
+
+    pool.start()
+    try:
+        assert asyncio.run(run()) == math.factorial(20)
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.parametrize('func, args', [
+    (lambda: None, ()),
+    (math.factorial, (threading.Lock(),)),
+])
+def test_not_picklable_process_task(func, args):
+    async def run():
+        tasks = BackgroundTasks()
+        with pytest.raises(NotPicklableTask):
+            await tasks.add_task('not picklable', func, *args, execution_mode=ExecutionMode.PROCESS)
+        assert not tasks._tasks
+
+    asyncio.run(run())
+
+
+class _Calls:
+    # Hashable, so the arguments can be coalesced
+    def __init__(self) -> None:
+        self.count = 0
+
+
+async def _counted(calls: _Calls, release: asyncio.Event, fail: bool = False, options: list | None = None):
+    calls.count += 1
+    await release.wait()
+    if fail:
+        raise RuntimeError('failed')
+    return calls.count
+
+
+def test_coalesce_shares_one_execution():
+    async def run():
+        calls, release = _Calls(), asyncio.Event()
+        tasks = BackgroundTasks()
+        first = await tasks.add_auto_named_task(_counted, calls, release, coalesce=True)
+        second = await tasks.add_auto_named_task(_counted, calls, release, coalesce=True)
+        other = await tasks.add_auto_named_task(_counted, calls, release, True, coalesce=True)
+        release.set()
+        await asyncio.gather(first, other, return_exceptions=True)
+        return tasks, calls, first, second, other
+
+    tasks, calls, first, second, other = asyncio.run(run())
+    assert first is second
+    assert other is not first
+    assert calls.count == 2
+    assert tasks.coalesced_tasks == 1
+
+    # Each caller gets the result, the task is removed by the last one
+    name = first.get_name()
+    result = tasks.result_task(name)
+    assert name in tasks._tasks
+    assert tasks.result_task(name) == result
+    assert name not in tasks._tasks
+
+
+def test_coalesce_removal_by_sharers():
+    async def run():
+        calls, release = _Calls(), asyncio.Event()
+        tasks = BackgroundTasks()
+        task = await tasks.add_auto_named_task(_counted, calls, release, coalesce=True)
+        await tasks.add_auto_named_task(_counted, calls, release, coalesce=True)
+        await tasks.add_auto_named_task(_counted, calls, release, coalesce=True)
+        name = task.get_name()
+
+        tasks.remove_task(name)
+        tasks.remove_task(name)
+        await asyncio.sleep(0)
+        # Other caller still waits for it
+        assert not task.cancelled() and name in tasks._tasks
+
+        tasks.remove_task(name)
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        assert name not in tasks._tasks and name not in tasks._shared
+        assert not tasks._in_flight
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_coalesce_key_freed_when_done(fail):
+    async def run():
+        calls, release = _Calls(), asyncio.Event()
+        tasks = BackgroundTasks()
+        task = await tasks.add_auto_named_task(_counted, calls, release, fail, coalesce=True)
+        release.set()
+        await asyncio.gather(task, return_exceptions=True)
+        assert not tasks._in_flight
+
+        # Not shared with the finished task
+        again = await tasks.add_auto_named_task(_counted, calls, release, fail, coalesce=True)
+        await asyncio.gather(again, return_exceptions=True)
+        return task, again, calls
+
+    task, again, calls = asyncio.run(run())
+    assert task is not again
+    assert calls.count == 2
+
+
+def test_not_hashable_arguments_not_coalesced():
+    async def run():
+        calls, release = _Calls(), asyncio.Event()
+        tasks = BackgroundTasks()
+        release.set()
+        first = await tasks.add_auto_named_task(_counted, calls, release, coalesce=True, options=[1])
+        second = await tasks.add_auto_named_task(_counted, calls, release, coalesce=True, options=[1])
+        await asyncio.gather(first, second, return_exceptions=True)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is not second
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replace the "time" module seen by basckground_tasks, the event loop keeps the real clock
+    """
+    monkeypatch.setattr(basckground_tasks.settings, 'BACKGROUND_TASK_PERSISTENCE_LIMIT', 60)
+    clock = SimpleNamespace(offset=0.0)
+    monkeypatch.setattr(basckground_tasks, 'time', SimpleNamespace(
+        time=lambda: time.time() + clock.offset,
+        monotonic=lambda: time.monotonic() + clock.offset,
+    ))
+    return clock
+
+
+def test_purge_finished_tasks_after_limit(clock):
+    async def run():
+        events, release = [], asyncio.Event()
+        tasks = BackgroundTasks()
+        await tasks.add_task('old', _job, events, 'old')
+        await tasks._tasks['old'][0]
+        clock.offset += 61
+        await tasks.add_task('recent', _job, events, 'recent')
+        await tasks._tasks['recent'][0]
+        await tasks.add_task('live', _job, events, 'live', release)
+        await asyncio.sleep(0)
+
+        tasks.purge_tasks()
+        assert set(tasks._tasks) == {'recent', 'live'}
+
+        # Still running after the limit
+        clock.offset += 61
+        tasks.purge_tasks()
+        assert set(tasks._tasks) == {'live'}
+        release.set()
+        await tasks._tasks['live'][0]
+        assert tasks.result_task('live') == 'live'
+
+    asyncio.run(run())
+
+
+def test_purge_skips_removed_tasks(clock):
+    async def run():
+        events, release = [], asyncio.Event()
+        tasks = BackgroundTasks()
+        for name in ('removed', 'reused'):
+            await tasks.add_task(name, _job, events, name)
+            await tasks._tasks[name][0]
+            tasks.remove_task(name)
+        # Same name than a removed task, its entry in the expiry index is not this task
+        await tasks.add_task('reused', _job, events, 'reused', release)
+        await asyncio.sleep(0)
+        assert len(tasks._expiry_index) == 2
+
+        clock.offset += 61
+        tasks.purge_tasks()
+        assert not tasks._expiry_index
+        assert set(tasks._tasks) == {'reused'}
+        release.set()
+        assert await tasks._tasks['reused'][0] == 'reused'
+
+    asyncio.run(run())
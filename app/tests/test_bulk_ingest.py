@@ -0,0 +1,16 @@
+import asyncio
+
+import pytest
+
+from services.users.bulk_ingest import InvalidConflictColumns, ingest_users
+
+
+async def _users():
+    return
+    yield
+
+
+@pytest.mark.parametrize('conflict_columns', [None, (), ('id',)])
+def test_upsert_needs_inserted_conflict_columns(conflict_columns):
+    with pytest.raises(InvalidConflictColumns):
+        asyncio.run(ingest_users(_users(), upsert=True, conflict_columns=conflict_columns))
@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+import zlib
+
+import pytest
+
+from core.utils import negotiate_encoding
+from middleware.compression import CompressionMiddleware
+
+JSON = b'{"items": [' + b','.join(b'{"id": %d, "name": "user"}' % i for i in range(200)) + b']}'
+
+
+def _app(messages: list[dict]):
+    async def app(scope, receive, send):
+        for message in messages:
+            await send(message)
+    return app
+
+
+def _start(content_type: str = 'application/json', **headers) -> dict:
+    raw = [(b'content-type', content_type.encode())]
+    raw += [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()]
+    return {'type': 'http.response.start', 'status': 200, 'headers': raw}
+
+
+def _run(app, accept_encoding: str = 'gzip', **options) -> list[dict]:
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/', 'headers': [(b'accept-encoding', accept_encoding.encode())]}
+    asyncio.run(CompressionMiddleware(app, **options)(scope, receive, send))
+    return sent
+
+
+def _headers(message: dict) -> dict[str, str]:
+    return {name.decode(): value.decode() for name, value in message['headers']}
+
+
+def test_gzip_json_body():
+    start, body = _run(_app([_start(), {'type': 'http.response.body', 'body': JSON}]))
+    headers = _headers(start)
+    assert headers['content-encoding'] == 'gzip'
+    assert headers['vary'] == 'Accept-Encoding'
+    assert int(headers['content-length']) == len(body['body']) < len(JSON)
+    assert gzip.decompress(body['body']) == JSON
+
+
+def test_small_body_not_compressed():
+    start, body = _run(_app([_start(), {'type': 'http.response.body', 'body': b'{}'}]))
+    assert 'content-encoding' not in _headers(start)
+    assert body['body'] == b'{}'
+
+
+@pytest.mark.parametrize('start', [
+    _start(content_encoding='br'),
+    _start(cache_control='no-transform'),
+    _start('image/png'),
+])
+def test_not_compressible_response(start):
+    sent_start, body = _run(_app([start, {'type': 'http.response.body', 'body': JSON}]))
+    assert _headers(sent_start).get('content-encoding') == _headers(start).get('content-encoding')
+    assert body['body'] == JSON
+
+
+def test_not_accepted():
+    start, body = _run(_app([_start(), {'type': 'http.response.body', 'body': JSON}]), 'gzip;q=0, identity')
+    assert 'content-encoding' not in _headers(start)
+    assert body['body'] == JSON
+
+
+def test_ndjson_stream_flushed_by_chunk():
+    chunks = [b'{"id": %d}\n' % i * 100 for i in range(3)]
+    messages = [_start('application/x-ndjson')]
+    messages += [{'type': 'http.response.body', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages.append({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    start, *bodies = _run(_app(messages))
+    headers = _headers(start)
+    assert headers['content-encoding'] == 'gzip'
+    assert headers['vary'] == 'Accept-Encoding'
+    assert len(bodies) == 4
+
+    decompressor = zlib.decompressobj(31)
+    for chunk, body in zip(chunks, bodies):
+        # Each chunk can be decompressed when received
+        assert decompressor.decompress(body['body']) == chunk
+    assert decompressor.decompress(bodies[-1]['body']) == b''
+    assert decompressor.eof
+
+
+def test_start_sent_before_other_messages():
+    pathsend = {'type': 'http.response.pathsend', 'path': '/tmp/file.json'}
+    sent = _run(_app([_start(), pathsend]))
+    assert [_['type'] for _ in sent] == ['http.response.start', 'http.response.pathsend']
+    assert 'content-encoding' not in _headers(sent[0])
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('GZIP; Q=0.5', 'gzip'),
+    ('*', 'zstd'),
+    ('*;q=0', None),
+    ('gzip;q=0, *', 'zstd'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('br, gzip', 'br'),
+    ('zstd;q=0.5, br;q=0.5', 'zstd'),
+    ('gzip;q=x', None),
+    ('', None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, ['zstd', 'br', 'gzip']) == expected
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import column, delete, insert, select, table, update
+
+from core import database
+from core.database import ReplicaRouter, RoutingSession
+
+users = table('users', column('id'))
+
+
+def test_fan_out_limit_shared_by_calls(monkeypatch):
+    monkeypatch.setattr(database.settings, 'DATABASE_FAN_OUT_CONCURRENCY', 2)
+    database.get_fan_out_limiter.cache_clear()
+    running = peak = 0
+
+    @contextlib.asynccontextmanager
+    async def session_factory():
+        yield None
+
+    async def query(session):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return 1
+
+    async def run():
+        return await asyncio.gather(*(
+            database.fan_out(query, query, session_factory=session_factory) for _ in range(3)
+        ))
+
+    try:
+        assert asyncio.run(run()) == [[1, 1]] * 3
+    finally:
+        database.get_fan_out_limiter.cache_clear()
+    assert peak == 2
+
+
+def _engine(name: str, connections: int = 0) -> SimpleNamespace:
+    # Only what the router and the session use of an AsyncEngine
+    return SimpleNamespace(
+        name=name, url=SimpleNamespace(host=name, port=5432), sync_engine=f'{name}-sync',
+        pool=SimpleNamespace(checkedout=lambda: connections)
+    )
+
+
+@pytest.fixture
+def engines(monkeypatch) -> SimpleNamespace:
+    primary = _engine('primary')
+    router = ReplicaRouter(primary, [_engine('replica1'), _engine('replica2')])
+    monkeypatch.setattr(database, 'get_engine', lambda: primary)
+    monkeypatch.setattr(database, 'get_replica_router', lambda: router)
+    return SimpleNamespace(primary=primary, router=router)
+
+
+def test_read_only_session_sticks_to_one_replica(engines):
+    session = RoutingSession(info={'read_only': True})
+    binds = {session.get_bind(clause=select(users)) for _ in range(3)}
+    # Round robin would change the replica on each call
+    assert binds == {'replica1-sync'}
+    assert RoutingSession(info={'read_only': True}).get_bind(clause=select(users)) == 'replica2-sync'
+
+
+@pytest.mark.parametrize('clause', [insert(users), update(users), delete(users)])
+def test_read_only_session_writes_to_primary(engines, clause):
+    session = RoutingSession(info={'read_only': True})
+    assert session.get_bind(clause=select(users)) == 'replica1-sync'
+    assert session.get_bind(clause=clause) == 'primary-sync'
+    # Reads its own writes
+    assert session.info['has_written']
+    assert session.get_bind(clause=select(users)) == 'primary-sync'
+
+
+def test_read_only_session_flush_goes_to_primary(engines):
+    session = RoutingSession(info={'read_only': True})
+    session._flushing = True
+    assert session.get_bind() == 'primary-sync'
+    session._flushing = False
+    assert session.get_bind(clause=select(users)) == 'primary-sync'
+
+
+def test_session_not_read_only_uses_primary(engines):
+    session = RoutingSession()
+    assert session.get_bind(clause=select(users)) == 'primary-sync'
+    assert 'replica' not in session.info
+
+
+def test_router_without_replicas_uses_primary():
+    primary = _engine('primary')
+    assert ReplicaRouter(primary, []).get_engine() is primary
+
+
+def test_router_round_robin():
+    replicas = [_engine('replica1'), _engine('replica2')]
+    router = ReplicaRouter(_engine('primary'), replicas)
+    assert [router.get_engine() for _ in range(4)] == replicas * 2
+
+
+def test_router_least_connections():
+    replicas = [_engine('replica1', 5), _engine('replica2', 1), _engine('replica3', 3)]
+    router = ReplicaRouter(_engine('primary'), replicas, balancing='least_connections')
+    assert router.get_engine() is replicas[1]
+
+
+def test_router_unknown_balancing():
+    with pytest.raises(ValueError):
+        ReplicaRouter(_engine('primary'), [], balancing='random')
+
+
+def test_router_skips_lagging_replicas(monkeypatch):
+    primary, replicas = _engine('primary'), [_engine('replica1'), _engine('replica2')]
+    router = ReplicaRouter(primary, replicas, max_lag=10)
+    lags = {}
+
+    async def replica_lag(engine):
+        return lags[engine.name]
+
+    monkeypatch.setattr(router, '_replica_lag', replica_lag)
+    # inf when the lag can't be checked
+    for replica1, replica2, expected in ((1, 20, replicas[:1]), (float('inf'), 20, []), (0, 0, replicas)):
+        lags.update(replica1=replica1, replica2=replica2)
+        asyncio.run(router.check_lag())
+        assert router.healthy == expected
+    assert router.get_engine() in replicas
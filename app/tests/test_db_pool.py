@@ -0,0 +1,57 @@
+import asyncio
+
+from core.db_pool import AdaptiveLimiter
+
+
+def _limits(limiter: AdaptiveLimiter, times: int, wait: float, hold: float) -> list[int]:
+    limits = []
+    for _ in range(times):
+        limiter.observe(wait=wait, hold=hold)
+        limits.append(limiter.limit)
+    return limits
+
+
+def test_limit_shrinks_when_hold_time_grows():
+    # interval=0 adjusts on every observation
+    limiter = AdaptiveLimiter(max_limit=8, min_limit=2, interval=0)
+    assert _limits(limiter, 1, wait=0, hold=0.01) == [8]
+    # A quarter less each time, down to min_limit
+    assert _limits(limiter, 5, wait=0, hold=0.05) == [6, 4, 3, 2, 2]
+
+
+def test_limit_grows_when_checkouts_wait():
+    limiter = AdaptiveLimiter(max_limit=4, min_limit=2, target_wait=0.01, interval=0)
+    _limits(limiter, 1, wait=0, hold=0.01)
+    assert _limits(limiter, 2, wait=0, hold=0.05) == [3, 2]
+    # Healthy hold time again, checkouts waiting over target_wait
+    assert _limits(limiter, 3, wait=0.1, hold=0.01) == [3, 4, 4]
+    # Waits under target_wait don't change it
+    limiter.limit = 2
+    assert _limits(limiter, 2, wait=0.001, hold=0.01) == [2, 2]
+
+
+def test_limit_adjusted_by_interval():
+    limiter = AdaptiveLimiter(max_limit=8, interval=3600)
+    limiter._baseline_hold = 0.01
+    # Not adjusted within the interval
+    assert _limits(limiter, 3, wait=0, hold=1) == [8, 8, 8]
+    # Adjusted with the average of the window
+    limiter._window_start -= 3600
+    assert _limits(limiter, 1, wait=0, hold=1) == [6]
+    assert not limiter._window_holds
+
+
+def test_growing_limit_wakes_waiters():
+    async def run():
+        limiter = AdaptiveLimiter(max_limit=2, min_limit=1, interval=0)
+        limiter.limit = 1
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        limiter.observe(wait=0.1, hold=0.01)
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.as_dict() == {'limit': 2, 'in_use': 2, 'waiting': 0}
+
+    asyncio.run(run())
@@ -0,0 +1,95 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from core.basckground_tasks import ResultNotSet
+from core.distributed_tasks import DistributedTasks, NotRegisteredTask
+
+
+async def add(a: int, b: int) -> int:
+    return a + b
+
+
+async def fail(message: str):
+    raise KeyError(message)
+
+
+def _distributed_tasks(client, consumer: str, claim_idle_time: int = 1) -> DistributedTasks:
+    tasks = DistributedTasks(client, stream='test:tasks', consumer=consumer, claim_idle_time=claim_idle_time)
+    tasks.register(add)
+    tasks.register(fail)
+    return tasks
+
+
+async def _wait_result(tasks: DistributedTasks, name: str, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        try:
+            return await tasks.result_task(name)
+        except ResultNotSet:
+            if asyncio.get_running_loop().time() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+def test_delivery():
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        producer = _distributed_tasks(client, 'producer')
+        worker = _distributed_tasks(client, 'worker')
+        await worker.start()
+        try:
+            await producer.add_task('sum', add, 1, b=2)
+            return await _wait_result(producer, 'sum')
+        finally:
+            await worker.stop()
+
+    assert asyncio.run(run()) == 3
+
+
+def test_error_propagation():
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        tasks = _distributed_tasks(client, 'worker')
+        await tasks.start()
+        try:
+            await tasks.add_task('failing', fail, 'boom')
+            with pytest.raises(KeyError, match='boom'):
+                await _wait_result(tasks, 'failing')
+        finally:
+            await tasks.stop()
+
+    asyncio.run(run())
+
+
+def test_not_registered_function():
+    async def other():
+        pass
+
+    async def run():
+        tasks = _distributed_tasks(fakeredis.FakeAsyncRedis(), 'worker')
+        with pytest.raises(NotRegisteredTask):
+            await tasks.add_task('other', other)
+
+    asyncio.run(run())
+
+
+def test_reclaim_from_crashed_consumer():
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        tasks = _distributed_tasks(client, 'worker')
+        await tasks._ensure_group()
+        await tasks.add_task('orphan', add, 2, 3)
+        # A consumer reads the task and crashes without acknowledging it
+        response = await client.xreadgroup(tasks.group, 'crashed', {tasks.stream: '>'}, count=1)
+        assert response[0][1]
+
+        await asyncio.sleep(tasks.claim_idle_time)
+        await tasks.start()
+        try:
+            return await _wait_result(tasks, 'orphan')
+        finally:
+            await tasks.stop()
+
+    assert asyncio.run(run()) == 5
@@ -0,0 +1,68 @@
+import pytest
+from fastapi import FastAPI
+
+from core import openapi
+from core.openapi import fingerprint, load_prebuilt, write_prebuilt
+from core.settings import settings
+
+
+@pytest.fixture(autouse=True)
+def build(monkeypatch):
+    monkeypatch.setattr(settings, 'BUILD_ID', 'build-1')
+    openapi.build_id.cache_clear()
+    yield
+    openapi.build_id.cache_clear()
+
+
+def _set_build_id(monkeypatch, value: str):
+    monkeypatch.setattr(settings, 'BUILD_ID', value)
+    openapi.build_id.cache_clear()
+
+
+def _app(version: str = '1.0.0') -> FastAPI:
+    app = FastAPI(title='test', version=version)
+
+    @app.get('/items/')
+    async def list_items():
+        return []
+
+    return app
+
+
+def test_fingerprint_stable():
+    assert fingerprint(_app()) == fingerprint(_app())
+
+
+def test_fingerprint_tracks_build_and_version(monkeypatch):
+    built = fingerprint(_app())
+    assert built != fingerprint(_app('1.0.1'))
+    _set_build_id(monkeypatch, 'build-2')
+    assert built != fingerprint(_app())
+
+
+def test_build_id_from_git(monkeypatch):
+    _set_build_id(monkeypatch, '')
+    monkeypatch.setattr(openapi, '_git', lambda *args: openapi.subprocess.CompletedProcess(args, 0, 'abc\n'))
+    assert openapi.build_id() == 'abc'
+    openapi.build_id.cache_clear()
+    # Uncommitted changes
+    monkeypatch.setattr(openapi, '_git', lambda *args: openapi.subprocess.CompletedProcess(args, int('diff' in args)))
+    assert openapi.build_id() == ''
+    openapi.build_id.cache_clear()
+    monkeypatch.setattr(openapi, '_git', lambda *args: None)
+    assert openapi.build_id() == ''
+
+
+def test_prebuilt(tmp_path, monkeypatch):
+    write_prebuilt(_app(), tmp_path)
+    assert load_prebuilt(_app(), tmp_path) is not None
+    assert load_prebuilt(_app('1.0.1'), tmp_path) is None
+    _set_build_id(monkeypatch, 'build-2')
+    assert load_prebuilt(_app(), tmp_path) is None
+
+
+def test_prebuilt_without_build_id(tmp_path, monkeypatch):
+    write_prebuilt(_app(), tmp_path)
+    _set_build_id(monkeypatch, '')
+    monkeypatch.setattr(openapi, '_git', lambda *args: None)
+    assert load_prebuilt(_app(), tmp_path) is None
@@ -0,0 +1,70 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Uuid
+
+from core.exceptions import InvalidCursor
+from core.pagination import PaginationSecretNotSet, decode_cursor, encode_cursor
+from core.settings import settings
+
+table = Table(
+    'item', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+    Column('created', DateTime),
+    Column('uid', Uuid),
+)
+KEYS = [table.c.created, table.c.uid, table.c.id]
+VALUES = [datetime(2024, 1, 2, 3, 4, 5), uuid.uuid4(), 7]
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(settings, 'PAGINATION_SECRET', 'secret')
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_round_trip(descending):
+    assert decode_cursor(KEYS, encode_cursor(KEYS, VALUES, descending), descending) == VALUES
+
+
+def test_other_direction_rejected():
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEYS, encode_cursor(KEYS, VALUES), descending=True)
+    with pytest.raises(InvalidCursor):
+        decode_cursor(KEYS, encode_cursor(KEYS, VALUES, descending=True))
+
+
+def test_other_keys_rejected():
+    cursor = encode_cursor([table.c.id], [7])
+    with pytest.raises(InvalidCursor):
+        decode_cursor([table.c.name], cursor)
+
+
+def test_other_secret_rejected(monkeypatch):
+    cursor = encode_cursor([table.c.id], [7])
+    monkeypatch.setattr(settings, 'PAGINATION_SECRET', 'other')
+    with pytest.raises(InvalidCursor):
+        decode_cursor([table.c.id], cursor)
+
+
+@pytest.mark.parametrize('cursor', ['', 'abc', 'a.b.c', '!!.!!'])
+def test_malformed_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor([table.c.id], cursor)
+
+
+def test_tampered_rejected():
+    signature = encode_cursor([table.c.id], [7]).split('.')[1]
+    other_payload = encode_cursor([table.c.id], [8]).split('.')[0]
+    with pytest.raises(InvalidCursor):
+        decode_cursor([table.c.id], f'{other_payload}.{signature}')
+
+
+def test_without_secret(monkeypatch):
+    monkeypatch.setattr(settings, 'PAGINATION_SECRET', '')
+    with pytest.raises(PaginationSecretNotSet):
+        encode_cursor([table.c.id], [7])
+    with pytest.raises(PaginationSecretNotSet):
+        decode_cursor([table.c.id], 'Wzdd.AAAA')
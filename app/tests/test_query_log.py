@@ -0,0 +1,65 @@
+import pytest
+
+from core import query_log as query_log_module
+from core.query_log import QueryLog, normalize_statement
+
+
+@pytest.fixture
+def explained(monkeypatch) -> list:
+    explained = []
+    monkeypatch.setattr(query_log_module, 'add_fire_and_forget_task', lambda *args: explained.append(args))
+    return explained
+
+
+@pytest.mark.parametrize('statement, normalized', [
+    ('SELECT * FROM users WHERE id = $1', 'SELECT * FROM users WHERE id = ?'),
+    ("SELECT * FROM users WHERE name = 'O''Brien' AND age > 30", 'SELECT * FROM users WHERE name = ? AND age > ?'),
+    ('SELECT * FROM users WHERE id = %(id_1)s OR id = %s OR id = :id',
+     'SELECT * FROM users WHERE id = ? OR id = ? OR id = ?'),
+    ('SELECT * FROM users WHERE id IN ($1, $2, $3)', 'SELECT * FROM users WHERE id IN (...)'),
+    ('INSERT INTO users (id, name) VALUES ($1, $2), ($3, $4)', 'INSERT INTO users (id, name) VALUES (...)'),
+    ('SELECT id -- comment\n  FROM /* other */ users', 'SELECT id FROM users'),
+    # Casts and identifiers with digits are kept
+    ('SELECT id::text FROM table2 LIMIT 10', 'SELECT id::text FROM table2 LIMIT ?'),
+])
+def test_normalize_statement(statement, normalized):
+    assert normalize_statement(statement) == normalized
+
+
+def test_same_fingerprint_for_different_literals():
+    query_log = QueryLog()
+    query_log.record('SELECT * FROM users WHERE id IN ($1, $2)', 0.1)
+    query_log.record('SELECT * FROM users WHERE id IN ($1, $2, $3)', 0.3)
+    [stats] = query_log.top()
+    assert stats['calls'] == 2
+    assert stats['total_time'] == pytest.approx(0.4)
+    assert stats['max_time'] == 0.3
+
+
+def test_explain_slow_statements(explained):
+    query_log = QueryLog(slow_threshold=0.5)
+    engine = object()
+    query_log.record('SELECT * FROM users WHERE id = $1', 0.1, (1,), engine)
+    assert explained == []
+    query_log.record('SELECT * FROM users WHERE id = $1', 1, (1,), engine)
+    assert len(explained) == 1
+    # Not again while the plan is captured
+    query_log.record('SELECT * FROM users WHERE id = $1', 1, (1,), engine)
+    assert len(explained) == 1
+    assert query_log.top()[0]['slow_calls'] == 2
+
+
+def test_no_explain_without_parameters(explained):
+    # executemany, the parameters are a list that EXPLAIN can't use
+    query_log = QueryLog(slow_threshold=0.5)
+    query_log.record('INSERT INTO users (id) VALUES ($1)', 1, None, object())
+    assert explained == []
+    assert query_log.top()[0]['slow_calls'] == 1
+
+
+def test_max_statements():
+    query_log = QueryLog(max_statements=1)
+    query_log.record('SELECT * FROM users', 0.1)
+    query_log.record('SELECT * FROM groups', 0.1)
+    assert [_['statement'] for _ in query_log.top()] == ['SELECT * FROM users']
+    assert query_log.dropped == 1
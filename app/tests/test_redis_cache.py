@@ -0,0 +1,300 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from aiocache import Cache
+from pydantic import BaseModel
+
+from core import redis_cache
+from core.basckground_tasks import background_tasks
+from core.redis_cache import CacheInvalidation, LocalCache, cache_invalidation, hashed_key_builder, internal_cached
+from core.utils import merge_dicts
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Own server, clients without one share the data between tests
+    client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    monkeypatch.setattr(cache_invalidation, 'client', client)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def unregister_local_caches():
+    """
+    Local caches of the functions cached in a test are registered in the global cache_invalidation, without
+    unregistering them later invalidations would publish to Redis
+    """
+    registered = list(cache_invalidation._local_caches)
+    yield
+    for local_cache in list(cache_invalidation._local_caches):
+        if local_cache not in registered:
+            cache_invalidation.unregister(local_cache)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replace the "time" module seen by redis_cache, moving the clock doesn't affect the event loop or fakeredis
+    """
+    clock = SimpleNamespace(offset=0.0)
+    monkeypatch.setattr(redis_cache, 'time', SimpleNamespace(
+        time=lambda: time.time() + clock.offset,
+        monotonic=lambda: time.monotonic() + clock.offset,
+        perf_counter=time.perf_counter,
+    ))
+    return clock
+
+
+def _cached(client, calls: dict, name: str, local_cache: bool):
+    async def load(user_id: int) -> dict:
+        calls[name] += 1
+        return {'user_id': user_id, 'calls': calls[name]}
+
+    load.__name__ = load.__qualname__ = name
+    function = internal_cached(
+        cache=Cache.REDIS, namespace='test', ttl=60, local_cache=local_cache,
+        tags=lambda user_id: [f'user:{user_id}']
+    )(load)
+    function.cache.client = client
+    return function
+
+
+def test_invalidate_tags_from_function_without_local_cache(client):
+    async def run():
+        calls = {'with_l1': 0, 'without_l1': 0}
+        with_l1 = _cached(client, calls, 'with_l1', local_cache=True)
+        without_l1 = _cached(client, calls, 'without_l1', local_cache=False)
+
+        await with_l1(1)
+        await without_l1(1)
+        # Served by L1
+        assert (await with_l1(1))['calls'] == 1
+        assert with_l1.stats.l1_hits == 1
+
+        report = await without_l1.invalidate_tags('user:1')
+        assert report['keys'] == 2
+        # Removed from the L1 of the other function too, not served stale until its TTL
+        assert (await with_l1(1))['calls'] == 2
+        assert (await without_l1(1))['calls'] == 2
+
+    asyncio.run(run())
+
+
+def test_invalidate_many_clears_local_cache(client):
+    async def run():
+        calls = {'many': 0}
+        function = _cached(client, calls, 'many', local_cache=True)
+        # invalidate_many builds the keys from kwargs
+        await function(user_id=1)
+        await function(user_id=2)
+        await function.invalidate_many({'user_id': 1})
+        assert (await function(user_id=1))['calls'] == 3
+        assert (await function(user_id=2))['calls'] == 2
+
+    asyncio.run(run())
+
+
+def test_local_cache_evicts_least_recently_used():
+    local_cache = LocalCache(max_size=2, ttl=60)
+    local_cache.set('a', 1)
+    local_cache.set('b', 2)
+    assert local_cache.get('a') == 1
+    local_cache.set('c', 3)
+    assert local_cache.get('b') is None
+    assert local_cache.get('a') == 1
+    assert local_cache.get('c') == 3
+
+
+def test_local_cache_ttl(clock):
+    local_cache = LocalCache(max_size=10, ttl=5)
+    local_cache.set('a', 1)
+    clock.offset += 4.9
+    assert local_cache.get('a') == 1
+    clock.offset += 0.2
+    assert local_cache.get('a') is None
+    assert 'a' not in local_cache._values
+
+
+def test_invalidation_reaches_other_workers():
+    async def run():
+        server = fakeredis.FakeServer()
+        channel = 'test:cache-invalidation'
+        workers = [CacheInvalidation(fakeredis.FakeAsyncRedis(server=server), channel) for _ in range(2)]
+        local_caches = [LocalCache(), LocalCache()]
+        for worker, local_cache in zip(workers, local_caches):
+            worker.register(local_cache)
+            local_cache.set('key', 'value')
+            local_cache.set('other', 'value')
+            await worker.start()
+        try:
+            for _ in range(100):
+                if (await workers[0].client.pubsub_numsub(channel))[0][1] == 2:
+                    break
+                await asyncio.sleep(0.01)
+            await workers[0].publish('key')
+            for _ in range(100):
+                if local_caches[1].get('key') is None:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            for worker in workers:
+                await worker.stop()
+        return local_caches
+
+    local_caches = asyncio.run(run())
+    assert [_.get('key') for _ in local_caches] == [None, None]
+    assert [_.get('other') for _ in local_caches] == ['value', 'value']
+
+
+def test_unregister_local_cache():
+    invalidation = CacheInvalidation(fakeredis.FakeAsyncRedis(), 'test:cache-invalidation')
+    local_cache = LocalCache()
+    invalidation.register(local_cache)
+    assert invalidation.has_local_caches
+    invalidation.unregister(local_cache)
+    invalidation.unregister(local_cache)
+    assert not invalidation.has_local_caches
+
+
+def _protected(client, calls: list, **options):
+    async def load(user_id: int) -> dict:
+        calls.append(user_id)
+        await asyncio.sleep(0.05)
+        return {'user_id': user_id, 'calls': len(calls)}
+
+    function = internal_cached(cache=Cache.REDIS, namespace='test', ttl=60, **options)(load)
+    function.cache.client = client
+    return function
+
+
+async def _wait_for_calls(calls: list, count: int):
+    # Until the refresh in background computes and stores the value
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if len(calls) >= count and not background_tasks._tasks:
+            break
+
+
+def test_lock_lease_computes_once(client):
+    async def run():
+        calls = []
+        function = _protected(client, calls, lock_lease=2)
+        results = await asyncio.gather(*[function(1) for _ in range(5)])
+        assert calls == [1]
+        assert [_['calls'] for _ in results] == [1] * 5
+        # One miss per caller, polling for the value of the lock owner is not counted
+        assert function.stats.l2_misses == 5
+        assert function.stats.l2_hits == 0
+
+    asyncio.run(run())
+
+
+def test_early_expiration_recomputes_before_ttl(client, clock, monkeypatch):
+    async def run():
+        calls = []
+        function = _protected(client, calls, early_expiration=1)
+        await function(1)
+        clock.offset = 59
+        # random() == 0 doesn't move the expiration
+        monkeypatch.setattr(redis_cache.random, 'random', lambda: 0.0)
+        assert (await function(1))['calls'] == 1
+        # Near 1 it does, by -delta * log(1 - random()) ~ 0.05 * 27. The value is not expired yet, so it's
+        # returned while it's recomputed in background
+        monkeypatch.setattr(redis_cache.random, 'random', lambda: 1 - 1e-12)
+        assert (await function(1))['calls'] == 1
+        await _wait_for_calls(calls, 2)
+        monkeypatch.setattr(redis_cache.random, 'random', lambda: 0.0)
+        assert (await function(1))['calls'] == 2
+
+    asyncio.run(run())
+
+
+def test_stale_while_revalidate(client, clock):
+    async def run():
+        calls = []
+        function = _protected(client, calls, stale_ttl=30, lock_lease=2)
+        await function(1)
+        clock.offset = 70
+        # Expired but in stale_ttl, returned at once while one refresh runs in background
+        stale = await asyncio.gather(function(1), function(1))
+        assert [_['calls'] for _ in stale] == [1, 1]
+        await _wait_for_calls(calls, 2)
+        assert calls == [1, 1]
+        assert (await function(1))['calls'] == 2
+
+        # After stale_ttl the caller waits for the new value
+        clock.offset = 70 + 91
+        assert (await function(1))['calls'] == 3
+
+    asyncio.run(run())
+
+
+class _Filter(BaseModel):
+    name: str
+    ids: set[int]
+
+
+# Arguments of merge_dicts, only its path is used in the key
+_KEY_ARGS = ({'b': 1, 'a': {3, 1, 2}}, 'text')
+_KEY_KWARGS = {'flag': True, 'tags': frozenset({'b', 'a'}), 'filter': _Filter(name='x', ids={2, 1})}
+
+
+def test_hashed_key_stable_across_processes():
+    key_builder = hashed_key_builder()
+    key = key_builder(merge_dicts, *_KEY_ARGS, **_KEY_KWARGS)
+    # Another hash seed changes the iteration order of sets
+    code = (
+        'from tests.test_redis_cache import _KEY_ARGS, _KEY_KWARGS, hashed_key_builder, merge_dicts;'
+        'print(hashed_key_builder()(merge_dicts, *_KEY_ARGS, **_KEY_KWARGS))'
+    )
+    for seed in ('1', '2'):
+        output = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(__file__)), env={**os.environ, 'PYTHONHASHSEED': seed}
+        )
+        assert output.stdout.strip() == key
+
+
+def test_hashed_key_prefix():
+    key_builder = hashed_key_builder()
+
+    async def load(user_id: int):
+        return user_id
+
+    assert key_builder(merge_dicts, 1).startswith('core.utils.merge_dicts:')
+    key = key_builder(load, 1)
+    assert key.startswith(f'{__name__}.test_hashed_key_prefix.<locals>.load:')
+    # Fixed length, whatever the arguments
+    assert len(key) == len(key_builder(load, 'x' * 1000))
+
+
+@pytest.mark.parametrize('args, other_args', [
+    ((1, 2), (2, 1)),
+    ((1,), ('1',)),
+    ((1,), (1.5,)),
+    ((1,), (True,)),
+    (({'a': 1},), ({'a': '1'},)),
+    ((None,), ((),)),
+])
+def test_hashed_key_distinct_arguments(args, other_args):
+    key_builder = hashed_key_builder()
+    assert key_builder(merge_dicts, *args) != key_builder(merge_dicts, *other_args)
+
+
+def test_hashed_key_equal_arguments():
+    key_builder = hashed_key_builder()
+    assert key_builder(merge_dicts, {'a': 1, 'b': 2}, c=3, d=4) == key_builder(merge_dicts, {'b': 2, 'a': 1}, d=4, c=3)
+    assert key_builder(merge_dicts, {1: 'a', 'b': 2}) == key_builder(merge_dicts, {'b': 2, 1: 'a'})
+    assert key_builder(merge_dicts, 1, transaction_id='a') == key_builder(merge_dicts, 1, transaction_id='b')
+    assert hashed_key_builder(exclude=())(merge_dicts, 1, transaction_id='a') != key_builder(merge_dicts, 1)
+
+
+def test_hashed_key_unsupported_argument():
+    with pytest.raises(TypeError):
+        hashed_key_builder()(merge_dicts, object())
@@ -0,0 +1,100 @@
+import math
+import pickle
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from enum import Enum, IntEnum, StrEnum
+
+import pytest
+from pydantic import BaseModel, Field
+
+from core.serializers import OrjsonSerializer
+from tests.schemas_fixtures import user_fixture
+
+
+class Color(Enum):
+    RED = 'red'
+
+
+class Level(IntEnum):
+    HIGH = 2
+
+
+class Mode(StrEnum):
+    FAST = 'fast'
+
+
+class Aliased(BaseModel):
+    user_name: str = Field(alias='userName')
+    tags: list[str] = Field(default=[], alias='tagList')
+
+
+@pytest.fixture
+def serializer():
+    return OrjsonSerializer(compress_threshold=2 ** 31)
+
+
+@pytest.mark.parametrize('value', [
+    uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    Color.RED,
+    Level.HIGH,
+    Mode.FAST,
+    (1, 'a'),
+    Decimal('1.10'),
+    datetime(2020, 1, 1, tzinfo=timezone.utc),
+    date(2020, 1, 1),
+    {1, 2},
+    b'bytes',
+    OrderedDict(a=1),
+    {'id': uuid.UUID('12345678-1234-5678-1234-567812345678'), 'color': Color.RED},
+    {'nested': [{'pair': (1, 2)}]},
+    [Mode.FAST, 'fast'],
+    {1: 'int key'},
+])
+def test_round_trip_keeps_types(serializer, value):
+    loaded = serializer.loads(serializer.dumps(value))
+    assert loaded == value
+    assert type(loaded) is type(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            assert type(loaded[key]) is type(item)
+
+
+def test_round_trip_nan(serializer):
+    assert math.isnan(serializer.loads(serializer.dumps(float('nan'))))
+
+
+@pytest.mark.parametrize('value', [
+    {'a': [1, 2.5, 'b', None, True]},
+    ['a', 1],
+    'text',
+    10,
+])
+def test_json_values_use_orjson(serializer, value):
+    dumped = serializer.dumps(value)
+    assert dumped[:1] == b'J'
+    assert serializer.loads(dumped) == value
+
+
+def test_models(serializer):
+    user = user_fixture()
+    users = [user_fixture(username=f'user{i}') for i in range(3)]
+    assert serializer.loads(serializer.dumps(user)) == user
+    assert serializer.loads(serializer.dumps(users)) == users
+    assert serializer.loads(serializer.dumps({'user': user, 'count': 1})) == {'user': user, 'count': 1}
+
+
+def test_compressed_and_legacy_pickle():
+    serializer = OrjsonSerializer(compress_threshold=10)
+    value = {'key': 'x' * 100, 'id': uuid.uuid4()}
+    assert serializer.loads(serializer.dumps(value)) == value
+    assert serializer.loads(pickle.dumps(value)) == value
+
+
+def test_models_with_aliases(serializer):
+    model = Aliased(userName='name', tagList=['a'])
+    models = [model, Aliased(userName='other')]
+    assert serializer.loads(serializer.dumps(model)) == model
+    assert serializer.loads(serializer.dumps(models)) == models
+    assert serializer.loads(serializer.dumps({'model': model, 'models': models})) == {'model': model, 'models': models}
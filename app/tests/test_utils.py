@@ -0,0 +1,37 @@
+import asyncio
+from datetime import datetime, timezone
+
+from pydantic import BaseModel
+
+from core.utils import pydantic_orjson_result
+
+
+class Sample(BaseModel):
+    created: datetime
+    value: float
+
+
+SAMPLE = Sample(created=datetime(2024, 1, 1, tzinfo=timezone.utc), value=1e20)
+
+
+def _body(decorator, result) -> bytes:
+    @decorator
+    async def endpoint():
+        return result
+
+    response = asyncio.run(endpoint())
+    assert response.media_type == 'application/json'
+    return response.body
+
+
+def test_default_dumps_model_dicts():
+    assert _body(pydantic_orjson_result, SAMPLE) == b'{"created":"2024-01-01T00:00:00+00:00","value":1e20}'
+    assert _body(pydantic_orjson_result(), [SAMPLE]) == b'[{"created":"2024-01-01T00:00:00+00:00","value":1e20}]'
+    assert _body(pydantic_orjson_result, {'a': 1}) == b'{"a":1}'
+
+
+def test_direct_dumps_with_pydantic_core():
+    direct = pydantic_orjson_result(direct=True)
+    assert _body(direct, SAMPLE) == b'{"created":"2024-01-01T00:00:00Z","value":1e+20}'
+    assert _body(direct, [SAMPLE]) == b'[{"created":"2024-01-01T00:00:00Z","value":1e+20}]'
+    assert _body(direct, {'sample': SAMPLE}) == b'{"sample":{"created":"2024-01-01T00:00:00Z","value":1e20}}'